@@ -0,0 +1,257 @@
+"""
+Loopback cluster benchmark. Starts a MasterNode and a number of SlaveNodes on
+this host, runs a job for every combination of the swept settings (each in a
+process of its own, so that its memory use is measured on its own), and
+prints the results as JSON, so that runs can be compared with each other.
+
+Example:
+
+    python benchmarks/loopback.py --tasks 1000,10000 --payload-sizes 16,64K,16M --nodes 1,4 --slots 1,4 --output results.json
+"""
+import os
+import sys
+import json
+import time
+import logging
+import platform
+import argparse
+import resource
+import itertools
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from hurricane import MasterNode
+from hurricane import SlaveNode
+
+SIZE_SUFFIXES = {"K" : 1024, "M" : 1024 ** 2, "G" : 1024 ** 3}
+
+def parse_size(text):
+    """
+    Parse a size in bytes, with an optional K, M or G suffix.
+    """
+    text = text.strip().upper()
+
+    if text[-1] in SIZE_SUFFIXES:
+        return int(float(text[:-1]) * SIZE_SUFFIXES[text[-1]])
+
+    return int(text)
+
+def parse_list(text, parse=int):
+    """
+    Parse a comma-separated list of values.
+    """
+    return [parse(value) for value in text.split(",") if value.strip() != ""]
+
+def run_slave(initialize_port, slots, task_time, shared_memory):
+    """
+    Body of a slave node process. Batches are run by a pool of slots
+    threads, each task sleeping for task_time seconds and returning the size
+    of its payload.
+    """
+    slave = SlaveNode(master_node="127.0.0.1", initialize_port=initialize_port, slots=slots, shared_memory=shared_memory, level=logging.WARNING)
+    slave.initialize()
+    slave.wait_for_initialize()
+
+    executor = ThreadPoolExecutor(slots)
+
+    def run_batch(tasks):
+        for task in tasks:
+            if task_time > 0:
+                time.sleep(task_time)
+
+            slave.finish_task(task_id=task.get_task_id(), generated_data=len(task.get_data()))
+
+    while True:
+        executor.submit(run_batch, slave.wait_for_tasks())
+
+def get_rss():
+    """
+    Return the resident set size of this process in bytes, or None if it
+    can not be read.
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        return None
+
+def get_peak_rss():
+    """
+    Return the peak resident set size of this process in bytes, since it
+    started.
+    """
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # ru_maxrss is in kilobytes everywhere but on macOS
+    if sys.platform != "darwin":
+        peak_rss *= 1024
+
+    return peak_rss
+
+def get_cpu_time():
+    """
+    Return the CPU time used by this process (the master node), excluding
+    the slave node processes.
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+
+    return usage.ru_utime + usage.ru_stime
+
+def run_case(initialize_port, tasks, payload_size, nodes, slots, args):
+    """
+    Run one job of tasks tasks with payloads of payload_size bytes on nodes
+    slave nodes with slots slots each.
+
+    @returns the measurements of the job
+    """
+    master = MasterNode(initialize_port=initialize_port, shared_memory=args.shared_memory, level=logging.WARNING)
+    master.initialize()
+
+    slaves = [multiprocessing.Process(target=run_slave, args=(initialize_port, slots, args.task_time, args.shared_memory)) for index in range(nodes)]
+    for slave in slaves:
+        slave.start()
+
+    try:
+        deadline = time.monotonic() + args.timeout
+        while len(master.get_stats()["nodes"]) < nodes:
+            if time.monotonic() > deadline:
+                raise RuntimeError("Only " + str(len(master.get_stats()["nodes"])) + " of " + str(nodes) + " slave nodes connected")
+
+            time.sleep(0.05)
+
+        payload = bytes(payload_size)
+
+        # Warm up the connections to every slave node
+        warm_up = master.send_tasks([b""] * (nodes * slots))
+        list(master.gather(warm_up, args.timeout))
+
+        before = master.get_stats()
+        cpu_time = get_cpu_time()
+        start_time = time.monotonic()
+
+        task_ids = master.send_tasks(itertools.repeat(payload, tasks), chunksize=args.chunksize)
+        completed = sum(1 for task in master.gather(task_ids, args.timeout) if task != None)
+
+        elapsed = time.monotonic() - start_time
+        cpu_time = get_cpu_time() - cpu_time
+        after = master.get_stats()
+    finally:
+        master.stop()
+
+        for slave in slaves:
+            slave.terminate()
+            slave.join()
+
+    return {
+        "tasks" : tasks,
+        "payload_size" : payload_size,
+        "nodes" : nodes,
+        "slots" : slots,
+        "chunksize" : args.chunksize,
+        "task_time" : args.task_time,
+        "shared_memory" : args.shared_memory,
+        "completed_tasks" : completed,
+        "elapsed" : elapsed,
+        "tasks_per_second" : completed / elapsed if elapsed > 0 else None,
+        "round_trip_p50" : after["latency"]["round_trip"]["p50"],
+        "round_trip_p99" : after["latency"]["round_trip"]["p99"],
+        "service_p50" : after["latency"]["service"]["p50"],
+        "service_p99" : after["latency"]["service"]["p99"],
+        "master_cpu_seconds" : cpu_time,
+        "master_cpu_utilization" : cpu_time / elapsed if elapsed > 0 else None,
+        "master_rss" : get_rss(),
+        "master_peak_rss" : get_peak_rss(),
+        "bytes_sent" : after["network"]["bytes_sent"] - before["network"]["bytes_sent"],
+        "bytes_received" : after["network"]["bytes_received"] - before["network"]["bytes_received"],
+        "shared_memory_bytes_sent" : after["network"]["shared_memory_bytes_sent"] - before["network"]["shared_memory_bytes_sent"],
+        "shared_memory_bytes_received" : after["network"]["shared_memory_bytes_received"] - before["network"]["shared_memory_bytes_received"],
+    }
+
+def run_case_process(connection, initialize_port, tasks, payload_size, nodes, slots, args):
+    """
+    Body of the process each job runs in. The peak resident set size of a
+    process only ever grows, so each job gets a fresh process for its
+    master node to measure its own peak. The measurements, or the error
+    that stopped the job, are sent back over connection.
+    """
+    try:
+        connection.send(run_case(initialize_port, tasks, payload_size, nodes, slots, args))
+    except (RuntimeError, OSError) as err:
+        connection.send({"tasks" : tasks, "payload_size" : payload_size, "nodes" : nodes, "slots" : slots, "error" : str(err)})
+    finally:
+        connection.close()
+
+def run_case_in_process(initialize_port, tasks, payload_size, nodes, slots, args):
+    """
+    Run one job in a process of its own.
+
+    @returns the measurements of the job
+    """
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+
+    # Not a daemon, since the master node starts the slave node processes
+    process = multiprocessing.Process(target=run_case_process, args=(sender, initialize_port, tasks, payload_size, nodes, slots, args))
+    process.start()
+    sender.close()
+
+    try:
+        return receiver.recv()
+    except EOFError:
+        process.join()
+
+        return {"tasks" : tasks, "payload_size" : payload_size, "nodes" : nodes, "slots" : slots, "error" : "The job's process exited with code " + str(process.exitcode)}
+    finally:
+        process.join()
+
+def get_environment():
+    """
+    Describe the host the benchmark ran on.
+    """
+    return {
+        "python" : platform.python_version(),
+        "platform" : platform.platform(),
+        "cpu_count" : multiprocessing.cpu_count(),
+        "time" : time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark a hurricane cluster running on this host.")
+    parser.add_argument("--tasks", default="1000", help="comma-separated numbers of tasks per job")
+    parser.add_argument("--payload-sizes", default="16,1K,64K,1M", help="comma-separated payload sizes in bytes (K, M and G suffixes are allowed)")
+    parser.add_argument("--nodes", default="1,2", help="comma-separated numbers of slave nodes")
+    parser.add_argument("--slots", default="1,4", help="comma-separated numbers of slots per slave node")
+    parser.add_argument("--chunksize", type=int, default=1, help="tasks per batch")
+    parser.add_argument("--task-time", type=float, default=0, help="seconds each task takes on a slave node")
+    parser.add_argument("--max-bytes", default="256M", help="cap on the payload bytes of one job; jobs with large payloads run fewer tasks")
+    parser.add_argument("--no-shared-memory", dest="shared_memory", action="store_false", help="send tasks over the loopback network instead of shared memory")
+    parser.add_argument("--timeout", type=float, default=300, help="seconds to wait for a job before giving up on it")
+    parser.add_argument("--port", type=int, default=23222, help="the initialize port of the first job; each following job uses a port three higher")
+    parser.add_argument("--output", default=None, help="file to write the JSON results to (default: standard output)")
+    args = parser.parse_args()
+
+    max_bytes = parse_size(args.max_bytes)
+    results = []
+    initialize_port = args.port
+
+    for tasks, payload_size, nodes, slots in itertools.product(parse_list(args.tasks), parse_list(args.payload_sizes, parse_size), parse_list(args.nodes), parse_list(args.slots)):
+        job_tasks = max(1, min(tasks, max_bytes // max(1, payload_size)))
+
+        print("Running " + str(job_tasks) + " tasks of " + str(payload_size) + " bytes on " + str(nodes) + " nodes with " + str(slots) + " slots", file=sys.stderr)
+
+        results.append(run_case_in_process(initialize_port, job_tasks, payload_size, nodes, slots, args))
+
+        # Each master node uses the initialize port and the one two above it
+        initialize_port += 3
+
+    report = json.dumps({"environment" : get_environment(), "results" : results}, indent=2)
+
+    if args.output == None:
+        print(report)
+    else:
+        with open(args.output, "w") as output:
+            output.write(report + "\n")
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
 from .master import MasterNode
 from .slave import SlaveNode
+from .relay import RelayNode
 
 __author__ = "Vale Tolpegin"
 __version__ = "0.0.1"
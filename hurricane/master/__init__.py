@@ -1 +1,6 @@
 from .master import MasterNode
+from .future import TaskFuture
+from .scheduler import Scheduler
+from .scheduler import RoundRobinScheduler
+from .scheduler import LeastLoadedScheduler
+from .scheduler import ServiceTimeScheduler
@@ -0,0 +1,57 @@
+MAP_CHUNK_TIME = 0.1
+MAP_MAX_CHUNKSIZE = 10000
+MAP_WINDOW_PER_SLOT = 2
+
+# Weight of the newest sample in the running estimate of the time per task,
+# and the most a chunk can grow by from one chunk to the next
+CHUNK_SMOOTHING = 0.25
+CHUNK_GROWTH = 4
+
+class ChunkSizer:
+    """
+    Picks the number of tasks to put in each chunk of a map. Chunks start
+    with a single task; as chunks complete, the time a task takes (from its
+    chunk being sent to a node to its completions arriving) is estimated,
+    and chunks are sized to take about map_chunk_time seconds each. That is
+    long enough for the cost of sending a chunk to be small next to the
+    tasks in it, and short enough to spread the tasks over many nodes and
+    keep stragglers short.
+
+    A fixed chunksize turns the sizing off.
+    """
+
+    def __init__(self, chunksize=None, **kwargs):
+        self.target_time = kwargs.get('map_chunk_time', MAP_CHUNK_TIME)
+        self.max_chunksize = kwargs.get('map_max_chunksize', MAP_MAX_CHUNKSIZE)
+
+        self.fixed = chunksize != None
+        self.chunksize = max(1, chunksize) if chunksize != None else 1
+        self.task_time = None
+
+    def get_chunksize(self):
+        """
+        Return the number of tasks to put in the next chunk.
+        """
+        return self.chunksize
+
+    def record(self, tasks, service_time):
+        """
+        Record that a chunk of tasks tasks completed service_time seconds
+        after it was sent to a node, and size the next chunks accordingly.
+        """
+        if self.fixed or tasks <= 0 or service_time < 0:
+            return
+
+        task_time = service_time / tasks
+
+        if self.task_time == None:
+            self.task_time = task_time
+        else:
+            self.task_time += CHUNK_SMOOTHING * (task_time - self.task_time)
+
+        if self.task_time <= 0:
+            chunksize = self.max_chunksize
+        else:
+            chunksize = int(self.target_time / self.task_time)
+
+        self.chunksize = max(1, min(chunksize, self.chunksize * CHUNK_GROWTH, self.max_chunksize))
@@ -0,0 +1,97 @@
+import math
+from collections import deque
+
+# Sensitivity of the failure detector: a node is suspected once phi, the
+# -log10 of the probability that a heartbeat is still on its way, exceeds
+# the threshold. A phi of 8 means a 1 in 10^8 chance of a false suspicion
+# if heartbeat intervals keep following the observed distribution.
+PHI_THRESHOLD = 8.0
+HEARTBEAT_WINDOW = 100
+MIN_HEARTBEAT_DEVIATION = 0.1
+ACCEPTABLE_HEARTBEAT_PAUSE = 0.5
+
+class PhiAccrualDetector:
+    """
+    Phi accrual failure detector. Instead of a fixed timeout, it keeps a
+    window of the intervals between each node's heartbeats and rates how
+    unlikely it is that a node which has been silent for so long is still
+    alive. Nodes with regular heartbeats are suspected quickly, while nodes
+    on jittery networks are given more slack.
+    """
+
+    def __init__(self, **kwargs):
+        self.threshold = kwargs.get('phi_threshold', PHI_THRESHOLD)
+        self.window = kwargs.get('heartbeat_window', HEARTBEAT_WINDOW)
+        self.min_deviation = kwargs.get('min_heartbeat_deviation', MIN_HEARTBEAT_DEVIATION)
+        self.acceptable_pause = kwargs.get('acceptable_heartbeat_pause', ACCEPTABLE_HEARTBEAT_PAUSE)
+
+        self.intervals = {}
+        self.last_heartbeats = {}
+
+    def heartbeat(self, node, now, interval=None):
+        """
+        Record a heartbeat from node received at time now. interval is how
+        often the node says it sends heartbeats; it is used to estimate the
+        distribution until real intervals have been measured.
+        """
+        if node not in self.intervals:
+            self.intervals[node] = deque(maxlen=self.window)
+
+            if interval != None:
+                # Bootstrap with a wide distribution around the announced
+                # interval so the first missed heartbeats are not fatal
+                self.intervals[node].extend([interval - interval / 4, interval + interval / 4])
+        elif node in self.last_heartbeats:
+            self.intervals[node].append(now - self.last_heartbeats[node])
+
+        self.last_heartbeats[node] = now
+
+    def remove(self, node):
+        """
+        Forget everything about node.
+        """
+        self.intervals.pop(node, None)
+        self.last_heartbeats.pop(node, None)
+
+    def is_monitored(self, node):
+        """
+        Return whether node has sent a heartbeat.
+        """
+        return node in self.last_heartbeats
+
+    def phi(self, node, now):
+        """
+        Return the suspicion level of node at time now: 0 for nodes that
+        have not sent enough heartbeats to judge.
+        """
+        intervals = self.intervals.get(node, None)
+        if not intervals:
+            return 0.0
+
+        mean = sum(intervals) / len(intervals)
+        variance = sum((interval - mean) ** 2 for interval in intervals) / len(intervals)
+        deviation = max(math.sqrt(variance), self.min_deviation)
+
+        return get_phi(now - self.last_heartbeats[node], mean + self.acceptable_pause, deviation)
+
+    def is_available(self, node, now):
+        """
+        Return whether node is still believed to be alive at time now.
+        """
+        return self.phi(node, now) < self.threshold
+
+def get_phi(elapsed, mean, deviation):
+    """
+    Return -log10 of the probability that a heartbeat arrives more than
+    elapsed seconds after the previous one, if the intervals are normally
+    distributed. The normal distribution is approximated with a logistic
+    function, which is accurate enough here and cheap to compute.
+    """
+    y = (elapsed - mean) / deviation
+    a = y * (1.5976 + 0.070566 * y * y)
+
+    # phi = log10(1 + e^a), arranged so that e^a never overflows
+    if a > 0:
+        return (a + math.log1p(math.exp(-a))) / math.log(10)
+
+    return math.log1p(math.exp(a)) / math.log(10)
@@ -0,0 +1,231 @@
+import heapq
+from time import time
+from time import monotonic
+from collections import deque
+
+# Seconds a batch has to wait to be treated as one priority level higher
+PRIORITY_AGING = 60.0
+
+class QueueEntry:
+    """
+    A batch in the dispatch queue, with what it is ordered by.
+    """
+
+    __slots__ = ("batch", "priority", "deadline", "sequence", "enqueue_time", "queued")
+
+    def __init__(self, batch, priority, deadline, sequence, enqueue_time):
+        self.batch = batch
+        self.priority = priority
+        self.deadline = deadline
+        self.sequence = sequence
+        self.enqueue_time = enqueue_time
+        self.queued = True
+
+class PriorityLevel:
+    """
+    The queued batches of one priority, ordered earliest deadline first
+    (batches without a deadline last, in the order they were queued), and
+    also kept in the order they were queued to find the one that has
+    waited longest.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.arrivals = deque()
+        self.size = 0
+
+    def push(self, entry):
+        deadline = entry.deadline if entry.deadline != None else float("inf")
+
+        heapq.heappush(self.heap, (deadline, entry.sequence, entry))
+        self.arrivals.append(entry)
+        self.size += 1
+
+    def peek(self):
+        return self.heap[0][2]
+
+    def pop(self):
+        entry = heapq.heappop(self.heap)[2]
+        entry.queued = False
+        self.size -= 1
+
+        # Entries are dropped from the arrival order lazily
+        while self.arrivals and not self.arrivals[0].queued:
+            self.arrivals.popleft()
+
+        return entry
+
+    def get_oldest_enqueue_time(self):
+        return self.arrivals[0].enqueue_time
+
+class DispatchQueue:
+    """
+    The queue of batches waiting for a free slot. Batches are dispatched in
+    order of priority (highest first) and, within a priority, earliest
+    deadline first. Deadlines are UNIX timestamps, as returned by
+    time.time(), so that they survive a restart of the master node.
+
+    To keep low priority batches from starving, a priority level is treated
+    as one level higher for every priority_aging seconds its oldest batch
+    has been waiting. Batches put back after a node failed are dispatched
+    before all others.
+
+    Every batch is indexed by batch id from when it is queued until it
+    completes or is abandoned, so its priority and deadline are kept while
+    it is in flight and if it is queued again. The queue also counts how
+    many batches with a deadline completed in time.
+    """
+
+    def __init__(self, **kwargs):
+        self.priority_aging = kwargs.get('priority_aging', PRIORITY_AGING)
+
+        self.levels = {}
+        self.retries = deque()
+        self.entries = {}
+        self.sequence = 0
+        self.size = 0
+        self.next_level = None
+
+        self.deadlines_met = 0
+        self.deadlines_missed = 0
+        self.total_lateness = 0.0
+
+    def __len__(self):
+        return len(self.retries) + self.size
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def __iter__(self):
+        """
+        Iterate over the queued batches, retries first, then by priority.
+        The order within a priority is not the dispatch order.
+        """
+        for batch in self.retries:
+            yield batch
+
+        for priority in sorted(self.levels, reverse=True):
+            for deadline, sequence, entry in self.levels[priority].heap:
+                yield entry.batch
+
+    def push(self, batch, priority=0, deadline=None):
+        """
+        Queue a new batch.
+        """
+        entry = QueueEntry(batch, priority, deadline, self.sequence, monotonic())
+        self.sequence += 1
+        self.size += 1
+
+        self.entries[batch[0].get_task_id()] = entry
+
+        if priority not in self.levels:
+            self.levels[priority] = PriorityLevel()
+
+        self.levels[priority].push(entry)
+        self.next_level = None
+
+    def push_front(self, batches):
+        """
+        Queue batches again ahead of every other batch, in their order.
+        """
+        self.retries.extendleft(reversed(batches))
+        self.next_level = None
+
+    def peek(self):
+        """
+        Return the batch to dispatch next, or None if the queue is empty.
+        """
+        if self.retries:
+            return self.retries[0]
+
+        self.next_level = self.choose_level()
+        if self.next_level == None:
+            return None
+
+        return self.levels[self.next_level].peek().batch
+
+    def pop(self):
+        """
+        Remove and return the batch to dispatch next.
+        """
+        if self.retries:
+            return self.retries.popleft()
+
+        if self.next_level == None:
+            self.next_level = self.choose_level()
+
+        level = self.levels[self.next_level]
+        entry = level.pop()
+        self.size -= 1
+
+        if level.size == 0:
+            del self.levels[self.next_level]
+
+        self.next_level = None
+
+        return entry.batch
+
+    def choose_level(self):
+        """
+        Return the priority to dispatch from next: the one with the highest
+        priority after aging, or None if no batches are queued.
+        """
+        if not self.levels:
+            return None
+
+        if self.priority_aging == None or len(self.levels) == 1:
+            return max(self.levels)
+
+        now = monotonic()
+
+        return max(self.levels, key=lambda priority: (priority + (now - self.levels[priority].get_oldest_enqueue_time()) / self.priority_aging, priority))
+
+    def get_info(self, batch_id):
+        """
+        Return the priority and deadline of a pending batch, or 0, None if
+        it is not known.
+        """
+        entry = self.entries.get(batch_id, None)
+        if entry == None:
+            return 0, None
+
+        return entry.priority, entry.deadline
+
+    def get_enqueue_time(self, batch_id):
+        """
+        Return when a pending batch was first queued (by monotonic()), or
+        None if it is not known.
+        """
+        entry = self.entries.get(batch_id, None)
+        if entry == None:
+            return None
+
+        return entry.enqueue_time
+
+    def finish(self, batch_id, completed=True):
+        """
+        Forget a batch that completed, or that was abandoned, and count
+        whether it met its deadline.
+        """
+        entry = self.entries.pop(batch_id, None)
+        if entry == None or entry.deadline == None:
+            return
+
+        lateness = time() - entry.deadline
+
+        if completed and lateness <= 0:
+            self.deadlines_met += 1
+        else:
+            self.deadlines_missed += 1
+            self.total_lateness += max(0.0, lateness)
+
+    def get_stats(self):
+        """
+        Return the queue length and the deadline counters.
+        """
+        return {
+            "queued_batches" : len(self),
+            "deadlines_met" : self.deadlines_met,
+            "deadlines_missed" : self.deadlines_missed,
+            "total_lateness" : self.total_lateness,
+        }
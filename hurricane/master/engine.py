@@ -0,0 +1,1146 @@
+import socket
+import struct
+import pickle
+import asyncio
+import threading
+import errno
+import logging
+from time import monotonic
+from collections import OrderedDict
+from hurricane.utils import *
+from hurricane.messages import MessageTypes
+from hurricane.messages import TaskManagementMessage
+from hurricane.messages import HeartbeatMessage
+from hurricane.messages import TaskBatchMessage
+from hurricane.master.store import CompletedTaskStore
+from hurricane.master.scheduler import create_scheduler
+from hurricane.master.detector import PhiAccrualDetector
+from hurricane.master.speculation import Speculator
+from hurricane.master.journal import TaskJournal
+from hurricane.master.dispatch import DispatchQueue
+from hurricane.master.metrics import MasterMetrics
+from hurricane.master.metrics import format_prometheus
+from hurricane.utils.compression import COMPRESSION_THRESHOLD
+from hurricane.utils.compression import CompressionStats
+from hurricane.utils.compression import get_codec
+from hurricane.utils.compression import get_codec_names
+from hurricane.utils.sharedMemory import HAS_SHARED_MEMORY
+from hurricane.utils.sharedMemory import SHARED_MEMORY_SIZE
+from hurricane.utils.sharedMemory import SharedMemoryRing
+from hurricane.utils.discovery import BEACON_ADDRESSES
+from hurricane.utils.discovery import BEACON_INTERVAL
+from hurricane.utils.discovery import create_beacon_socket
+from hurricane.utils.discovery import send_beacon
+
+# Backlog of the sockets the master node listens on
+MAX_CONNECTIONS = 128
+
+class MasterEngine:
+    """
+    Event-driven core of the master node. Accepting slaves, dispatching
+    tasks, sending heartbeats and receiving task completions all run as
+    coroutines on a single asyncio event loop (in a background thread), so
+    they wake on socket readiness instead of on polling timers.
+
+    Every slave sends its completions to one listener on
+    task_completion_port, over a connection it keeps open. Each message
+    carries the id the master gave the node when it was identified, so the
+    number of sockets and coroutines on the master only grows by one
+    connection per node. Slaves also send small UDP heartbeats with their
+    load to the same port, which feed a phi accrual failure detector.
+
+    State owned by the event loop (nodes, the send queue) is only touched
+    from the loop thread. State shared with the blocking MasterNode API
+    (completed tasks, pending task ids, connection status) is guarded by
+    self.condition, which is notified whenever it changes.
+    """
+
+    def __init__(self, **kwargs):
+        self.initialize_port = kwargs.get('initialize_port', 12222)
+        self.max_disconnect_errors = kwargs.get('max_disconnect_errors', 3)
+        self.max_task_retries = kwargs.get('max_task_retries', 3)
+        self.task_retry_backoff = kwargs.get('task_retry_backoff', 0.5)
+        self.compression = get_codec_names(kwargs.get('compression', None))
+        self.compression_threshold = kwargs.get('compression_threshold', COMPRESSION_THRESHOLD)
+        self.shared_memory = kwargs.get('shared_memory', True) and HAS_SHARED_MEMORY
+        self.shared_memory_size = kwargs.get('shared_memory_size', SHARED_MEMORY_SIZE)
+
+        self.max_connections = kwargs.get('max_connections', MAX_CONNECTIONS)
+        self.connect_timeout = 10
+        self.registration_timeout = kwargs.get('registration_timeout', 10)
+        self.retry_delay = 0.5
+        self.failure_check_interval = 0.1
+        self.speculation_interval = 0.1
+        self.task_completion_port = self.initialize_port + 2
+
+        self.nodes = {}
+        self.send_tasks_queue = DispatchQueue(**kwargs)
+        self.connection_pool = ConnectionPool()
+        self.listen_sockets = []
+        self.background_tasks = set()
+        self.compression_stats = CompressionStats()
+        self.node_ids = {}
+        self.node_addresses = {}
+        self.shared_memory_rings = {}
+        self.completion_rings = {}
+        self.scheduler = create_scheduler(kwargs.get('scheduler', 'least_loaded'))
+        self.detector = PhiAccrualDetector(**kwargs)
+        self.speculation = kwargs.get('speculation', False)
+        self.speculator = Speculator(**kwargs)
+        self.batch_retries = {}
+        self.waiting_batches = {}
+        self.requeued_tasks = 0
+        self.abandoned_tasks = 0
+        self.beacon_interval = kwargs.get('beacon_interval', BEACON_INTERVAL)
+        self.beacon_addresses = kwargs.get('beacon_addresses', BEACON_ADDRESSES)
+        self.metrics = MasterMetrics()
+        self.metrics_port = kwargs.get('metrics_port', None)
+        self.metrics_address = kwargs.get('metrics_address', "127.0.0.1")
+        self.trace = kwargs.get('trace', None)
+
+        self.condition = threading.Condition()
+        self.completed_tasks = CompletedTaskStore(**kwargs)
+        self.current_tasks = set()
+        self.futures = {}
+        self.has_connection_tf = False
+
+        self.exit_signal = threading.Event()
+        self.exit_event = None
+        self.dispatch_event = None
+        self.loop = None
+        self.thread = None
+
+        self.journal = None
+        self.journal_flush_scheduled = False
+        if kwargs.get('journal', None) != None:
+            self.journal = TaskJournal(kwargs['journal'], **kwargs)
+            self.restore_journal(self.journal.open())
+
+    def start(self):
+        """
+        Start the event loop in a background thread.
+        """
+        self.loop = asyncio.new_event_loop()
+
+        self.thread = threading.Thread(target=self.run_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop the event loop and wake up anything waiting on the engine. When
+        called from another thread, wait for the engine to close its sockets
+        and shared memory.
+        """
+        self.exit_signal.set()
+
+        if self.loop != None and not self.loop.is_closed():
+            try:
+                self.loop.call_soon_threadsafe(self.shutdown)
+            except RuntimeError:
+                pass
+
+        with self.condition:
+            futures = list(self.futures.values())
+            self.futures = {}
+
+            self.condition.notify_all()
+
+        for future in futures:
+            future.cancel()
+
+        if self.thread != None and self.thread is not threading.current_thread():
+            self.thread.join(self.connect_timeout)
+
+    def shutdown(self):
+        """
+        Ask the running engine to exit (called on the loop thread).
+        """
+        if self.exit_event != None:
+            self.exit_event.set()
+
+    def run_loop(self):
+        """
+        Body of the engine thread.
+        """
+        asyncio.set_event_loop(self.loop)
+
+        try:
+            self.loop.run_until_complete(self.run())
+        finally:
+            self.loop.close()
+
+    async def run(self):
+        """
+        Run the engine's coroutines until the engine is stopped.
+        """
+        self.exit_event = asyncio.Event()
+        self.dispatch_event = asyncio.Event()
+
+        if self.exit_signal.is_set():
+            return
+
+        workers = [self.spawn(self.identify_slaves()), self.spawn(self.receive_node_messages()), self.spawn(self.monitor_nodes()), self.spawn(self.node_manager()), self.spawn(self.heartbeat())]
+        if self.beacon_interval != None:
+            workers.append(self.spawn(self.beacon()))
+        if self.speculation:
+            workers.append(self.spawn(self.speculate()))
+        if self.metrics_port != None:
+            workers.append(self.spawn(self.serve_metrics()))
+        if self.send_tasks_queue:
+            self.dispatch_event.set()
+
+        await self.exit_event.wait()
+
+        for task in list(self.background_tasks):
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+        self.connection_pool.close_all()
+        for listen_socket in self.listen_sockets:
+            listen_socket.close()
+
+        for node_id in list(self.shared_memory_rings):
+            self.close_shared_memory(node_id)
+
+        if self.journal != None:
+            self.journal.close()
+
+    def spawn(self, coroutine):
+        """
+        Run a coroutine in the background; it is cancelled when the engine
+        stops.
+        """
+        task = self.loop.create_task(coroutine)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+
+        return task
+
+    def create_listen_socket(self, port):
+        """
+        Create a non-blocking socket listening on port.
+        """
+        listen_socket = create_listen_socket(port, self.max_connections)
+        listen_socket.setblocking(False)
+        self.listen_sockets.append(listen_socket)
+
+        return listen_socket
+
+    def submit(self, batches, futures=None, speculative=True, priority=0, deadline=None):
+        """
+        Queue batches of tasks for dispatch. Each batch is a list of tasks
+        that is sent to a node in one frame and occupies one of its slots.
+        futures optionally maps task ids to TaskFutures; those tasks are
+        delivered through their future instead of the completed task store.
+        Unless speculative is set, the batches are never run twice by
+        speculative execution. Batches with a higher priority are sent
+        first, and within a priority the one with the earliest deadline (a
+        time.time() timestamp). Safe to call from any thread.
+        """
+        with self.condition:
+            for batch in batches:
+                self.current_tasks.update(task.get_task_id() for task in batch)
+
+            if futures:
+                self.futures.update(futures)
+
+        if self.loop == None:
+            self.enqueue_batches(batches, speculative, priority, deadline)
+        else:
+            self.loop.call_soon_threadsafe(self.enqueue_batches, batches, speculative, priority, deadline)
+
+    def enqueue_batches(self, batches, speculative=True, priority=0, deadline=None):
+        """
+        Add batches of tasks to the send queue and wake the dispatcher.
+        """
+        if not speculative:
+            for batch in batches:
+                self.speculator.disallow(get_batch_id(batch))
+
+        if self.journal != None:
+            self.journal.submit(batches, speculative, priority, deadline)
+            self.schedule_journal_flush()
+
+        for batch in batches:
+            self.send_tasks_queue.push(batch, priority, deadline)
+            self.metrics.tasks_submitted += len(batch)
+
+        if self.dispatch_event != None:
+            self.dispatch_event.set()
+
+    async def node_manager(self):
+        """
+        Dispatch queued batches to nodes with free slots whenever a batch is
+        queued or a slot frees up. Batches are taken from the queue in
+        priority order, and the scheduler picks the node each is sent to.
+        """
+        while True:
+            await self.dispatch_event.wait()
+            self.dispatch_event.clear()
+
+            while self.send_tasks_queue:
+                batch = self.send_tasks_queue.peek()
+                node = self.scheduler.choose_node(self.nodes, batch, len(self.send_tasks_queue))
+                if node == None or self.get_free_slots(node) <= 0:
+                    break
+
+                self.send_tasks_queue.pop()
+
+                enqueue_time = self.send_tasks_queue.get_enqueue_time(get_batch_id(batch))
+                if enqueue_time != None:
+                    self.metrics.latencies["queue"].record(monotonic() - enqueue_time)
+
+                self.dispatch(node, batch)
+
+    def dispatch(self, node, batch):
+        """
+        Take up one of a node's slots with a batch and send it.
+        """
+        self.nodes[node]["batches"][get_batch_id(batch)] = batch
+        self.nodes[node]["dispatch_times"][get_batch_id(batch)] = monotonic()
+        self.metrics.tasks_dispatched += len(batch)
+
+        if self.journal != None:
+            self.journal.dispatch(get_batch_id(batch))
+            self.schedule_journal_flush()
+
+        self.spawn(self.send_batch(node, batch))
+
+    async def speculate(self):
+        """
+        Once every queued batch has been dispatched, send a copy of each
+        batch that is taking well past the usual time for its size to a
+        node with a free slot. Whichever copy completes first is kept.
+        """
+        while True:
+            await asyncio.sleep(self.speculation_interval)
+
+            if self.send_tasks_queue:
+                continue
+
+            threshold = self.speculator.get_latency_threshold()
+            if threshold == None:
+                continue
+
+            now = monotonic()
+            for node in list(self.nodes):
+                for batch_id, batch in list(self.nodes[node]["batches"].items()):
+                    if not self.speculator.is_straggler(batch_id, len(batch), now - self.nodes[node]["dispatch_times"][batch_id], threshold):
+                        continue
+
+                    candidates = {other_node : node_info for other_node, node_info in self.nodes.items() if other_node != node}
+                    copy_node = self.scheduler.choose_node(candidates, batch, 1)
+                    if copy_node == None or self.get_free_slots(copy_node) <= 0:
+                        continue
+
+                    logging.info("Batch starting with task " + str(batch_id) + " is straggling on " + node + "...sending a copy to " + copy_node)
+
+                    self.speculator.speculate(batch_id, node, copy_node)
+                    self.dispatch(copy_node, batch)
+
+    def get_free_slots(self, node):
+        """
+        Return how many more batches a node can be given right now.
+        """
+        return self.nodes[node]["slots"] - len(self.nodes[node]["batches"])
+
+    def get_slot_count(self):
+        """
+        Return the total number of slots of the connected nodes.
+        """
+        return sum(node_info.get("slots", 0) for node_info in list(self.nodes.values()))
+
+    async def send_batch(self, node, batch):
+        """
+        Send a batch of tasks to a node in a single frame. If it can not be
+        delivered the batch goes back to the front of the queue.
+        """
+        start_time = monotonic()
+        task_ring = None
+
+        try:
+            if len(batch) == 1:
+                logging.info("Sending task " + str(batch[0].get_task_id()) + " to " + node)
+
+                message, task_ring = await self.encode_message(node, batch[0])
+            else:
+                logging.info("Sending a batch of " + str(len(batch)) + " tasks to " + node)
+
+                message, task_ring = await self.encode_message(node, TaskBatchMessage(batch))
+
+            await self.connection_pool.send_message(node, message)
+            self.metrics.latencies["transfer"].record(monotonic() - start_time)
+
+            if task_ring != None:
+                self.metrics.shared_memory_bytes_sent += get_shared_memory_frame_size(message)
+
+            if node in self.nodes:
+                self.nodes[node]["num_disconnects"] = 0
+        except socket.error as err:
+            self.handle_send_error(node, err, "send a task to")
+
+            # The node will never read the record the message points to, if
+            # it was written to the node's shared memory ring
+            if task_ring != None and self.nodes.get(node, {}).get("task_ring", None) is task_ring:
+                release_shared_memory_frame(message, task_ring)
+
+            # Free the slot before the batch can be dispatched again, so that
+            # neither a new dispatch to this node nor its removal sees it
+            # as still in flight here
+            if node in self.nodes and self.nodes[node]["batches"].get(get_batch_id(batch), None) is batch:
+                del self.nodes[node]["batches"][get_batch_id(batch)]
+                del self.nodes[node]["dispatch_times"][get_batch_id(batch)]
+
+            # A speculative copy that can not be sent is dropped, as long as
+            # another copy of the batch is still running
+            if not self.speculator.lose(get_batch_id(batch), node):
+                self.send_tasks_queue.push_front([batch])
+
+            self.manage_node_status(node)
+
+            await asyncio.sleep(self.retry_delay)
+            self.dispatch_event.set()
+
+    async def encode_message(self, node, data):
+        """
+        Encode data for a node, compressing it with the codec the node chose
+        if it is large enough. Compression runs in the loop's executor so
+        that it does not hold up dispatching. For a node on the same host,
+        the message is passed through shared memory when there is room.
+
+        @returns the encoded message, and the shared memory ring it was
+        written to or None
+        """
+        message = encode_data(data)
+        codec = self.nodes.get(node, {}).get("codec", None)
+
+        if codec != None and get_message_size(message) >= self.compression_threshold:
+            message = await self.loop.run_in_executor(None, compress_message, message, codec, self.compression_threshold, self.compression_stats)
+
+        task_ring = self.nodes.get(node, {}).get("task_ring", None)
+        if task_ring != None:
+            descriptor_message = write_shared_memory_frame(message, task_ring, self.nodes[node]["node_id"])
+
+            if descriptor_message != None:
+                return descriptor_message, task_ring
+
+        return message, None
+
+    async def beacon(self):
+        """
+        Announce the master node to slave nodes looking for it, by sending a
+        UDP beacon to the initialize port every beacon_interval seconds.
+        """
+        beacon_socket = create_beacon_socket()
+
+        try:
+            while True:
+                send_beacon(beacon_socket, self.initialize_port, self.beacon_addresses)
+
+                await asyncio.sleep(self.beacon_interval)
+        finally:
+            beacon_socket.close()
+
+    async def heartbeat(self):
+        """
+        Periodically send a heartbeat to every node. Busy nodes are included,
+        since a node with all of its slots full is still waiting on the
+        stream and would otherwise think the master has gone away.
+        """
+        while True:
+            await asyncio.sleep(self.connect_timeout)
+
+            await asyncio.gather(*[self.send_heartbeat(node) for node in list(self.nodes)])
+
+    async def send_heartbeat(self, node):
+        """
+        Send a heartbeat to a node, dropping the node if it has stopped
+        responding.
+        """
+        try:
+            await self.connection_pool.send(node, HeartbeatMessage())
+
+            if node in self.nodes:
+                self.nodes[node]["num_disconnects"] = 0
+        except socket.error as err:
+            self.handle_send_error(node, err, "send a heartbeat to")
+
+            self.manage_node_status(node)
+
+    async def monitor_nodes(self):
+        """
+        Receive the heartbeats slave nodes send over UDP, and drop every node
+        that the failure detector suspects has failed. Nodes that have never
+        sent a heartbeat are only dropped after failed sends.
+        """
+        heartbeat_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        heartbeat_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        heartbeat_socket.bind(('', self.task_completion_port))
+        heartbeat_socket.setblocking(False)
+
+        self.loop.add_reader(heartbeat_socket, self.read_heartbeats, heartbeat_socket)
+
+        try:
+            while True:
+                await asyncio.sleep(self.failure_check_interval)
+
+                now = monotonic()
+                for node in list(self.nodes):
+                    if self.detector.is_monitored(node) and not self.detector.is_available(node, now):
+                        logging.info("Node " + node + " missed its heartbeats (phi " + str(round(self.detector.phi(node, now), 1)) + ")...disconnecting from slave node")
+
+                        self.remove_node(node)
+        finally:
+            self.loop.remove_reader(heartbeat_socket)
+            heartbeat_socket.close()
+
+    def read_heartbeats(self, heartbeat_socket):
+        """
+        Handle every heartbeat waiting on the heartbeat socket.
+        """
+        while True:
+            try:
+                datagram, addr = heartbeat_socket.recvfrom(1024)
+                receive_time = monotonic()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as err:
+                logging.error("Unable to receive a heartbeat: " + str(err))
+
+                return
+
+            try:
+                data = decode_datagram(datagram)
+            except (ValueError, struct.error) as err:
+                logging.error("Ignoring an invalid heartbeat from " + str(addr[0]) + ": " + str(err))
+
+                continue
+
+            self.metrics.bytes_received += len(datagram)
+
+            if isinstance(data, HeartbeatMessage) and self.receive_heartbeat(data, receive_time) and data.get_sent_time() != None:
+                self.answer_heartbeat(heartbeat_socket, data, receive_time, addr)
+
+    def receive_heartbeat(self, heartbeat, receive_time):
+        """
+        Record a heartbeat from a node, along with the load it reports.
+
+        @returns whether the heartbeat came from a known node
+        """
+        node = self.node_ids.get(heartbeat.get_node_id(), None)
+        if node == None:
+            return False
+
+        self.detector.heartbeat(node, receive_time, heartbeat.get_interval())
+        self.nodes[node]["load"] = heartbeat.get_tasks()
+
+        return True
+
+    def answer_heartbeat(self, heartbeat_socket, heartbeat, receive_time, addr):
+        """
+        Answer a heartbeat with the times it was received and answered, so
+        that the node can work out the offset between its clock and the
+        master node's.
+        """
+        try:
+            heartbeat_socket.sendto(encode_datagram(HeartbeatMessage(sent_time=monotonic(), echo_time=heartbeat.get_sent_time(), receive_time=receive_time)), addr)
+        except OSError:
+            pass
+
+    def handle_send_error(self, node, err, action):
+        """
+        Log a failed send and count it against the node.
+        """
+        if node not in self.nodes:
+            return
+
+        if err.errno == errno.ECONNREFUSED or (err.args and err.args[0] == "timed out"):
+            logging.error("Connection refused when attempting to " + action + " " + node + ", try number " + str(self.nodes[node]["num_disconnects"] + 1))
+
+            self.nodes[node]["num_disconnects"] += 1
+        elif err.errno == errno.EPIPE:
+            logging.error("Client connection from " + node + " disconnected early")
+        else:
+            logging.error("Unknown error \"" + str(err) + "\" thrown when attempting to " + action + " " + node)
+
+    async def identify_slaves(self):
+        """
+        Accept new slave nodes, give each of them a node id, and tell them
+        where to send task completions.
+        """
+        initialize_socket = self.create_listen_socket(self.initialize_port)
+
+        while True:
+            connection, addr = await self.loop.sock_accept(initialize_socket)
+
+            try:
+                node_id = generate_task_id()
+                self.node_addresses[node_id] = str(addr[0])
+
+                logging.info("Identified new node " + str(node_id) + " at " + str(addr[0]))
+
+                shared_memory = []
+                if self.shared_memory and is_same_host(connection):
+                    shared_memory = self.create_shared_memory(node_id)
+
+                await send_data_async(self.loop, connection, TaskManagementMessage(node_id=node_id, task_completion_port=self.task_completion_port, compression=self.compression, shared_memory=shared_memory))
+
+                # A slave probing several of this host's addresses at once
+                # may connect more than once, and only registers one of the
+                # node ids it is given
+                self.loop.call_later(self.registration_timeout, self.forget_unregistered_node, node_id)
+            except socket.error as err:
+                logging.error("Unable to initialize the node at " + str(addr[0]) + ": " + str(err))
+
+                self.node_addresses.pop(node_id, None)
+                self.close_shared_memory(node_id)
+            finally:
+                connection.close()
+
+    def forget_unregistered_node(self, node_id):
+        """
+        Free the node id and shared memory handed out on an initialize
+        connection, if no node registered with them in time.
+        """
+        if self.node_addresses.pop(node_id, None) == None:
+            return
+
+        logging.info("Node " + str(node_id) + " did not register in time, forgetting it")
+
+        self.close_shared_memory(node_id)
+
+    def create_shared_memory(self, node_id):
+        """
+        Create the shared memory rings for tasks to and completions from a
+        node on the same host.
+
+        @returns the names of the rings, or an empty list if they could not
+        be created
+        """
+        try:
+            rings = [SharedMemoryRing(size=self.shared_memory_size), SharedMemoryRing(size=self.shared_memory_size)]
+        except OSError as err:
+            logging.error("Unable to create shared memory for node " + str(node_id) + ": " + str(err))
+
+            return []
+
+        self.shared_memory_rings[node_id] = rings
+        self.completion_rings[node_id] = rings[1]
+
+        return [ring.get_name() for ring in rings]
+
+    def close_shared_memory(self, node_id):
+        """
+        Remove the shared memory rings of a node.
+        """
+        self.completion_rings.pop(node_id, None)
+
+        for ring in self.shared_memory_rings.pop(node_id, []):
+            ring.close()
+
+    async def receive_node_messages(self):
+        """
+        Accept the connections every node sends its completions and other
+        messages on.
+        """
+        data_socket = self.create_listen_socket(self.task_completion_port)
+
+        while True:
+            connection, addr = await self.loop.sock_accept(data_socket)
+
+            self.spawn(self.read_node_messages(connection))
+
+    async def read_node_messages(self, connection):
+        """
+        Handle every message a node sends on one connection. The node is
+        identified by the node id in each message.
+        """
+        node_id = None
+
+        try:
+            while True:
+                data, frame_size, shared_memory_size = await read_frame_async(self.loop, connection, self.compression_stats, self.completion_rings)
+                node_id = data.get_node_id()
+                self.metrics.bytes_received += frame_size
+                self.metrics.shared_memory_bytes_received += shared_memory_size
+
+                # Results are sized by the frame they arrived in, wherever
+                # it was passed
+                frame_size = shared_memory_size or frame_size
+
+                if data.get_message() in [MessageTypes.TASK, MessageTypes.TASK_BATCH]:
+                    completed_tasks = [data.get_task()] if data.get_message() == MessageTypes.TASK else data.get_tasks()
+
+                    # Large results are written out before they are stored,
+                    # without holding up the loop or the condition
+                    if self.completed_tasks.spill_threshold != None:
+                        await self.loop.run_in_executor(None, self.completed_tasks.spill_results, completed_tasks, frame_size // len(completed_tasks))
+
+                    self.complete_batch(self.node_ids.get(node_id, None), completed_tasks, frame_size)
+                elif data.get_message() == MessageTypes.INITIALIZE_NODE:
+                    self.add_node(node_id, data.get_task_port(), data.get_cpu_count(), data.get_slots(), data.get_compression(), data.get_shared_memory())
+        except socket.error:
+            pass
+        except (ValueError, EOFError, struct.error, pickle.UnpicklingError) as err:
+            logging.error("Unable to read a message from node " + str(node_id) + ", dropping the connection: " + str(err))
+        finally:
+            connection.close()
+
+    def add_node(self, node_id, task_port, cpu_count, slots, compression=None, shared_memory=False):
+        """
+        Register a node once it has told the master it is ready for tasks,
+        and on which port it receives them. A registered node may send its
+        settings again, for example to change its number of slots.
+        """
+        if node_id in self.node_ids and node_id not in self.node_addresses:
+            node = self.node_ids[node_id]
+        elif node_id not in self.node_addresses or task_port == None:
+            logging.error("Node " + str(node_id) + " was not identified by this master node")
+
+            return
+        else:
+            node = self.node_addresses.pop(node_id) + ":" + str(task_port)
+
+        if node not in self.nodes:
+            self.nodes[node] = {"num_disconnects" : 0, "batches" : {}, "dispatch_times" : {}, "load" : 0}
+        elif self.nodes[node]["node_id"] != node_id:
+            # The node has identified itself again; forget its old id
+            self.metrics.rejoined_nodes += 1
+            self.node_ids.pop(self.nodes[node]["node_id"], None)
+            self.close_shared_memory(self.nodes[node]["node_id"])
+            self.detector.remove(node)
+
+        self.node_ids[node_id] = node
+        self.nodes[node]["node_id"] = node_id
+        self.nodes[node]["cpu_count"] = cpu_count
+        self.nodes[node]["slots"] = max(1, slots)
+        self.nodes[node]["codec"] = None
+
+        logging.info("Got CPU count from node " + node + ": " + str(cpu_count) + " (" + str(self.nodes[node]["slots"]) + " slots)")
+
+        if compression != None:
+            try:
+                self.nodes[node]["codec"] = get_codec(compression)
+
+                logging.info("Compressing large messages to node " + node + " with " + compression)
+            except ValueError:
+                logging.error("Node " + node + " chose an unknown compression codec " + str(compression))
+
+        if shared_memory and node_id in self.shared_memory_rings:
+            logging.info("Sending tasks to node " + node + " through shared memory")
+
+            self.nodes[node]["task_ring"] = self.shared_memory_rings[node_id][0]
+        else:
+            self.nodes[node]["task_ring"] = None
+            self.close_shared_memory(node_id)
+
+        self.scheduler.add_node(node, self.nodes[node])
+
+        self.set_has_connection(True)
+        self.dispatch_event.set()
+
+    def complete_batch(self, node, completed_tasks, frame_size=0):
+        """
+        Record the completion of a batch of tasks by node and free the slot
+        that ran it. Slaves send back a batch's completions together, in the
+        order the batch was sent. frame_size is split evenly between the
+        tasks to account for the memory their results take up.
+        """
+        batch_id = get_batch_id(completed_tasks)
+        completed_time = monotonic()
+        dispatch_time = None
+
+        if len(completed_tasks) == 1:
+            logging.info("Received task completion for task " + str(batch_id))
+        else:
+            logging.info("Received task completions for a batch of " + str(len(completed_tasks)) + " tasks")
+
+        if node in self.nodes and self.nodes[node]["batches"].pop(batch_id, None) != None:
+            dispatch_time = self.nodes[node]["dispatch_times"].pop(batch_id)
+            service_time = completed_time - dispatch_time
+
+            self.scheduler.batch_completed(node, len(completed_tasks), service_time)
+            self.speculator.record_latency(len(completed_tasks), service_time)
+            self.metrics.latencies["service"].record(service_time)
+
+        self.batch_retries.pop(batch_id, None)
+
+        copy_nodes = self.speculator.get_nodes(batch_id) - {node}
+
+        if not self.speculator.complete(batch_id, node):
+            logging.info("Discarding duplicate completions of the batch starting with task " + str(batch_id) + " from " + str(node))
+
+            self.dispatch_event.set()
+
+            return
+
+        # The other copies of a speculated batch are left to run, but they
+        # no longer take up a slot
+        for copy_node in copy_nodes:
+            if copy_node in self.nodes and self.nodes[copy_node]["batches"].pop(batch_id, None) != None:
+                del self.nodes[copy_node]["dispatch_times"][batch_id]
+
+        enqueue_time = self.send_tasks_queue.get_enqueue_time(batch_id)
+        if enqueue_time != None:
+            self.metrics.latencies["round_trip"].record(completed_time - enqueue_time)
+
+        self.send_tasks_queue.finish(batch_id)
+
+        for completed_task in completed_tasks:
+            if enqueue_time != None:
+                completed_task.record_timing("submitted", enqueue_time)
+            if dispatch_time != None:
+                completed_task.record_timing("dispatched", dispatch_time)
+            completed_task.record_timing("completed", completed_time)
+
+            self.metrics.record_timings(completed_task.get_timings())
+
+        resolved_futures = []
+        stored_tasks = []
+        delivered_tasks = []
+
+        with self.condition:
+            for completed_task in completed_tasks:
+                task_id = completed_task.get_task_id()
+
+                # A batch lost with a node may complete twice if the node
+                # comes back after the batch was requeued
+                if task_id not in self.current_tasks:
+                    continue
+
+                self.current_tasks.discard(task_id)
+                delivered_tasks.append(completed_task)
+
+                future = self.futures.pop(task_id, None)
+                if future != None:
+                    resolved_futures.append((future, completed_task))
+                else:
+                    stored_tasks.append((completed_task, frame_size // len(completed_tasks)))
+                    self.completed_tasks.add(completed_task, frame_size // len(completed_tasks))
+
+            self.condition.notify_all()
+
+        self.metrics.tasks_completed += len(delivered_tasks)
+
+        if self.journal != None:
+            self.journal.complete(batch_id, stored_tasks)
+            self.schedule_journal_flush()
+
+        self.resolve_futures(resolved_futures)
+        self.trace_tasks(delivered_tasks)
+        self.dispatch_event.set()
+
+    def trace_tasks(self, completed_tasks):
+        """
+        Pass every completed task, with its timings, to the trace hook.
+        """
+        if self.trace == None:
+            return
+
+        for completed_task in completed_tasks:
+            try:
+                self.trace(completed_task)
+            except Exception as err:
+                logging.error("The trace hook raised \"" + str(err) + "\" for task " + str(completed_task.get_task_id()))
+
+    def resolve_futures(self, resolved_futures):
+        """
+        Set the results of (future, result) pairs. This is done outside of
+        self.condition, since future callbacks run here.
+        """
+        for future, result in resolved_futures:
+            if future.set_running_or_notify_cancel():
+                future.set_result(result)
+
+    def manage_node_status(self, node):
+        """
+        If a node has disconnected too many times, remove it from the known
+        nodes. Its in-flight tasks are requeued.
+        """
+        if node not in self.nodes or self.nodes[node]["num_disconnects"] < self.max_disconnect_errors:
+            return
+
+        logging.info("Connection with " + node + " has timed out...disconnecting from slave node")
+
+        self.remove_node(node)
+
+    def remove_node(self, node):
+        """
+        Remove a node from the known nodes. Its in-flight batches are put
+        back at the front of the queue, unless a speculative copy of them is
+        still running on another node. Each batch is retried up to
+        max_task_retries times, waiting task_retry_backoff seconds before
+        the first retry and twice as long before each following one; after
+        that its tasks are abandoned.
+        """
+        node_info = self.nodes.pop(node)
+        self.node_ids.pop(node_info["node_id"], None)
+        self.connection_pool.close(node)
+        self.close_shared_memory(node_info["node_id"])
+        self.scheduler.remove_node(node)
+        self.detector.remove(node)
+
+        retries = {}
+        abandoned_batches = []
+
+        for batch_id, batch in node_info["batches"].items():
+            if self.speculator.lose(batch_id, node):
+                continue
+
+            retry = self.batch_retries.get(batch_id, 0) + 1
+
+            if retry > self.max_task_retries:
+                logging.error("Batch starting with task " + str(batch_id) + " was lost on " + node + " after " + str(self.max_task_retries) + " retries...abandoning it")
+
+                self.batch_retries.pop(batch_id, None)
+                self.speculator.forget(batch_id)
+                abandoned_batches.append(batch)
+
+                continue
+
+            self.batch_retries[batch_id] = retry
+            self.waiting_batches[batch_id] = batch
+            delay = self.task_retry_backoff * 2 ** (retry - 1)
+            retries.setdefault(delay, []).append(batch)
+
+        for delay, batches in retries.items():
+            logging.info("Requeueing " + str(sum(len(batch) for batch in batches)) + " tasks from " + node + " in " + str(delay) + " seconds")
+
+            self.loop.call_later(delay, self.requeue_batches, batches)
+
+        self.abandon_batches(abandoned_batches)
+
+        if self.nodes == {}:
+            self.set_has_connection(False)
+
+    def requeue_batches(self, batches):
+        """
+        Put batches that were lost with a node back at the front of the
+        queue, in their original order.
+        """
+        self.requeued_tasks += sum(len(batch) for batch in batches)
+
+        for batch in batches:
+            self.waiting_batches.pop(get_batch_id(batch), None)
+
+        self.send_tasks_queue.push_front(batches)
+        self.dispatch_event.set()
+
+    def abandon_batches(self, batches):
+        """
+        Give up on batches of tasks. Anything waiting for them is woken up,
+        and their futures resolve to None.
+        """
+        abandoned_futures = []
+
+        if self.journal != None and batches != []:
+            self.journal.abandon([get_batch_id(batch) for batch in batches])
+            self.schedule_journal_flush()
+
+        for batch in batches:
+            self.send_tasks_queue.finish(get_batch_id(batch), completed=False)
+
+        with self.condition:
+            for batch in batches:
+                self.abandoned_tasks += len(batch)
+
+                for task in batch:
+                    self.current_tasks.discard(task.get_task_id())
+
+                    future = self.futures.pop(task.get_task_id(), None)
+                    if future != None:
+                        abandoned_futures.append((future, None))
+
+            self.condition.notify_all()
+
+        self.resolve_futures(abandoned_futures)
+
+    def restore_journal(self, state):
+        """
+        Resume the work recorded in the journal: batches that were in flight
+        are queued first, then the batches that were still queued, and
+        completed tasks that had not been compacted away are stored again.
+        """
+        batches = state.get_pending_batches()
+
+        self.current_tasks.update(task.get_task_id() for batch in batches for task in batch)
+
+        for batch_id in state.non_speculative:
+            self.speculator.disallow(batch_id)
+
+        for task, size in state.get_completed_tasks():
+            self.completed_tasks.spill_results([task], size)
+            self.completed_tasks.add(task, size)
+
+        self.completed_tasks.remove_stray_spill_files()
+
+        for batch in batches:
+            priority, deadline = state.priorities.get(get_batch_id(batch), (0, None))
+            self.send_tasks_queue.push(batch, priority, deadline)
+
+        if batches != [] or len(self.completed_tasks) > 0:
+            logging.info("Resumed " + str(len(self.current_tasks)) + " tasks (" + str(len(state.dispatched)) + " batches were in flight) and " + str(len(self.completed_tasks)) + " completed tasks from the journal")
+
+    def schedule_journal_flush(self):
+        """
+        Flush the journal once the event loop is done with the records being
+        written now, or right away if the engine is not running.
+        """
+        if self.loop == None or not self.loop.is_running():
+            self.flush_journal()
+        elif not self.journal_flush_scheduled:
+            self.journal_flush_scheduled = True
+            self.loop.call_soon(self.flush_journal)
+
+    def flush_journal(self):
+        """
+        Flush the journal, and start compacting it if it has grown too long.
+        """
+        self.journal_flush_scheduled = False
+        self.journal.flush()
+
+        if self.loop != None and self.loop.is_running() and self.journal.needs_compaction(self.get_pending_batch_count()):
+            self.spawn(self.compact_journal())
+
+    def get_pending_batch_count(self):
+        """
+        Return the number of batches that have not completed yet.
+        """
+        return len(self.send_tasks_queue) + len(self.waiting_batches) + sum(len(node_info["batches"]) for node_info in self.nodes.values())
+
+    async def compact_journal(self):
+        """
+        Replace the journal with a snapshot of the pending work. The snapshot
+        is written in the loop's executor; records appended meanwhile are
+        added to it before it replaces the journal.
+        """
+        pending_batches = OrderedDict()
+        for node_info in self.nodes.values():
+            pending_batches.update(node_info["batches"])
+        pending_batches.update(self.waiting_batches)
+
+        dispatched = list(pending_batches)
+        for batch in self.send_tasks_queue:
+            pending_batches.setdefault(get_batch_id(batch), batch)
+
+        priorities = {}
+        for batch_id in pending_batches:
+            priority, deadline = self.send_tasks_queue.get_info(batch_id)
+            if priority != 0 or deadline != None:
+                priorities[batch_id] = (priority, deadline)
+
+        non_speculative = set(self.speculator.non_speculative_batches)
+        with self.condition:
+            completed_tasks = self.completed_tasks.get_tasks()
+
+        self.journal.start_compaction()
+
+        try:
+            snapshot_path = await self.loop.run_in_executor(None, self.journal.write_snapshot, list(pending_batches.values()), dispatched, non_speculative, priorities, completed_tasks)
+
+            self.journal.finish_compaction(snapshot_path)
+        except asyncio.CancelledError:
+            self.journal.abort_compaction()
+
+            raise
+        except OSError as err:
+            self.journal.abort_compaction()
+
+            logging.error("Unable to compact the journal: " + str(err))
+
+            return
+
+        logging.info("Compacted the journal to " + str(len(pending_batches)) + " pending batches and " + str(len(completed_tasks)) + " completed tasks")
+
+    async def serve_metrics(self):
+        """
+        Serve get_stats() in the Prometheus text format over HTTP on
+        metrics_port.
+        """
+        metrics_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        metrics_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        metrics_socket.bind((self.metrics_address, self.metrics_port))
+        metrics_socket.listen(self.max_connections)
+        metrics_socket.setblocking(False)
+        self.listen_sockets.append(metrics_socket)
+
+        while True:
+            connection, addr = await self.loop.sock_accept(metrics_socket)
+
+            self.spawn(self.send_metrics(connection))
+
+    async def send_metrics(self, connection):
+        """
+        Answer one HTTP request for the metrics.
+        """
+        try:
+            request = b""
+            while b"\r\n\r\n" not in request and len(request) < 8192:
+                data = await asyncio.wait_for(self.loop.sock_recv(connection, 4096), self.connect_timeout)
+                if not data:
+                    break
+
+                request += data
+
+            if request.startswith(b"GET "):
+                status = "200 OK"
+                body = format_prometheus(self.get_stats(), self.metrics.latencies).encode()
+            else:
+                status = "405 Method Not Allowed"
+                body = b""
+
+            header = "HTTP/1.0 " + status + "\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: " + str(len(body)) + "\r\nConnection: close\r\n\r\n"
+
+            await self.loop.sock_sendall(connection, header.encode() + body)
+        except (socket.error, asyncio.TimeoutError):
+            pass
+        finally:
+            connection.close()
+
+    def get_stats(self):
+        """
+        Return statistics about the engine. Safe to call from any thread.
+        """
+        with self.condition:
+            completed_task_stats = self.completed_tasks.get_stats()
+
+        nodes = {node : {"in_flight" : len(node_info["batches"]), "slots" : node_info.get("slots", 0), "load" : node_info["load"]} for node, node_info in list(self.nodes.items())}
+
+        return {
+            "completed_tasks" : completed_task_stats,
+            "compression" : self.compression_stats.get_stats(),
+            "speculation" : self.speculator.get_stats(),
+            "dispatch" : self.send_tasks_queue.get_stats(),
+            "failures" : {"requeued_tasks" : self.requeued_tasks, "abandoned_tasks" : self.abandoned_tasks},
+            "tasks" : {
+                "submitted" : self.metrics.tasks_submitted,
+                "dispatched" : self.metrics.tasks_dispatched,
+                "completed" : self.metrics.tasks_completed,
+                "in_flight_batches" : sum(node_stats["in_flight"] for node_stats in nodes.values()),
+            },
+            "nodes" : nodes,
+            "network" : {
+                "bytes_sent" : self.connection_pool.bytes_sent,
+                "bytes_received" : self.metrics.bytes_received,
+                "shared_memory_bytes_sent" : self.metrics.shared_memory_bytes_sent,
+                "shared_memory_bytes_received" : self.metrics.shared_memory_bytes_received,
+                "reconnects" : self.connection_pool.reconnects,
+                "rejoined_nodes" : self.metrics.rejoined_nodes,
+            },
+            "latency" : self.metrics.get_latency_stats(),
+        }
+
+    def set_has_connection(self, has_connection):
+        """
+        Publish whether any slave nodes are connected.
+        """
+        with self.condition:
+            self.has_connection_tf = has_connection
+            self.condition.notify_all()
+
+def get_batch_id(batch):
+    """
+    A batch is identified by the id of its first task.
+    """
+    return batch[0].get_task_id()
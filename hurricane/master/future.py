@@ -0,0 +1,26 @@
+from concurrent.futures import Future
+
+class TaskFuture(Future):
+    """
+    Handle on the result of a task sent to a slave node. This is a
+    concurrent.futures.Future, so it supports result(timeout),
+    add_done_callback() and concurrent.futures.wait()/as_completed(). Its
+    result is the completed Task, or None if the task was abandoned.
+
+    Callbacks are run on the master node's event loop thread, so they should
+    return quickly.
+    """
+
+    def __init__(self, task_id):
+        """
+        Initialize the TaskFuture
+        """
+        super(TaskFuture, self).__init__()
+
+        self.task_id = task_id
+
+    def get_task_id(self):
+        """
+        Return the id of the task this future is for.
+        """
+        return self.task_id
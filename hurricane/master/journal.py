@@ -0,0 +1,456 @@
+import os
+import math
+import zlib
+import struct
+import logging
+import itertools
+from collections import OrderedDict
+from hurricane.messages import TaskBatchMessage
+from hurricane.utils.task import Task
+from hurricane.utils.spill import SpilledData
+from hurricane.utils.messages import encode_data
+from hurricane.utils.messages import decode_data
+from hurricane.utils.messages import split_frame
+
+# A journal file starts with JOURNAL_HEADER, followed by records. Each
+# record is a JOURNAL_RECORD header (type, payload length, CRC-32 of the
+# payload) and its payload:
+#
+#   submit      whether the batches may be speculated (B), their priority
+#               (i), their deadline (d, NaN for none), the number of
+#               batches (I), the size of each batch (I each), and a frame
+#               holding the tasks of all the batches
+#   dispatch    batch id (Q)
+#   complete    batch id (Q), the number of tasks (I), the size of each
+#               task (Q each), the number of tasks whose generated data was
+#               spilled to disk (I) with, for each of them, its index (I),
+#               the kind of spill file (B) and the length of its path (H)
+#               followed by the path, and a frame holding the completed
+#               tasks that went to the completed task store
+#   abandon     batch ids (Q each)
+#
+# Tasks are written in the same binary layout as on the wire, with all of
+# their user data in one pickle, which is much faster to replay than a
+# pickle of the Task objects. The generated data of spilled tasks is left
+# out; it is read back from the spill file when it is needed, as long as
+# the file is still there.
+#
+# A record that was only partly written when the master node stopped is
+# dropped, along with anything after it.
+JOURNAL_MAGIC = b"HURRJRNL"
+JOURNAL_VERSION = 3
+JOURNAL_HEADER = struct.Struct('>8sB')
+JOURNAL_RECORD = struct.Struct('>BII')
+BATCH_ID = struct.Struct('>Q')
+SUBMIT_FIELDS = struct.Struct('>BidI')
+COMPLETE_FIELDS = struct.Struct('>QI')
+SPILLED_COUNT = struct.Struct('>I')
+SPILLED_FIELDS = struct.Struct('>IBH')
+
+SPILL_KINDS = ["bytes", "bytearray", "frame"]
+
+JOURNAL_SUBMIT   = 1
+JOURNAL_DISPATCH = 2
+JOURNAL_COMPLETE = 3
+JOURNAL_ABANDON  = 4
+
+JOURNAL_COMPACTION_RECORDS = 100000
+SNAPSHOT_CHUNK_SIZE = 10000
+
+class JournalState:
+    """
+    The work recorded in a journal: the batches that were submitted but not
+    completed or abandoned, which of them had been dispatched, the priority
+    and deadline of those that have one, and the completed tasks that went
+    to the completed task store.
+    """
+
+    def __init__(self):
+        self.batches = OrderedDict()
+        self.dispatched = set()
+        self.non_speculative = set()
+        self.priorities = {}
+        self.completed = OrderedDict()
+
+    def get_pending_batches(self):
+        """
+        Return the pending batches, those that had been dispatched first,
+        each group in submission order.
+        """
+        if not self.dispatched:
+            return list(self.batches.values())
+
+        dispatched = [batch for batch_id, batch in self.batches.items() if batch_id in self.dispatched]
+        queued = [batch for batch_id, batch in self.batches.items() if batch_id not in self.dispatched]
+
+        return dispatched + queued
+
+    def get_completed_tasks(self):
+        """
+        Return (task, size) for every recorded completed task, oldest first.
+        """
+        return list(self.completed.values())
+
+    def apply(self, record_type, payload):
+        """
+        Update the state with a record.
+        """
+        if record_type == JOURNAL_SUBMIT:
+            speculative, priority, deadline, count = SUBMIT_FIELDS.unpack_from(payload)
+            offset = SUBMIT_FIELDS.size + 4 * count
+            tasks = decode_tasks(payload[offset:])
+
+            if len(tasks) == count:
+                batches = [[task] for task in tasks]
+            else:
+                batches = []
+                start = 0
+                for size in struct.unpack_from('>' + 'I' * count, payload, SUBMIT_FIELDS.size):
+                    batches.append(tasks[start:start + size])
+                    start += size
+
+            batch_ids = [batch[0].get_task_id() for batch in batches]
+            self.batches.update(zip(batch_ids, batches))
+
+            if not speculative:
+                self.non_speculative.update(batch_ids)
+
+            if priority != 0 or not math.isnan(deadline):
+                info = (priority, None if math.isnan(deadline) else deadline)
+                self.priorities.update((batch_id, info) for batch_id in batch_ids)
+        elif record_type == JOURNAL_DISPATCH:
+            batch_id = BATCH_ID.unpack(payload)[0]
+
+            if batch_id in self.batches:
+                self.dispatched.add(batch_id)
+        elif record_type == JOURNAL_COMPLETE:
+            batch_id, count = COMPLETE_FIELDS.unpack_from(payload)
+            offset = COMPLETE_FIELDS.size + 8 * count
+            sizes = struct.unpack_from('>' + 'Q' * count, payload, COMPLETE_FIELDS.size)
+
+            spilled_count = SPILLED_COUNT.unpack_from(payload, offset)[0]
+            offset += SPILLED_COUNT.size
+
+            spill_files = {}
+            for _ in range(spilled_count):
+                index, kind, path_length = SPILLED_FIELDS.unpack_from(payload, offset)
+                offset += SPILLED_FIELDS.size
+
+                spill_files[index] = (bytes(payload[offset:offset + path_length]).decode(), SPILL_KINDS[kind])
+                offset += path_length
+
+            self.remove(batch_id)
+
+            if count > 0:
+                for index, (task, size) in enumerate(zip(decode_tasks(payload[offset:]), sizes)):
+                    if index in spill_files:
+                        try:
+                            task.set_spilled_data(SpilledData(*spill_files[index], keep_at_exit=True))
+                        except OSError:
+                            # The file is removed once the task has been
+                            # claimed, which the journal does not record
+                            self.completed.pop(task.get_task_id(), None)
+
+                            continue
+
+                    self.completed[task.get_task_id()] = (task, size)
+        elif record_type == JOURNAL_ABANDON:
+            for (batch_id,) in BATCH_ID.iter_unpack(payload):
+                self.remove(batch_id)
+        else:
+            raise ValueError("Unknown journal record type " + str(record_type))
+
+    def remove(self, batch_id):
+        """
+        Forget a batch that completed or was abandoned.
+        """
+        self.batches.pop(batch_id, None)
+        self.dispatched.discard(batch_id)
+        self.non_speculative.discard(batch_id)
+        self.priorities.pop(batch_id, None)
+
+class TaskJournal:
+    """
+    Append-only journal of the tasks submitted to, dispatched by and
+    completed on a master node, so that a restarted master node can resume
+    the work that was pending. Records are written by the engine's event
+    loop and flushed once per loop iteration.
+
+    The journal is compacted once it holds journal_compaction_records
+    records more than are needed to describe the pending work: a snapshot
+    of the pending batches and stored completed tasks is written to a new
+    file, which then replaces the journal.
+
+    Claims of completed tasks are not recorded, so completed tasks that
+    were claimed since the last compaction are stored again on replay,
+    except for spilled tasks, whose file went with them.
+    """
+
+    def __init__(self, path, **kwargs):
+        self.path = path
+        self.fsync = kwargs.get('journal_fsync', False)
+        self.compaction_records = kwargs.get('journal_compaction_records', JOURNAL_COMPACTION_RECORDS)
+
+        self.file = None
+        self.records = 0
+        self.compaction_buffer = None
+
+    def open(self):
+        """
+        Replay the journal, if there is one, and open it for appending.
+
+        @returns the JournalState read from the journal
+        """
+        state = JournalState()
+        end = 0
+
+        if os.path.exists(self.path):
+            end = self.replay(state)
+
+        self.file = open(self.path, "r+b" if os.path.exists(self.path) else "wb")
+
+        if end == 0:
+            self.file.truncate(0)
+            self.file.write(JOURNAL_HEADER.pack(JOURNAL_MAGIC, JOURNAL_VERSION))
+        else:
+            self.file.truncate(end)
+            self.file.seek(end)
+
+        self.flush()
+
+        return state
+
+    def replay(self, state):
+        """
+        Apply every complete record in the journal to state.
+
+        @returns the offset just past the last complete record, or 0 if the
+        file is too short to hold the journal header
+        """
+        with open(self.path, "rb") as journal_file:
+            data = journal_file.read()
+
+        if len(data) < JOURNAL_HEADER.size:
+            return 0
+
+        magic, version = JOURNAL_HEADER.unpack_from(data)
+        if magic != JOURNAL_MAGIC or version != JOURNAL_VERSION:
+            raise ValueError(self.path + " is not a version " + str(JOURNAL_VERSION) + " task journal")
+
+        view = memoryview(data)
+        offset = JOURNAL_HEADER.size
+
+        while offset + JOURNAL_RECORD.size <= len(data):
+            record_type, length, checksum = JOURNAL_RECORD.unpack_from(data, offset)
+            start = offset + JOURNAL_RECORD.size
+            payload = view[start:start + length]
+
+            if len(payload) < length or zlib.crc32(payload) != checksum:
+                break
+
+            state.apply(record_type, payload)
+
+            offset = start + length
+            self.records += 1
+
+        if offset < len(data):
+            logging.warning("Dropped " + str(len(data) - offset) + " bytes of incomplete records from the end of " + self.path)
+
+        return offset
+
+    def submit(self, batches, speculative=True, priority=0, deadline=None):
+        """
+        Record that batches of tasks were queued.
+        """
+        self.append(JOURNAL_SUBMIT, pack_submit(batches, speculative, priority, deadline))
+
+    def dispatch(self, batch_id):
+        """
+        Record that a batch was sent to a node.
+        """
+        self.append(JOURNAL_DISPATCH, BATCH_ID.pack(batch_id))
+
+    def complete(self, batch_id, completed_tasks):
+        """
+        Record that a batch completed. completed_tasks lists (task, size)
+        for the tasks that went to the completed task store.
+        """
+        self.append(JOURNAL_COMPLETE, pack_complete(batch_id, completed_tasks))
+
+    def abandon(self, batch_ids):
+        """
+        Record that batches were abandoned.
+        """
+        self.append(JOURNAL_ABANDON, b"".join(BATCH_ID.pack(batch_id) for batch_id in batch_ids))
+
+    def append(self, record_type, payload):
+        """
+        Append a record to the journal. While the journal is being
+        compacted, records are also kept to be added to the snapshot.
+        """
+        record = pack_record(record_type, payload)
+
+        self.file.write(record)
+        self.records += 1
+
+        if self.compaction_buffer != None:
+            self.compaction_buffer.append(record)
+
+    def flush(self):
+        """
+        Write the appended records out, and sync them to disk if
+        journal_fsync is set.
+        """
+        self.file.flush()
+
+        if self.fsync:
+            os.fsync(self.file.fileno())
+
+    def needs_compaction(self, live_batches):
+        """
+        Return whether the journal should be compacted, given the number of
+        batches still pending.
+        """
+        return self.compaction_buffer == None and self.records >= max(self.compaction_records, 2 * live_batches)
+
+    def start_compaction(self):
+        """
+        Start keeping the records appended from now on for the snapshot.
+        """
+        self.compaction_buffer = []
+
+    def write_snapshot(self, pending_batches, dispatched, non_speculative, priorities, completed_tasks):
+        """
+        Write a snapshot of the pending work to a new file next to the
+        journal. priorities maps batch ids to (priority, deadline) for the
+        batches that have one. Safe to run in another thread while records
+        are appended.
+
+        @returns the path of the snapshot
+        """
+        snapshot_path = self.path + ".snapshot"
+
+        with open(snapshot_path, "wb") as snapshot_file:
+            snapshot_file.write(JOURNAL_HEADER.pack(JOURNAL_MAGIC, JOURNAL_VERSION))
+
+            def get_submit_fields(batch):
+                batch_id = batch[0].get_task_id()
+
+                return (batch_id not in non_speculative,) + priorities.get(batch_id, (0, None))
+
+            # Runs of batches submitted alike share a record, in their order
+            for (speculative, priority, deadline), group in itertools.groupby(pending_batches, get_submit_fields):
+                batches = list(group)
+
+                for index in range(0, len(batches), SNAPSHOT_CHUNK_SIZE):
+                    snapshot_file.write(pack_record(JOURNAL_SUBMIT, pack_submit(batches[index:index + SNAPSHOT_CHUNK_SIZE], speculative, priority, deadline)))
+
+            for batch_id in dispatched:
+                snapshot_file.write(pack_record(JOURNAL_DISPATCH, BATCH_ID.pack(batch_id)))
+
+            for index in range(0, len(completed_tasks), SNAPSHOT_CHUNK_SIZE):
+                snapshot_file.write(pack_record(JOURNAL_COMPLETE, pack_complete(0, completed_tasks[index:index + SNAPSHOT_CHUNK_SIZE])))
+
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+
+        return snapshot_path
+
+    def finish_compaction(self, snapshot_path):
+        """
+        Add the records appended during the compaction to the snapshot and
+        make it the journal.
+        """
+        records = self.compaction_buffer
+        self.compaction_buffer = None
+
+        snapshot_file = open(snapshot_path, "ab")
+        snapshot_file.write(b"".join(records))
+        snapshot_file.flush()
+        os.fsync(snapshot_file.fileno())
+
+        os.replace(snapshot_path, self.path)
+
+        self.file.close()
+        self.file = snapshot_file
+        self.records = len(records)
+
+    def abort_compaction(self):
+        """
+        Give up on a compaction; the journal stays as it was.
+        """
+        self.compaction_buffer = None
+
+    def close(self):
+        """
+        Flush and close the journal.
+        """
+        if self.file != None:
+            self.flush()
+            self.file.close()
+            self.file = None
+
+def pack_submit(batches, speculative, priority=0, deadline=None):
+    """
+    Pack the payload of a submit record.
+    """
+    sizes = struct.pack('>' + 'I' * len(batches), *[len(batch) for batch in batches])
+
+    if deadline == None:
+        deadline = math.nan
+
+    return SUBMIT_FIELDS.pack(speculative, priority, deadline, len(batches)) + sizes + encode_tasks([task for batch in batches for task in batch])
+
+def pack_complete(batch_id, completed_tasks):
+    """
+    Pack the payload of a complete record. Spilled tasks are recorded with
+    the path of their spill file instead of their generated data, so that
+    the data is neither read back from disk nor copied into the journal.
+    """
+    sizes = struct.pack('>' + 'Q' * len(completed_tasks), *[size for task, size in completed_tasks])
+
+    spill_files = []
+    for index, (task, size) in enumerate(completed_tasks):
+        if task.is_spilled():
+            spilled_data = task.get_spilled_data()
+            path = spilled_data.get_path().encode()
+
+            spill_files.append(SPILLED_FIELDS.pack(index, SPILL_KINDS.index(spilled_data.get_kind()), len(path)) + path)
+
+    tasks = b""
+    if completed_tasks != []:
+        tasks = encode_tasks([get_journaled_task(task) for task, size in completed_tasks])
+
+    return COMPLETE_FIELDS.pack(batch_id, len(completed_tasks)) + sizes + SPILLED_COUNT.pack(len(spill_files)) + b"".join(spill_files) + tasks
+
+def get_journaled_task(task):
+    """
+    Return the task to write to the journal in place of a completed task: a
+    copy without its generated data if it was spilled, and otherwise the
+    task itself.
+    """
+    if not task.is_spilled():
+        return task
+
+    return Task(task_id=task.get_task_id(), return_port=task.get_return_port(), starttime=task.get_starttime(), data=task.get_data(), timings=task.get_timings())
+
+def encode_tasks(tasks):
+    """
+    Encode a list of tasks as a single frame.
+    """
+    return b"".join(encode_data(TaskBatchMessage(tasks)))
+
+def decode_tasks(frame):
+    """
+    Decode a list of tasks encoded by encode_tasks. Out-of-band buffers
+    are copied, so the tasks do not keep the whole journal in memory.
+    """
+    flags, body, buffers = split_frame(frame)
+
+    return decode_data(body, [bytearray(buffer) for buffer in buffers], flags).get_tasks()
+
+def pack_record(record_type, payload):
+    """
+    Pack a journal record.
+    """
+    return JOURNAL_RECORD.pack(record_type, len(payload), zlib.crc32(payload)) + payload
@@ -1,17 +1,14 @@
-import socket
-import multiprocessing
-import errno
-import sys
+import queue
 import logging
-from queue import Empty
-from time import sleep
-from datetime import datetime
+import itertools
+from collections import OrderedDict
 from hurricane.utils import *
-from hurricane.messages import MessageTypes
-from hurricane.messages import TaskManagementMessage
-from hurricane.messages import HeartbeatMessage
-from hurricane.messages import NewNodeMessage
-from hurricane.messages import NodeInitializeMessage
+from hurricane.master.engine import MasterEngine
+from hurricane.master.future import TaskFuture
+from hurricane.master.chunking import ChunkSizer
+from hurricane.master.chunking import MAP_CHUNK_TIME
+from hurricane.master.chunking import MAP_MAX_CHUNKSIZE
+from hurricane.master.chunking import MAP_WINDOW_PER_SLOT
 
 class MasterNode:
 
@@ -19,364 +16,337 @@ class MasterNode:
         self.initialize_port = kwargs.get('initialize_port', 12222)
         self.debug = kwargs.get('debug', False)
         self.max_disconnect_errors = kwargs.get('max_disconnect_errors', 3)
-
-        self.max_connections = 20
-        self.connect_timeout = 10
-        self.task_port = self.initialize_port + 1
-        self.task_completion_port = self.initialize_port + 2
-        self.scanner_input, self.scanner_output = multiprocessing.Pipe()
-        self.has_connection_input, self.has_connection_output = multiprocessing.Pipe()
-        self.completed_tasks_input, self.completed_tasks_output = multiprocessing.Pipe()
-        self.has_connection_tf = False
-        self.completed_tasks_queue = multiprocessing.Queue()
-        self.completed_tasks = []
-        self.current_tasks_queue = multiprocessing.Queue()
-        self.current_tasks = []
-        self.send_tasks_queue = multiprocessing.Queue()
-
-        self.exit_signal = multiprocessing.Event()
+        self.map_chunk_time = kwargs.get('map_chunk_time', MAP_CHUNK_TIME)
+        self.map_max_chunksize = kwargs.get('map_max_chunksize', MAP_MAX_CHUNKSIZE)
 
         logging.basicConfig(format="%(asctime)s %(name)s [%(levelname)s] %(message)s", level=kwargs.get("level", logging.INFO))
 
+        self.engine = MasterEngine(**kwargs)
+        self.exit_signal = self.engine.exit_signal
+
     def initialize(self):
         """
-        This method runs in the background and attempts to identify slaves to use.
+        Start the master node's event loop, which identifies slaves to use
+        and distributes tasks to them in the background.
         """
         logging.info("Initializing the master node")
-        logging.info("Starting scanning process")
-        self.scanning_process = multiprocessing.Process(target=self.identify_slaves)
-        self.scanning_process.start()
 
-        logging.info("Starting task distribution process")
-        self.node_management_process = multiprocessing.Process(target=self.node_manager)
-        self.node_management_process.daemon = True
-        self.node_management_process.start()
+        self.engine.start()
 
     def stop(self):
         """
-        Stop the server and kill all child processes
+        Stop the server and close all of its connections
         """
-        self.exit_signal.set()
+        self.engine.stop()
 
-    def node_manager(self):
+    def is_task_completed(self, task_id):
         """
-        This process manages task distribution within the node network.
+        Returns "True, generated_data" if the task has been completed,
+        "False, None" if it has not.
         """
-        nodes = {}
-
-        while not self.exit_signal.is_set():
-            nodes = self.manage_node_status(nodes)
+        with self.engine.condition:
+            task = self.engine.completed_tasks.claim(task_id)
 
-            while self.completed_tasks_input.poll():
-                completed_task = self.completed_tasks_input.recv()
+        if task != None:
+            return True, task
 
-                for node in nodes:
-                    if nodes[node]["task"]:
-                        if nodes[node]["task"].get_task_id() == completed_task.get_task_id():
-                            nodes[node]["task"] = None
-
-            current_tasks = []
-            for node in nodes:
-                if nodes[node]["task"]:
-                    current_tasks.append(nodes[node]["task"].get_task_id())
-            self.current_tasks_queue.put(current_tasks)
+        return False, None
 
-            for node in nodes:
-                if not nodes[node]["task"]:
-                    task = None
-                    try:
-                        task = self.send_tasks_queue.get(block=False)
-                    except:
-                        pass
+    def wait_for_any_task_completion(self, timeout=-1):
+        """
+        Wait for any task to be completed
+        """
+        with self.engine.condition:
+            self.engine.condition.wait_for(lambda: len(self.engine.completed_tasks) > 0 or self.exit_signal.is_set(), self.get_wait_timeout(timeout))
 
-                    if task:
-                        did_error_occur = False
+            return self.engine.completed_tasks.claim_oldest()
 
-                        try:
-                            task_socket = create_active_socket(self.get_host(node), int(self.get_port(node)))
+    def wait_for_task_completion(self, task_id, timeout=-1):
+        """
+        Wait for the task with task_id to be completed. Returns None if the
+        task was abandoned or the timeout expired.
+        """
+        if self.has_connection() == False:
+            logging.error("No nodes are connected...please connect a node then send it a task")
 
-                            logging.info("Sending task " + str(task.get_task_id()) + " to " + node)
+            return None
 
-                            task_socket.send(encode_data(task))
-                            task_socket.close()
+        logging.info("Waiting for task " + str(task_id) + " to be completed")
 
-                            nodes[node]["num_disconnects"] = 0
-                        except socket.error as err:
-                            did_error_occur = True
+        with self.engine.condition:
+            self.engine.condition.wait_for(lambda: task_id not in self.engine.current_tasks or self.exit_signal.is_set(), self.get_wait_timeout(timeout))
 
-                            if err.errno == errno.ECONNREFUSED or err.args[0] == "timed out":
-                                logging.error("Connection refused when attempting to send a task to " + node + ", try number " + str(nodes[node]["num_disconnects"] + 1))
+            completed, data = self.is_task_completed(task_id)
+            if completed:
+                return data
 
-                                nodes[node]["num_disconnects"] += 1
-                            elif err.errno == errno.EPIPE:
-                                logging.error("Client connection from " + node + " disconnected early")
-                            else:
-                                logging.error("Unknown error \"" + err.args[0] + "\" thrown when attempting to send a task to " + node)
+        return None
 
-                        if not did_error_occur:
-                            nodes[node]["task"] = task
+    def get_stats(self):
+        """
+        Return statistics about the master node.
+        """
+        return self.engine.get_stats()
 
-                    try:
-                        if "connect_time" in nodes[node]:
-                            if (datetime.now() - nodes[node]["connect_time"]).total_seconds() > self.connect_timeout:
-                                task_socket = create_active_socket(self.get_host(node), int(self.get_port(node)))
-                                task_socket.send(encode_data(HeartbeatMessage()))
-                                task_socket.close()
-                                nodes[node]["num_disconnects"] = 0
-                                nodes[node]["connect_time"] = datetime.now()
-                        else:
-                            task_socket = create_active_socket(self.get_host(node), int(self.get_port(node)))
-                            task_socket.send(encode_data(HeartbeatMessage()))
-                            task_socket.close()
-                            nodes[node]["num_disconnects"] = 0
-                            nodes[node]["connect_time"] = datetime.now()
-                    except socket.error as err:
-                        nodes[node]["connect_time"] = datetime.now()
+    def get_wait_timeout(self, timeout):
+        """
+        Convert a timeout argument (-1 meaning forever) for Condition.wait_for
+        """
+        if timeout > 0:
+            return timeout
 
-                        if err.errno == errno.ECONNREFUSED:
-                            logging.error("Connection refused when attempting to send a task to " + node + ", try number " + str(nodes[node]["num_disconnects"] + 1))
+        return None
 
-                            nodes[node]["num_disconnects"] += 1
+    def has_connection(self):
+        """
+        Returns whether this MasterNode has any slave nodes connected
+        """
+        return self.engine.has_connection_tf
 
-                        sleep(0.5)
-            sleep(0.1)
+    def get_host(self, id):
+        """
+        Read the host from the id.
+        """
+        return id.split(":")[0]
 
-    def identify_slaves(self):
+    def get_port(self, id):
         """
-        Identify slave nodes.
+        Read the port from the id
         """
-        initialize_socket = create_listen_socket_timer(self.initialize_port, self.max_connections)
+        return id.split(":")[1]
 
-        while not self.exit_signal.is_set():
-            try:
-                connection, addr = initialize_socket.accept()
-                self.update_available_ports()
+    def wait_for_connection(self, timeout=-1):
+        """
+        Block the current thread until there is a slave node to send tasks to
+        """
+        logging.info("Waiting for a connection")
 
-                self.scanner_output.send(NewNodeMessage(addr, self.task_port, self.task_completion_port))
+        with self.engine.condition:
+            self.engine.condition.wait_for(lambda: self.engine.has_connection_tf or self.exit_signal.is_set(), self.get_wait_timeout(timeout))
 
-                task_completion_monitoring_process = multiprocessing.Process(target=self.node_communication_receiver, args=(self.task_completion_port,))
-                task_completion_monitoring_process.daemon = True
-                task_completion_monitoring_process.start()
-                sleep(0.01)
+    def send_task(self, data, return_future=False, speculative=True, priority=0, deadline=None):
+        """
+        Distribute a task to a slave node. When speculative execution is
+        enabled, a straggling task may be run on a second node as well;
+        set speculative to False for tasks that must not run twice.
 
-                connection.send(encode_data(TaskManagementMessage(task_port=self.task_port, task_completion_port=self.task_completion_port)))
-                connection.close()
-            except socket.error as err:
-                if err.args[0] == "timed out":
-                    pass
+        Queued tasks are sent in order of priority, an integer (higher
+        first), and within a priority earliest deadline first. deadline is
+        a time.time() timestamp the task should complete by; tasks without
+        one go after those with one. Tasks that have waited long are moved
+        up, see priority_aging.
 
-    def node_communication_receiver(self, port):
+        @returns the task id, or a TaskFuture for the task if return_future
+        is set (the task is then only delivered through the future)
         """
-        Capture the data received whenever a node sends data to the master node.
-        """
-        data_socket = create_listen_socket(port, self.max_connections)
+        if self.has_connection() == False:
+            logging.warning("No nodes are connected/available to send a task to...task will be queued until a node is available/connected")
 
-        while not self.exit_signal.is_set():
-            connection, addr = data_socket.accept()
-            data = read_data(connection)
-            connection.close()
+        new_task = Task(task_id=generate_task_id(), return_port=self.engine.task_completion_port, data=data)
 
-            if data.get_message() == MessageTypes.TASK:
-                completed_task = data.get_task()
+        if return_future:
+            future = TaskFuture(new_task.get_task_id())
+            self.engine.submit([[new_task]], {new_task.get_task_id() : future}, speculative, priority, deadline)
 
-                logging.info("Received task completion for task " + str(completed_task.get_task_id()))
+            return future
 
-                self.completed_tasks_output.send(completed_task)
-                self.completed_tasks_queue.put(completed_task)
-            elif data.get_message() == MessageTypes.INITIALIZE_NODE:
-                self.scanner_output.send(NodeInitializeMessage(addr, data.get_cpu_count()))
+        self.engine.submit([[new_task]], speculative=speculative, priority=priority, deadline=deadline)
 
-    def is_task_completed(self, task_id):
-        """
-        Returns "True, generated_data" if the task has been completed,
-        "False, None" if it has not.
-        """
-        self.update_completed_tasks()
+        return new_task.get_task_id()
 
-        for task_idx in range(len(self.completed_tasks)):
-            task = self.completed_tasks[task_idx]
+    def send_tasks(self, iterable, chunksize=1, return_futures=False, speculative=True, priority=0, deadline=None):
+        """
+        Distribute a task to a slave node for every item of iterable. Tasks
+        are grouped into chunks of chunksize tasks; each chunk is sent to a
+        node in a single frame, takes up one of the node's slots, and its
+        completions come back together. Large chunks cut the per-task
+        overhead of many small tasks. speculative, priority and deadline are
+        as for send_task.
 
-            if task_id == task.get_task_id():
-                updated_completed_tasks = self.completed_tasks[:task_idx]
-                updated_completed_tasks.extend(self.completed_tasks[task_idx + 1:])
-                self.completed_tasks = updated_completed_tasks
+        @returns the list of task ids (or of TaskFutures, if return_futures
+        is set), in the order of iterable
+        """
+        if self.has_connection() == False:
+            logging.warning("No nodes are connected/available to send tasks to...tasks will be queued until a node is available/connected")
 
-                return True, task
+        chunksize = max(1, chunksize)
+        task_ids = []
+        batches = []
+        batch = []
 
-        return False, None
+        for data in iterable:
+            new_task = Task(task_id=generate_task_id(), return_port=self.engine.task_completion_port, data=data)
 
-    def update_completed_tasks(self):
-        """
-        Update the completed tasks list from the completed tasks queue
-        """
-        while True:
-            try:
-                self.completed_tasks.append(self.completed_tasks_queue.get(block=False))
-            except Empty:
-                break
+            task_ids.append(new_task.get_task_id())
+            batch.append(new_task)
 
-    def update_current_tasks(self):
-        """
-        Update the current tasks lists from the current tasks queue
-        """
-        while True:
-            try:
-                self.current_tasks = self.current_tasks_queue.get(block=False)
-            except Empty:
-                break
+            if len(batch) == chunksize:
+                batches.append(batch)
+                batch = []
 
-    def wait_for_any_task_completion(self, timeout=-1):
-        """
-        Wait for any task to be completed
-        """
-        if timeout > 0:
-            time = 0
-            while time < timeout and not self.exit_signal.is_set():
-                if self.completed_tasks == []:
-                    self.update_completed_tasks()
+        if batch != []:
+            batches.append(batch)
 
-                    sleep(0.1)
-                    time += 0.1
-                else:
-                    return self.completed_tasks.pop(0)
+        if return_futures:
+            futures = [TaskFuture(task_id) for task_id in task_ids]
+            self.engine.submit(batches, dict(zip(task_ids, futures)), speculative, priority, deadline)
 
-            return None
+            return futures
 
-        while not self.exit_signal.is_set():
-            if self.completed_tasks == []:
-                self.update_completed_tasks()
+        self.engine.submit(batches, speculative=speculative, priority=priority, deadline=deadline)
 
-                sleep(0.1)
-            else:
-                return self.completed_tasks.pop(0)
+        return task_ids
 
-    def wait_for_task_completion(self, task_id, timeout=-1):
+    def as_completed(self, task_ids, timeout=-1):
         """
-        Wait for the task with task_id to be completed.
+        Yield the completed task for each of task_ids as soon as the master
+        node receives it, in completion order. Tasks that are abandoned are
+        skipped. Stops early if no task completes within timeout seconds.
+        Tasks sent with a future are delivered through the future instead.
         """
-        if self.has_connection() == False:
-            logging.error("No nodes are connected...please connect a node then send it a task")
+        remaining = set(task_ids)
 
-            return None
+        while remaining:
+            completed = []
 
-        logging.info("Waiting for task " + str(task_id) + " to be completed")
+            with self.engine.condition:
+                def is_ready():
+                    completed.extend(self.engine.completed_tasks.claim_many(remaining))
+                    remaining.difference_update(task.get_task_id() for task in completed)
+                    remaining.intersection_update(self.engine.current_tasks)
 
-        if timeout > 0:
-            time = 0
-            while time < timeout and not self.exit_signal.is_set():
-                completed, data = self.is_task_completed(task_id)
-                if completed:
-                    return data
-                else:
-                    sleep(0.1)
-                    time += 0.1
-        else:
-            while not self.exit_signal.is_set():
-                self.update_current_tasks()
-                if task_id in self.current_tasks:
-                    completed, data = self.is_task_completed(task_id)
-                    if completed:
-                        return data
-                    else:
-                        sleep(0.1)
-                else:
-                    return None
+                    return completed != [] or not remaining or self.exit_signal.is_set()
 
-        return None
+                if not self.engine.condition.wait_for(is_ready, self.get_wait_timeout(timeout)):
+                    return
 
-    def update_available_ports(self):
-        """
-        Update to get next available port to communicate on.
-        """
-        self.task_port += 2
-        self.task_completion_port += 2
+            for task in completed:
+                yield task
 
-    def has_connection(self):
+            if self.exit_signal.is_set():
+                return
+
+    def gather(self, task_ids, timeout=-1):
         """
-        Returns whether this MasterNode has any slave nodes connected
+        Yield the completed task for each of task_ids in the order of
+        task_ids, each as soon as it and every task before it have been
+        received. Abandoned tasks, and tasks still outstanding when no task
+        has completed for timeout seconds, yield None.
         """
-        while self.has_connection_input.poll():
-            self.has_connection_tf = self.has_connection_input.recv()
+        task_ids = list(task_ids)
+        completed = {}
+        completions = self.as_completed(task_ids, timeout)
 
-        return self.has_connection_tf
+        for task_id in task_ids:
+            while task_id not in completed:
+                task = next(completions, None)
+                if task == None:
+                    break
 
-    def get_host(self, id):
-        """
-        Read the host from the id.
-        """
-        return id.split(":")[0]
+                completed[task.get_task_id()] = task
 
-    def get_port(self, id):
-        """
-        Read the port from the id
-        """
-        return id.split(":")[1]
+            yield completed.pop(task_id, None)
 
-    def manage_node_status(self, nodes):
+    def map(self, iterable, chunksize=None, ordered=True, window=None, timeout=-1, speculative=True, priority=0, deadline=None):
         """
-        If a host has disconnected, remove them from the known hosts list
+        Run a task for every item of iterable and yield the generated data
+        of each, in the order of iterable, or in completion order if
+        ordered is not set. None is yielded for abandoned tasks.
+
+        iterable is read lazily, a chunk at a time, and at most window
+        chunks are sent and not yet yielded at any time (by default
+        MAP_WINDOW_PER_SLOT for each slot of the connected nodes), so an
+        unbounded iterable can be mapped in constant memory. Unless
+        chunksize is set, chunks are sized from how long tasks take, see
+        map_chunk_time. Stops early if no chunk completes within timeout
+        seconds or the master node is stopped. speculative, priority and
+        deadline are as for send_task.
         """
-        while self.scanner_input.poll():
-            data = self.scanner_input.recv()
+        items = iter(iterable)
+        sizer = ChunkSizer(chunksize, map_chunk_time=self.map_chunk_time, map_max_chunksize=self.map_max_chunksize)
+        completions = queue.Queue()
+        chunks = OrderedDict()
+        completed_chunks = set()
+        chunk_count = 0
+        exhausted = False
+
+        while True:
+            if window != None:
+                max_chunks = max(1, window)
+            else:
+                max_chunks = max(MAP_WINDOW_PER_SLOT, MAP_WINDOW_PER_SLOT * self.engine.get_slot_count())
+
+            while not exhausted and len(chunks) < max_chunks:
+                chunk = list(itertools.islice(items, sizer.get_chunksize()))
+                if chunk == []:
+                    exhausted = True
+                    break
 
-            if isinstance(data, NewNodeMessage):
-                new_node_compiled = str(data.get_addr()[0]) + ":" + str(data.get_task_port())
-                if new_node_compiled not in nodes:
-                    nodes[new_node_compiled] = {"num_disconnects" : 0, "task" : None}
-                    self.has_connection_output.send(True)
+                chunks[chunk_count] = self.send_chunk(chunk, completions, chunk_count, speculative, priority, deadline)
+                chunk_count += 1
 
-                    logging.info("Identified new node at " + new_node_compiled)
-            elif isinstance(data, NodeInitializeMessage):
-                address = str(data.get_addr()[0])
-                for node in nodes:
-                    if address in node:
-                        nodes[node]["cpu_count"] = data.get_cpu_count()
+            if not chunks:
+                return
 
-                        logging.info("Got CPU count from node with address of " + address + ": " + str(nodes[node]["cpu_count"]))
+            try:
+                chunk_number = completions.get(timeout=self.get_wait_timeout(timeout))
+            except queue.Empty:
+                logging.warning("No chunk of the map completed within " + str(timeout) + " seconds...stopping")
 
-                        break
+                return
 
-        should_update = False
-        for node, node_info in nodes.items():
-            if node_info["num_disconnects"] >= self.max_disconnect_errors:
-                logging.info("Connection with " + node + " has timed out...disconnecting from slave node")
+            if self.exit_signal.is_set():
+                return
 
-                new_nodes = {}
-                for inner_node, inner_node_info in nodes.items():
-                    if inner_node != node:
-                        new_nodes[inner_node] = inner_node_info
+            completed_chunks.add(chunk_number)
 
-                nodes = new_nodes
+            if ordered:
+                ready_chunks = []
+                while chunks and next(iter(chunks)) in completed_chunks:
+                    chunk_number = next(iter(chunks))
+                    completed_chunks.discard(chunk_number)
+                    ready_chunks.append(chunks.pop(chunk_number))
+            else:
+                completed_chunks.discard(chunk_number)
+                ready_chunks = [chunks.pop(chunk_number)]
 
-        if nodes == {}:
-            self.has_connection_output.send(False)
+            for futures in ready_chunks:
+                tasks = [future.result() for future in futures]
+                self.record_chunk(sizer, tasks)
 
-        return nodes
+                for task in tasks:
+                    yield task.get_generated_data() if task != None else None
 
-    def wait_for_connection(self, timeout=-1):
+    def imap_unordered(self, iterable, chunksize=None, window=None, timeout=-1, speculative=True, priority=0, deadline=None):
         """
-        Block the current thread until there is a slave node to send tasks to
+        Like map, but yield the generated data of tasks in the order they
+        complete.
         """
-        logging.info("Waiting for a connection")
-
-        if timeout > 0:
-            time = 0
-            while self.has_connection() == False and time < timeout:
-                sleep(0.1)
-                time += 0.1
-        else:
-            while self.has_connection() == False and not self.exit_signal.is_set():
-                sleep(0.1)
+        return self.map(iterable, chunksize, False, window, timeout, speculative, priority, deadline)
 
-    def send_task(self, data):
+    def send_chunk(self, chunk, completions, chunk_number, speculative, priority, deadline):
         """
-        Distribute a task to a slave node.
+        Send a chunk of a map as a single batch. chunk_number is put on
+        completions once the whole chunk has completed or been abandoned.
+
+        @returns the TaskFutures of the chunk's tasks
         """
-        if self.has_connection == False:
-            logging.warning("No nodes are connected/available to send a task to...task will be queued until a node is available/connected")
+        batch = [Task(task_id=generate_task_id(), return_port=self.engine.task_completion_port, data=data) for data in chunk]
+        futures = [TaskFuture(task.get_task_id()) for task in batch]
 
-        new_task = Task(task_id=generate_task_id(), return_port=self.task_completion_port, data=data)
+        # The futures of a batch are resolved in order, so the whole chunk
+        # is done once its last future is
+        futures[-1].add_done_callback(lambda future: completions.put(chunk_number))
 
-        self.send_tasks_queue.put(new_task)
+        self.engine.submit([batch], {future.get_task_id() : future for future in futures}, speculative, priority, deadline)
 
-        return new_task.get_task_id()
+        return futures
+
+    def record_chunk(self, sizer, tasks):
+        """
+        Tell sizer how long a completed chunk took to run on its node.
+        """
+        timings = tasks[0].get_timings() if tasks[0] != None else None
+
+        if timings != None and "dispatched" in timings and "completed" in timings:
+            sizer.record(len(tasks), timings["completed"] - timings["dispatched"])
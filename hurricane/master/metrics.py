@@ -0,0 +1,238 @@
+import math
+
+# Latencies are recorded in microseconds into log-linear buckets, as in an
+# HDR histogram: every power of two is split into 2^(HISTOGRAM_PRECISION_BITS
+# - 1) buckets, so a recorded value is off by less than 1 / 2^(
+# HISTOGRAM_PRECISION_BITS - 1) of itself. Recording a value is a couple of
+# integer operations and a list increment.
+HISTOGRAM_PRECISION_BITS = 7
+HISTOGRAM_MAX_BITS = 42
+
+# Bucket boundaries, in seconds, of the histograms on the metrics endpoint
+PROMETHEUS_BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+LATENCIES = ["queue", "transfer", "service", "round_trip", "delivery", "slave_queue", "execution", "batch_wait", "return"]
+
+# The stages of a task's lifecycle each latency measured from a task's
+# timings runs between
+STAGE_LATENCIES = [
+    ("delivery", "dispatched", "received"),
+    ("slave_queue", "received", "started"),
+    ("execution", "started", "finished"),
+    ("batch_wait", "finished", "sent"),
+    ("return", "sent", "completed"),
+]
+
+class LatencyHistogram:
+    """
+    Histogram of latencies with a bounded relative error, from which
+    percentiles can be read at any time.
+    """
+
+    def __init__(self):
+        self.half = 1 << (HISTOGRAM_PRECISION_BITS - 1)
+        self.counts = [0] * ((HISTOGRAM_MAX_BITS - HISTOGRAM_PRECISION_BITS + 2) * self.half)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, latency):
+        """
+        Record a latency in seconds.
+        """
+        micros = int(latency * 1000000)
+        if micros < 0:
+            micros = 0
+
+        shift = micros.bit_length() - HISTOGRAM_PRECISION_BITS
+        if shift <= 0:
+            index = micros
+        else:
+            index = min(shift * self.half + (micros >> shift), len(self.counts) - 1)
+
+        self.counts[index] += 1
+        self.count += 1
+        self.total += latency
+        if latency > self.max:
+            self.max = latency
+
+    def get_bucket_value(self, index):
+        """
+        Return the middle of a bucket, in seconds.
+        """
+        if index < 2 * self.half:
+            return index / 1000000
+
+        shift = index // self.half - 1
+        low = (index - shift * self.half) << shift
+
+        return (low + (1 << shift) / 2) / 1000000
+
+    def get_percentiles(self, percentiles):
+        """
+        Return the latency at each of percentiles (0 to 100), or None for
+        each if nothing was recorded.
+        """
+        counts = list(self.counts)
+        count = sum(counts)
+        if count == 0:
+            return [None for percentile in percentiles]
+
+        targets = sorted((max(1, math.ceil(count * percentile / 100)), position) for position, percentile in enumerate(percentiles))
+        values = [None] * len(percentiles)
+        seen = 0
+        target = 0
+
+        for index, bucket_count in enumerate(counts):
+            seen += bucket_count
+
+            while target < len(targets) and seen >= targets[target][0]:
+                values[targets[target][1]] = min(self.get_bucket_value(index), self.max)
+                target += 1
+
+            if target == len(targets):
+                break
+
+        return values
+
+    def get_cumulative_counts(self, bounds):
+        """
+        Return how many latencies were at most each of bounds, in seconds.
+        """
+        counts = list(self.counts)
+        cumulative = []
+        seen = 0
+        index = 0
+
+        for bound in bounds:
+            while index < len(counts) and self.get_bucket_value(index) <= bound:
+                seen += counts[index]
+                index += 1
+
+            cumulative.append(seen)
+
+        return cumulative
+
+    def get_stats(self):
+        """
+        Return the number of latencies recorded, their mean, their
+        maximum and their 50th, 90th, 99th and 99.9th percentiles.
+        """
+        p50, p90, p99, p999 = self.get_percentiles([50, 90, 99, 99.9])
+
+        return {
+            "count" : self.count,
+            "mean" : self.total / self.count if self.count > 0 else None,
+            "max" : self.max if self.count > 0 else None,
+            "p50" : p50,
+            "p90" : p90,
+            "p99" : p99,
+            "p999" : p999,
+        }
+
+class MasterMetrics:
+    """
+    Counters and latency histograms of a master node. They are only updated
+    on the engine's event loop, so updates are not locked; other threads
+    may read them at any time and get a value that is at most slightly
+    stale.
+
+    The latencies recorded for each batch of tasks are:
+
+        queue       from being submitted to being sent to a node
+        transfer    from being sent to a node to the whole frame being
+                    written
+        service     from being sent to a node to its completions arriving
+        round_trip  from being submitted to its completions arriving
+
+    and, for each task, from the timings the slave node sends back:
+
+        delivery    from being sent to a node to the node receiving it
+        slave_queue from the node receiving it to it being started
+        execution   from being started to being finished
+        batch_wait  from being finished to being sent back, while the rest
+                    of its batch runs
+        return      from being sent back to arriving on the master node
+    """
+
+    def __init__(self):
+        self.tasks_submitted = 0
+        self.tasks_dispatched = 0
+        self.tasks_completed = 0
+        self.bytes_received = 0
+        self.shared_memory_bytes_sent = 0
+        self.shared_memory_bytes_received = 0
+        self.rejoined_nodes = 0
+
+        self.latencies = {name : LatencyHistogram() for name in LATENCIES}
+
+    def record_timings(self, timings):
+        """
+        Record the latencies between the stages of a completed task.
+        """
+        if timings == None:
+            return
+
+        for name, start, end in STAGE_LATENCIES:
+            if start in timings and end in timings:
+                self.latencies[name].record(timings[end] - timings[start])
+
+    def get_latency_stats(self):
+        """
+        Return a summary of each latency histogram.
+        """
+        return {name : histogram.get_stats() for name, histogram in self.latencies.items()}
+
+def format_prometheus(stats, histograms, prefix="hurricane"):
+    """
+    Render the output of MasterNode.get_stats() in the Prometheus text
+    format. Nested keys are joined with underscores; the entries of the
+    "nodes" statistics become a node label. Summaries of histograms are
+    left out in favor of the histograms themselves.
+
+    @returns the text to serve
+    """
+    lines = []
+
+    for name, value in flatten_stats(stats, prefix):
+        if name.startswith(prefix + "_latency_"):
+            continue
+
+        lines.append(name + " " + format_value(value))
+
+    for name, histogram in histograms.items():
+        metric = prefix + "_" + name + "_latency_seconds"
+        lines.append("# TYPE " + metric + " histogram")
+
+        for bound, count in zip(PROMETHEUS_BUCKETS, histogram.get_cumulative_counts(PROMETHEUS_BUCKETS)):
+            lines.append(metric + "_bucket{le=\"" + str(bound) + "\"} " + str(count))
+
+        lines.append(metric + "_bucket{le=\"+Inf\"} " + str(histogram.count))
+        lines.append(metric + "_sum " + format_value(histogram.total))
+        lines.append(metric + "_count " + str(histogram.count))
+
+    return "\n".join(lines) + "\n"
+
+def flatten_stats(stats, name):
+    """
+    Yield (metric name with labels, value) for every number in stats.
+    """
+    for key, value in stats.items():
+        if isinstance(value, dict) and key == "nodes":
+            for node, node_stats in value.items():
+                for stat, stat_value in node_stats.items():
+                    if is_number(stat_value):
+                        yield name + "_node_" + stat + "{node=\"" + node + "\"}", stat_value
+        elif isinstance(value, dict):
+            yield from flatten_stats(value, name + "_" + key)
+        elif is_number(value):
+            yield name + "_" + key, value
+
+def is_number(value):
+    return isinstance(value, (int, float))
+
+def format_value(value):
+    if isinstance(value, bool):
+        return str(int(value))
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
@@ -0,0 +1,190 @@
+class Scheduler:
+    """
+    Decides which node the next batch of tasks is sent to. A scheduler is
+    only used from the master node's event loop, and is told about nodes
+    joining and leaving and about every batch that completes, so that it can
+    keep its own statistics.
+
+    Subclasses implement choose_node, and may override the other hooks.
+    """
+
+    def add_node(self, node, node_info):
+        """
+        Called when a node is ready for tasks. node_info holds the node's
+        "cpu_count" and "slots".
+        """
+        pass
+
+    def remove_node(self, node):
+        """
+        Called when a node is dropped.
+        """
+        pass
+
+    def batch_completed(self, node, batch_size, service_time):
+        """
+        Called when a node completes a batch of batch_size tasks,
+        service_time seconds after the batch was sent to it.
+        """
+        pass
+
+    def choose_node(self, nodes, batch, queue_length):
+        """
+        Pick the node to send batch, the next queued batch, to. nodes maps
+        every node to its information: "cpu_count", "slots", "batches", the
+        batches it is running (keyed by batch id), and "load", the number of
+        tasks the node last reported running in a heartbeat. queue_length is
+        the number of queued batches, including this one.
+
+        Only a node with a free slot can be given the batch right away.
+        Choosing a node without one, or None, leaves the batch queued until
+        a slot frees up somewhere.
+
+        @returns one of the nodes, or None
+        """
+        raise NotImplementedError()
+
+class RoundRobinScheduler(Scheduler):
+    """
+    Send batches to the nodes with free slots in turn.
+    """
+
+    def __init__(self):
+        self.last_node = None
+
+    def choose_node(self, nodes, batch, queue_length):
+        node_list = list(nodes)
+
+        start_index = 0
+        if self.last_node in nodes:
+            start_index = node_list.index(self.last_node) + 1
+
+        for offset in range(len(node_list)):
+            node = node_list[(start_index + offset) % len(node_list)]
+
+            if get_free_slots(nodes[node]) > 0:
+                self.last_node = node
+
+                return node
+
+        return None
+
+class LeastLoadedScheduler(Scheduler):
+    """
+    Send each batch to the node with the fewest tasks in flight for its
+    number of CPUs, so that a node with twice the CPUs is given twice the
+    work.
+    """
+
+    def choose_node(self, nodes, batch, queue_length):
+        free_nodes = get_free_nodes(nodes)
+        if free_nodes == []:
+            return None
+
+        return min(free_nodes, key=lambda node: (get_tasks_in_flight(nodes[node]) / get_capacity(nodes[node]), -get_capacity(nodes[node])))
+
+class ServiceTimeScheduler(Scheduler):
+    """
+    Send each batch to the node expected to finish it first, going by an
+    exponentially weighted moving average of the time each node takes per
+    task. The time is measured from when a batch is sent to a node until
+    its completions are received, so it covers the network as well as the
+    node's speed. Nodes that have not completed a batch yet are tried first.
+
+    When only a few batches are left, a batch is held back for a busy node
+    if that node would finish it, and every other queued batch, before a
+    slow node with a free slot would finish this one batch. This keeps slow
+    nodes from holding up the end of a job.
+    """
+
+    def __init__(self, alpha=0.3):
+        self.alpha = alpha
+        self.service_times = {}
+
+    def remove_node(self, node):
+        self.service_times.pop(node, None)
+
+    def batch_completed(self, node, batch_size, service_time):
+        task_service_time = service_time / max(1, batch_size)
+
+        if node not in self.service_times:
+            self.service_times[node] = task_service_time
+        else:
+            self.service_times[node] += self.alpha * (task_service_time - self.service_times[node])
+
+    def get_service_time(self, node):
+        """
+        Return the average time node takes per task, in seconds, or None if
+        it has not completed a batch yet.
+        """
+        return self.service_times.get(node, None)
+
+    def choose_node(self, nodes, batch, queue_length):
+        best_node = None
+        best_finish_time = None
+
+        for node, node_info in nodes.items():
+            if get_free_slots(node_info) > 0:
+                finish_time = self.get_expected_finish_time(node, node_info, len(batch))
+            elif node in self.service_times:
+                finish_time = self.get_expected_finish_time(node, node_info, len(batch) * queue_length)
+            else:
+                continue
+
+            if best_finish_time == None or finish_time < best_finish_time:
+                best_node = node
+                best_finish_time = finish_time
+
+        return best_node
+
+    def get_expected_finish_time(self, node, node_info, new_tasks):
+        """
+        Estimate how long node would take to finish its tasks in flight and
+        new_tasks more, running them on all of its slots.
+        """
+        service_time = self.service_times.get(node, 0)
+
+        return service_time * (get_tasks_in_flight(node_info) + new_tasks) / node_info["slots"]
+
+SCHEDULERS = {
+    "round_robin" : RoundRobinScheduler,
+    "least_loaded" : LeastLoadedScheduler,
+    "service_time" : ServiceTimeScheduler,
+}
+
+def create_scheduler(scheduler):
+    """
+    Return a scheduler from a scheduler option: the name of a built-in
+    scheduler, or a Scheduler instance.
+    """
+    if isinstance(scheduler, Scheduler):
+        return scheduler
+
+    if scheduler not in SCHEDULERS:
+        raise ValueError("Unknown scheduler " + str(scheduler) + ", expected one of " + ", ".join(SCHEDULERS))
+
+    return SCHEDULERS[scheduler]()
+
+def get_free_nodes(nodes):
+    """
+    Return the nodes that have a free slot.
+    """
+    return [node for node, node_info in nodes.items() if get_free_slots(node_info) > 0]
+
+def get_free_slots(node_info):
+    """
+    Return how many more batches a node can be given right now.
+    """
+    return node_info["slots"] - len(node_info["batches"])
+
+def get_tasks_in_flight(node_info):
+    """
+    Return the number of tasks a node is running.
+    """
+    return sum(len(batch) for batch in node_info["batches"].values())
+
+def get_capacity(node_info):
+    """
+    Return the relative capacity of a node: its CPU count.
+    """
+    return max(1, node_info.get("cpu_count", 1) or 1)
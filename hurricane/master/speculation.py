@@ -0,0 +1,157 @@
+from collections import deque
+from collections import OrderedDict
+
+SPECULATION_PERCENTILE = 90
+SPECULATION_MULTIPLIER = 2.0
+SPECULATION_MIN_SAMPLES = 10
+LATENCY_WINDOW = 1000
+
+# How many completed speculations are remembered, to recognize the results
+# of their losing copies
+SPECULATION_HISTORY = 10000
+
+class Speculator:
+    """
+    Keeps track of how long tasks take, to pick out stragglers: batches
+    that have been running well past the usual time for their size. The
+    master node sends a copy of a straggler to another node and keeps the
+    result that arrives first. Once a copy has completed, the other copies
+    are left to run but no longer hold a slot on their nodes; the batch is
+    remembered for a while after, so that their late results can be
+    recognized and discarded.
+
+    A batch is only copied if none of its tasks opted out of speculative
+    execution.
+    """
+
+    def __init__(self, **kwargs):
+        self.percentile = kwargs.get('speculation_percentile', SPECULATION_PERCENTILE)
+        self.multiplier = kwargs.get('speculation_multiplier', SPECULATION_MULTIPLIER)
+        self.min_samples = kwargs.get('speculation_min_samples', SPECULATION_MIN_SAMPLES)
+
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.speculations = {}
+        self.completed_speculations = OrderedDict()
+        self.non_speculative_batches = set()
+
+        self.speculated_batches = 0
+        self.discarded_duplicates = 0
+
+    def record_latency(self, batch_size, latency):
+        """
+        Record that a batch of batch_size tasks completed latency seconds
+        after it was sent.
+        """
+        self.latencies.append(latency / max(1, batch_size))
+
+    def get_latency_threshold(self):
+        """
+        Return the time per task after which a task is considered a
+        straggler, or None if not enough tasks have completed to tell.
+        """
+        if len(self.latencies) < self.min_samples:
+            return None
+
+        latencies = sorted(self.latencies)
+        index = min(len(latencies) - 1, int(len(latencies) * self.percentile / 100))
+
+        return latencies[index] * self.multiplier
+
+    def disallow(self, batch_id):
+        """
+        Never send copies of the batch with batch_id.
+        """
+        self.non_speculative_batches.add(batch_id)
+
+    def is_straggler(self, batch_id, batch_size, elapsed, threshold):
+        """
+        Return whether a batch that has been running for elapsed seconds
+        should be copied to another node.
+        """
+        if batch_id in self.non_speculative_batches or batch_id in self.speculations:
+            return False
+
+        return elapsed > threshold * batch_size
+
+    def speculate(self, batch_id, original_node, copy_node):
+        """
+        Record that the batch running on original_node was copied to
+        copy_node.
+        """
+        self.speculations[batch_id] = {original_node, copy_node}
+        self.speculated_batches += 1
+
+    def is_speculative(self, batch_id):
+        """
+        Return whether more than one copy of a batch has been sent.
+        """
+        return batch_id in self.speculations
+
+    def get_nodes(self, batch_id):
+        """
+        Return the nodes copies of a batch are running on, or an empty set
+        if it is not being speculated.
+        """
+        return set(self.speculations.get(batch_id, ()))
+
+    def complete(self, batch_id, node):
+        """
+        Record that node sent back the results of a batch. The copies of the
+        batch on other nodes are no longer waited on.
+
+        @returns True if these are the first results of the batch, False if
+        they duplicate results that already arrived
+        """
+        self.non_speculative_batches.discard(batch_id)
+
+        if batch_id in self.completed_speculations:
+            self.discarded_duplicates += 1
+
+            return False
+
+        if self.speculations.pop(batch_id, None) != None:
+            self.completed_speculations[batch_id] = None
+
+            if len(self.completed_speculations) > SPECULATION_HISTORY:
+                self.completed_speculations.popitem(last=False)
+
+        return True
+
+    def lose(self, batch_id, node):
+        """
+        Record that the copy of a batch on node will not report back.
+
+        @returns True if the batch has completed or another copy of it is
+        still running, False if the batch is lost
+        """
+        if batch_id in self.completed_speculations:
+            return True
+
+        nodes = self.speculations.get(batch_id, None)
+        if nodes == None:
+            return False
+
+        nodes.discard(node)
+
+        if nodes == set():
+            del self.speculations[batch_id]
+
+            return False
+
+        return True
+
+    def forget(self, batch_id):
+        """
+        Forget a batch that was abandoned.
+        """
+        self.non_speculative_batches.discard(batch_id)
+
+    def get_stats(self):
+        """
+        Return the speculative execution counters.
+        """
+        return {
+            "speculated_batches" : self.speculated_batches,
+            "discarded_duplicates" : self.discarded_duplicates,
+            "running_speculations" : len(self.speculations),
+        }
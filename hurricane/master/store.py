@@ -0,0 +1,261 @@
+import os
+import atexit
+import shutil
+import logging
+import tempfile
+from time import monotonic
+from collections import OrderedDict
+from hurricane.utils.spill import spill_data
+from hurricane.utils.spill import remove_spill_file
+
+class CompletedTaskStore:
+    """
+    Holds completed tasks until they are claimed, indexed by task id so that
+    a task is claimed in O(1). Unclaimed tasks are evicted, oldest first,
+    once there are more than max_completed_tasks of them or they take up
+    more than max_completed_bytes, and after completed_task_ttl seconds. All
+    limits are off by default.
+
+    Tasks are sized by their generated data: its length if it is a
+    bytes-like object (or anything else supporting the buffer protocol),
+    and otherwise the share of the completion frame it arrived in, less the
+    length of the data the task was sent with if that is bytes-like.
+
+    With spill_threshold set, spill_results writes generated data of at
+    least spill_threshold bytes to a file in spill_directory (by default a
+    temporary directory) before the tasks are stored, and only a handle on
+    the file is kept in memory; spilled tasks do not count towards
+    max_completed_bytes. Spilling is off by default. When the master node
+    keeps a journal, spilled tasks are journaled by the path of their file,
+    so the files are kept when the process exits, in spill_directory or by
+    default in a directory next to the journal.
+
+    The store is not thread-safe by itself; the engine guards it with its
+    condition. spill_results only touches the tasks it is given, so it can
+    run in another thread without the condition.
+    """
+
+    def __init__(self, **kwargs):
+        self.max_count = kwargs.get('max_completed_tasks', None)
+        self.max_bytes = kwargs.get('max_completed_bytes', None)
+        self.ttl = kwargs.get('completed_task_ttl', None)
+        self.spill_threshold = kwargs.get('spill_threshold', None)
+        self.spill_directory = kwargs.get('spill_directory', None)
+        self.keep_spilled = kwargs.get('journal', None) != None
+
+        if self.spill_threshold != None and self.spill_directory == None and self.keep_spilled:
+            self.spill_directory = kwargs['journal'] + ".spill"
+            os.makedirs(self.spill_directory, exist_ok=True)
+        elif self.spill_threshold != None and self.spill_directory == None:
+            self.spill_directory = tempfile.mkdtemp(prefix="hurricane-spill-")
+
+            # Files of tasks that are still held at exit go with it
+            atexit.register(shutil.rmtree, self.spill_directory, True)
+
+        if self.spill_directory != None:
+            self.spill_directory = os.path.abspath(self.spill_directory)
+
+        self.tasks = OrderedDict()
+        self.total_bytes = 0
+
+        self.evictions = {"count" : 0, "bytes" : 0, "ttl" : 0}
+        self.evicted_bytes = 0
+
+        self.spilled_tasks = 0
+        self.spilled_bytes = 0
+        self.total_spilled_tasks = 0
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def __contains__(self, task_id):
+        return task_id in self.tasks
+
+    def add(self, task, size=0):
+        """
+        Store a completed task. size is the number of bytes its completion
+        took on the wire, used as its size for the byte limit if its
+        generated data is not bytes-like.
+        """
+        task_id = task.get_task_id()
+
+        if task_id in self.tasks:
+            self.remove(task_id)
+
+        size = get_result_size(task, size)
+
+        self.tasks[task_id] = (task, size, monotonic())
+        self.add_size(task, size, 1)
+
+        if task.is_spilled():
+            self.total_spilled_tasks += 1
+
+        self.evict()
+
+    def claim(self, task_id):
+        """
+        Remove and return the completed task with task_id.
+
+        @returns the task, or None if it has not completed (or was evicted)
+        """
+        self.evict()
+
+        if task_id not in self.tasks:
+            return None
+
+        return self.remove(task_id)
+
+    def claim_many(self, task_ids):
+        """
+        Remove and return every completed task whose id is in task_ids (a
+        set), looking through whichever of the two is smaller.
+
+        @returns the claimed tasks, in completion order when the store is
+        scanned and in task_ids order otherwise
+        """
+        self.evict()
+
+        if len(task_ids) < len(self.tasks):
+            ready_ids = [task_id for task_id in task_ids if task_id in self.tasks]
+        else:
+            ready_ids = [task_id for task_id in self.tasks if task_id in task_ids]
+
+        return [self.remove(task_id) for task_id in ready_ids]
+
+    def claim_oldest(self):
+        """
+        Remove and return the task that completed first.
+
+        @returns the task, or None if the store is empty
+        """
+        self.evict()
+
+        if not self.tasks:
+            return None
+
+        return self.remove(next(iter(self.tasks)))
+
+    def get_tasks(self):
+        """
+        Return (task, size) for every stored task, oldest first, without
+        claiming them.
+        """
+        return [(task, size) for task, size, completion_time in self.tasks.values()]
+
+    def remove(self, task_id):
+        """
+        Remove a task from the store and return it.
+        """
+        task, size, completion_time = self.tasks.pop(task_id)
+        self.add_size(task, size, -1)
+
+        return task
+
+    def add_size(self, task, size, sign):
+        """
+        Add (or, if sign is -1, remove) a task to the stored or spilled
+        totals.
+        """
+        if task.is_spilled():
+            self.spilled_tasks += sign
+            self.spilled_bytes += sign * size
+        else:
+            self.total_bytes += sign * size
+
+    def spill_results(self, tasks, size=0):
+        """
+        Spill the generated data of each of tasks that is at least
+        spill_threshold bytes to disk. size is the number of bytes each
+        task's completion took on the wire. A result that can not be
+        written is kept in memory.
+        """
+        if self.spill_threshold == None:
+            return
+
+        for task in tasks:
+            if task.is_spilled() or get_result_size(task, size) < self.spill_threshold:
+                continue
+
+            try:
+                task.set_spilled_data(spill_data(task.get_generated_data(), self.spill_directory, self.keep_spilled))
+            except OSError as err:
+                logging.error("Unable to spill the result of task " + str(task.get_task_id()) + " to disk: " + str(err))
+
+    def remove_stray_spill_files(self):
+        """
+        Remove the spill files in spill_directory that no stored task was
+        spilled to. A journaled master node leaves them behind when it stops
+        between spilling results and journaling them.
+        """
+        if self.spill_directory == None or not self.keep_spilled:
+            return
+
+        paths = set(task.get_spilled_data().get_path() for task, size, completion_time in self.tasks.values() if task.is_spilled())
+
+        for name in os.listdir(self.spill_directory):
+            path = os.path.join(self.spill_directory, name)
+
+            if name.startswith("result-") and name.endswith(".spill") and path not in paths:
+                remove_spill_file(path)
+
+    def evict(self):
+        """
+        Evict the oldest unclaimed tasks until the store is within its limits.
+        """
+        if self.ttl != None:
+            expiry_time = monotonic() - self.ttl
+
+            while self.tasks and next(iter(self.tasks.values()))[2] < expiry_time:
+                self.evict_oldest("ttl")
+
+        if self.max_count != None:
+            while len(self.tasks) > self.max_count:
+                self.evict_oldest("count")
+
+        if self.max_bytes != None:
+            while self.tasks and self.total_bytes > self.max_bytes:
+                self.evict_oldest("bytes")
+
+    def evict_oldest(self, reason):
+        """
+        Drop the oldest task, counting the eviction under reason.
+        """
+        task_id, (task, size, completion_time) = self.tasks.popitem(last=False)
+        self.add_size(task, size, -1)
+
+        self.evictions[reason] += 1
+        self.evicted_bytes += size
+
+    def get_stats(self):
+        """
+        Return the size of the store and its eviction counters.
+        """
+        return {
+            "stored" : len(self.tasks),
+            "stored_bytes" : self.total_bytes,
+            "evictions" : dict(self.evictions),
+            "evicted_bytes" : self.evicted_bytes,
+            "spilled" : self.spilled_tasks,
+            "spilled_bytes" : self.spilled_bytes,
+            "total_spilled" : self.total_spilled_tasks,
+        }
+
+def get_result_size(task, size):
+    """
+    Return the number of bytes the generated data of a task takes up: the
+    size of its file if it was spilled, its length if it supports the
+    buffer protocol, and otherwise size, less the length of the data the
+    task was sent with if it supports the buffer protocol.
+    """
+    if task.is_spilled():
+        return task.get_spilled_data().get_size()
+
+    try:
+        return memoryview(task.get_generated_data()).nbytes
+    except TypeError:
+        pass
+
+    try:
+        return max(0, size - memoryview(task.get_data()).nbytes)
+    except TypeError:
+        return size
@@ -1,6 +1,7 @@
 from .messages import Message
 from .messages import MessageTypes
 from .task_message import TaskMessage
+from .task_message import TaskBatchMessage
 from .heartbeat import HeartbeatMessage
 from .initialize_message import TaskManagementMessage
 from .initialize_message import NodeInitializeMessage
@@ -4,11 +4,67 @@ from hurricane.messages import MessageTypes
 class HeartbeatMessage(Message):
     """
     Simple heartbeat reminder that allows the master node to determine if
-    the slave node is still connected to the hurricane network
+    the slave node is still connected to the hurricane network. Heartbeats
+    a slave node sends also carry its node id, the number of tasks it is
+    running, and how often it sends heartbeats.
+
+    To measure the offset between the clocks of the two nodes, a heartbeat
+    can carry the monotonic time it was sent at; the master node answers it
+    with a heartbeat echoing that time along with the times it received
+    the heartbeat and sent the answer
     """
 
-    def __init__(self):
+    __slots__ = ("node_id", "tasks", "interval", "sent_time", "echo_time", "receive_time")
+
+    def __init__(self, node_id=None, tasks=0, interval=None, sent_time=None, echo_time=None, receive_time=None):
         """
         Initialize the HeartbeatMessage
         """
         super(HeartbeatMessage, self).__init__(MessageTypes.HEARTBEAT)
+
+        self.node_id = node_id
+        self.tasks = tasks
+        self.interval = interval
+        self.sent_time = sent_time
+        self.echo_time = echo_time
+        self.receive_time = receive_time
+
+    def get_node_id(self):
+        """
+        Return the id of the node that sent the heartbeat, if it is set
+        """
+        return self.node_id
+
+    def get_tasks(self):
+        """
+        Return the number of tasks the node is running
+        """
+        return self.tasks
+
+    def get_interval(self):
+        """
+        Return the number of seconds between the node's heartbeats, if it
+        is set
+        """
+        return self.interval
+
+    def get_sent_time(self):
+        """
+        Return the monotonic time of the sender when the heartbeat was sent,
+        if it is set
+        """
+        return self.sent_time
+
+    def get_echo_time(self):
+        """
+        Return the sent time of the heartbeat this heartbeat answers, if it
+        is an answer
+        """
+        return self.echo_time
+
+    def get_receive_time(self):
+        """
+        Return the monotonic time of the sender when the heartbeat this
+        heartbeat answers was received, if it is an answer
+        """
+        return self.receive_time
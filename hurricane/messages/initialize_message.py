@@ -3,18 +3,31 @@ from hurricane.messages import MessageTypes
 
 class TaskManagementMessage(Message):
     """
-    Simple initialization message which is sent to inform of the
-    task port and a task completion port
+    Simple initialization message which is sent to inform a node of the id
+    the master gave it and of the task completion port, of the compression
+    codecs the master node can use, and of the shared memory rings a node
+    on the same host as the master can attach to
     """
 
+    __slots__ = ("node_id", "task_port", "task_completion_port", "compression", "shared_memory")
+
     def __init__(self, **kwargs):
         """
         Initialize the InitializeMessage
         """
         super(TaskManagementMessage, self).__init__(MessageTypes.INITIALIZE_MSG)
 
+        self.node_id = kwargs.get("node_id", None)
         self.task_port = kwargs.get("task_port", None)
         self.task_completion_port = kwargs.get("task_completion_port", None)
+        self.compression = kwargs.get("compression", [])
+        self.shared_memory = kwargs.get("shared_memory", [])
+
+    def get_node_id(self):
+        """
+        Returns the id the master node gave the node.
+        """
+        return self.node_id
 
     def get_task_port(self):
         """
@@ -28,13 +41,29 @@ class TaskManagementMessage(Message):
         """
         return self.task_completion_port
 
+    def get_compression(self):
+        """
+        Returns the names of the compression codecs the master node can use,
+        in its order of preference.
+        """
+        return self.compression
+
+    def get_shared_memory(self):
+        """
+        Returns the names of the shared memory rings for tasks and for task
+        completions, or an empty list.
+        """
+        return self.shared_memory
+
 class NodeInitializeMessage(Message):
     """
     Initialization message that is sent from a slove node to a master
     node to provide necessary information
     """
 
-    def __init__(self, addr, cpu_count):
+    __slots__ = ("addr", "cpu_count", "slots", "compression", "shared_memory", "node_id", "task_port")
+
+    def __init__(self, addr, cpu_count, slots=1, compression=None, shared_memory=False, node_id=None, task_port=None):
         """
         Initialize the NodeInitializeMessage
         """
@@ -42,6 +71,11 @@ class NodeInitializeMessage(Message):
 
         self.addr = addr
         self.cpu_count = cpu_count
+        self.slots = slots
+        self.compression = compression
+        self.shared_memory = shared_memory
+        self.node_id = node_id
+        self.task_port = task_port
 
     def get_addr(self):
         """
@@ -54,3 +88,33 @@ class NodeInitializeMessage(Message):
         Returns the CPU count of the node
         """
         return self.cpu_count
+
+    def get_slots(self):
+        """
+        Returns the number of tasks the node can run at the same time
+        """
+        return self.slots
+
+    def get_compression(self):
+        """
+        Returns the name of the compression codec the node chose, or None
+        """
+        return self.compression
+
+    def get_shared_memory(self):
+        """
+        Returns whether the node attached to the master's shared memory rings
+        """
+        return self.shared_memory
+
+    def get_node_id(self):
+        """
+        Returns the id the master node gave the node
+        """
+        return self.node_id
+
+    def get_task_port(self):
+        """
+        Returns the port the node receives tasks on
+        """
+        return self.task_port
@@ -7,6 +7,7 @@ class Message(object):
     """
 
     __metaclass__ = ABCMeta
+    __slots__ = ("message",)
 
     def __init__(self, message):
         """
@@ -31,3 +32,4 @@ class MessageTypes:
     INITIALIZE_NODE    = "INITIALIZE_NODE"
 
     TASK               = "TASK"
+    TASK_BATCH         = "TASK_BATCH"
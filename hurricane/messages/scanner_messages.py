@@ -6,6 +6,8 @@ class NewNodeMessage(Message):
     Provides a wrapper class for new node identification
     """
 
+    __slots__ = ("addr", "task_port", "task_completion_port")
+
     def __init__(self, addr, task_port, task_completion_port):
         """
         Initialize the new node message
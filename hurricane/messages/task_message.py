@@ -7,16 +7,54 @@ class TaskMessage(Message):
     between nodes on a network
     """
 
-    def __init__(self, task):
+    __slots__ = ("task", "node_id")
+
+    def __init__(self, task, node_id=None):
         """
         Initialize the TaskMessage
         """
         super(TaskMessage, self).__init__(MessageTypes.TASK)
 
         self.task = task
+        self.node_id = node_id
 
     def get_task(self):
         """
         Return the task that this class is acting as a wrapper for
         """
         return self.task
+
+    def get_node_id(self):
+        """
+        Return the id of the node that sent the message, if it is set
+        """
+        return self.node_id
+
+class TaskBatchMessage(Message):
+    """
+    Provides a wrapper class for sending several tasks between nodes in a
+    single message
+    """
+
+    __slots__ = ("tasks", "node_id")
+
+    def __init__(self, tasks, node_id=None):
+        """
+        Initialize the TaskBatchMessage
+        """
+        super(TaskBatchMessage, self).__init__(MessageTypes.TASK_BATCH)
+
+        self.tasks = tasks
+        self.node_id = node_id
+
+    def get_tasks(self):
+        """
+        Return the tasks that this class is acting as a wrapper for
+        """
+        return self.tasks
+
+    def get_node_id(self):
+        """
+        Return the id of the node that sent the message, if it is set
+        """
+        return self.node_id
@@ -0,0 +1 @@
+from .relay import RelayNode
@@ -0,0 +1,169 @@
+import logging
+import threading
+from time import sleep
+from hurricane.utils import *
+from hurricane.master import MasterNode
+from hurricane.master import TaskFuture
+from hurricane.slave import SlaveNode
+
+# Seconds between checks of the number of slots in the relay's subtree
+RELAY_UPDATE_INTERVAL = 1.0
+
+class RelayNode:
+    """
+    A node that is a slave node to its parent master node and a master node
+    to a subtree of its own, so that a cluster can grow past what a single
+    master node can keep up with. Its subtree's slave nodes (or relay
+    nodes) find it on relay_port, just as they would find a master node.
+
+    Every batch the parent sends is split into up to one sub-batch for each
+    slot of the subtree, and the sub-batches are queued on the relay's own
+    master node, which schedules them over the subtree. Once every task of
+    the batch has completed, the completions are sent to the parent
+    together, as a single batch. The relay tells the parent it has as many
+    slots as its subtree, plus relay_prefetch, and keeps that up to date as
+    nodes join and leave the subtree.
+
+    Tasks the parent sends again while the relay is still running them (for
+    example after it missed the relay's heartbeats) are not relayed a
+    second time; the copies already running complete them.
+
+    Options are passed on to both the slave node and the master node, except
+    that the master node listens on relay_port instead of initialize_port.
+    """
+
+    def __init__(self, **kwargs):
+        self.initialize_port = kwargs.get('initialize_port', 12222)
+        self.relay_port = kwargs.get('relay_port', self.initialize_port + 3)
+        self.relay_prefetch = kwargs.get('relay_prefetch', 0)
+
+        master_options = dict(kwargs)
+        master_options["initialize_port"] = self.relay_port
+
+        self.master = MasterNode(**master_options)
+        self.slave = SlaveNode(**kwargs)
+
+        self.relayed_task_ids = set()
+        self.relay_lock = threading.Lock()
+
+        self.relayed_batches = 0
+        self.relayed_tasks = 0
+        self.duplicate_tasks = 0
+
+    def initialize(self):
+        """
+        Start the relay's master node and find the parent master node.
+        """
+        logging.info("Initializing the relay node on port " + str(self.relay_port))
+
+        self.master.initialize()
+        self.slave.initialize()
+
+    def stop(self):
+        """
+        Stop the relay's master node, abandoning the tasks in its subtree.
+        """
+        self.slave.stop_sending_completions()
+        self.master.stop()
+
+    def serve(self):
+        """
+        Relay every batch the parent sends to the subtree, and its
+        completions back. This method does not return.
+        """
+        self.slave.wait_for_initialize()
+        self.slave.start_sending_completions()
+
+        update_thread = threading.Thread(target=self.update_slots)
+        update_thread.daemon = True
+        update_thread.start()
+
+        while True:
+            self.relay_batch(self.slave.wait_for_tasks())
+
+    def relay_batch(self, tasks):
+        """
+        Split a batch from the parent into sub-batches and queue them on the
+        relay's master node. Tasks that are already being relayed are left
+        out.
+        """
+        with self.relay_lock:
+            new_tasks = [task for task in tasks if task.get_task_id() not in self.relayed_task_ids]
+            self.relayed_task_ids.update(task.get_task_id() for task in new_tasks)
+
+            self.duplicate_tasks += len(tasks) - len(new_tasks)
+
+        tasks = new_tasks
+        if tasks == []:
+            return
+
+        count = min(len(tasks), max(1, self.master.engine.get_slot_count()))
+        size, extra = divmod(len(tasks), count)
+
+        batches = []
+        futures = {}
+        start = 0
+
+        for index in range(count):
+            end = start + size + (1 if index < extra else 0)
+            batch = [Task(task_id=task.get_task_id(), return_port=self.master.engine.task_completion_port, data=task.get_data()) for task in tasks[start:end]]
+
+            for task in batch:
+                futures[task.get_task_id()] = TaskFuture(task.get_task_id())
+
+            # The futures of a batch are resolved in order, so the whole
+            # sub-batch is done once its last future is
+            batch_futures = [futures[task.get_task_id()] for task in batch]
+            batch_futures[-1].add_done_callback(lambda future, batch_futures=batch_futures: self.finish_batch(batch_futures))
+
+            batches.append(batch)
+            start = end
+
+        self.relayed_batches += 1
+        self.relayed_tasks += len(tasks)
+
+        self.master.engine.submit(batches, futures)
+
+    def finish_batch(self, futures):
+        """
+        Complete the tasks of a sub-batch on the slave side. The slave node
+        sends a batch back to the parent once all of its tasks are complete.
+        Runs on the relay's master node's event loop thread.
+        """
+        with self.relay_lock:
+            self.relayed_task_ids.difference_update(future.get_task_id() for future in futures)
+
+        for future in futures:
+            task = future.result() if not future.cancelled() else None
+
+            if task == None:
+                self.slave.finish_task(task_id=future.get_task_id(), generated_data=None)
+
+                continue
+
+            timings = task.get_timings() or {}
+            self.slave.finish_task(task_id=task.get_task_id(), generated_data=task.get_generated_data(), started=timings.get("started", None), finished=timings.get("finished", None))
+
+    def update_slots(self):
+        """
+        Keep the number of slots the parent sees equal to the number of
+        slots in the subtree. Runs in a background thread.
+        """
+        while True:
+            try:
+                self.slave.set_slots(max(1, self.master.engine.get_slot_count() + self.relay_prefetch))
+            except OSError as err:
+                logging.error("Unable to update the relay's slots on the parent master node: " + str(err))
+
+            sleep(RELAY_UPDATE_INTERVAL)
+
+    def get_stats(self):
+        """
+        Return statistics about the relay's master node, with the number of
+        batches and tasks relayed, and of tasks the parent sent again while
+        they were being relayed.
+        """
+        stats = self.master.get_stats()
+        stats["relay"] = {"relayed_batches" : self.relayed_batches, "relayed_tasks" : self.relayed_tasks, "duplicate_tasks" : self.duplicate_tasks}
+
+        return stats
@@ -1,12 +1,31 @@
+import os
 import socket
+import select
+import struct
 import errno
 import multiprocessing
+import threading
+import queue
 import logging
 from time import sleep
+from time import monotonic
+from functools import partial
+from multiprocessing.pool import ThreadPool
+from collections import deque
 from hurricane.utils import *
 from hurricane.messages import HeartbeatMessage
 from hurricane.messages import TaskMessage
+from hurricane.messages import TaskBatchMessage
 from hurricane.messages import NodeInitializeMessage
+from hurricane.utils.compression import COMPRESSION_THRESHOLD
+from hurricane.utils.compression import CompressionStats
+from hurricane.utils.compression import choose_codec
+from hurricane.utils.compression import get_codec
+from hurricane.utils.sharedMemory import attach_shared_memory_rings
+from hurricane.utils.discovery import wait_for_beacon
+from hurricane.utils.discovery import probe_hosts
+from hurricane.utils.discovery import get_local_addresses
+from hurricane.utils.clock import ClockOffset
 
 
 class SlaveNode:
@@ -16,13 +35,35 @@ class SlaveNode:
         self.initialize_port = kwargs.get('initialize_port', 12222)
         self.master_node_address = kwargs.get('master_node', '')
         self.max_disconnects = kwargs.get('max_disconnect_errors', 4)
+        self.slots = kwargs.get('slots', 1)
+        self.compression = kwargs.get('compression', None)
+        self.compression_threshold = kwargs.get('compression_threshold', COMPRESSION_THRESHOLD)
+        self.shared_memory = kwargs.get('shared_memory', True)
+        self.return_task_data = kwargs.get('return_task_data', True)
+        self.beacon_timeout = kwargs.get('beacon_timeout', 0.5)
+        self.heartbeat_interval = kwargs.get('heartbeat_interval', 0.25)
 
         self.is_initialized = False
-        self.task_port = self.initialize_port + 1
-        self.task_completion_port = self.task_port + 1
+        self.node_id = None
+        self.task_port = kwargs.get('task_port', 0)
+        self.task_completion_port = self.initialize_port + 2
         self.task_socket = None
+        self.task_connection = None
         self.scanning_process = None
         self.current_task = None
+        self.current_tasks = {}
+        self.received_tasks = deque()
+        self.task_lock = threading.Lock()
+        self.completion_connection = None
+        self.completion_lock = threading.Lock()
+        self.heartbeat_process = None
+        self.heartbeat_tasks = multiprocessing.Value('i', 0, lock=False)
+        self.completion_queue = None
+        self.clock = ClockOffset()
+        self.codec = None
+        self.compression_stats = CompressionStats()
+        self.task_ring = None
+        self.completion_ring = None
         self.scanner_input, self.scanner_output= multiprocessing.Pipe()
 
         logging.basicConfig(format="%(asctime)s %(name)s [%(levelname)s] %(message)s", level=kwargs.get("level", logging.INFO))
@@ -60,25 +101,77 @@ class SlaveNode:
                 try:
                     self.master_node_address = data["address"]
                 except:
-                    self.task_port = data.get_task_port()
+                    self.node_id = data.get_node_id()
                     self.task_completion_port = data.get_task_completion_port()
-                    self.task_socket = create_listen_socket_timer(self.task_port, 1, 5)
+
+                    if self.task_socket == None:
+                        self.task_socket = create_listen_socket_timer(self.task_port, 1, 5)
+
+                    codec_name = choose_codec(data.get_compression(), self.compression)
+                    if codec_name != None:
+                        logging.info("Compressing large messages to the master node with " + codec_name)
+
+                        self.codec = get_codec(codec_name)
+                    else:
+                        self.codec = None
+
+                    self.attach_shared_memory(data.get_shared_memory())
 
             self.scanning_process.terminate()
 
         if self.master_node_address != '':
             logging.info("Sending initialization information to the master node")
 
-            completion_socket = create_active_socket(self.master_node_address, self.task_completion_port)
-            completion_socket.send(encode_data(NodeInitializeMessage((None), multiprocessing.cpu_count())))
+            with self.completion_lock:
+                self.close_completion_connection()
+
+            self.send_node_initialize()
+
+            if self.heartbeat_interval != None:
+                self.start_heartbeats()
 
             return True
 
         return False
 
+    def send_node_initialize(self):
+        """
+        Tell the master node that this node is ready for tasks, with its
+        number of slots and the port it receives tasks on.
+        """
+        self.send_to_master(encode_data(NodeInitializeMessage((None), multiprocessing.cpu_count(), self.slots, self.get_codec_name(), self.task_ring != None, self.node_id, self.task_socket.getsockname()[1])))
+
+    def set_slots(self, slots):
+        """
+        Change the number of tasks the master node keeps in flight on this
+        node.
+        """
+        if slots == self.slots:
+            return
+
+        self.slots = slots
+
+        if self.node_id != None and self.task_socket != None:
+            self.send_node_initialize()
+
     def wait_for_task(self, timeout=5):
         """
-        Wait for a task to be sent on the data port.
+        Wait for a task to be sent on the data port. Tasks that arrive
+        together in a batch are returned one at a time.
+        """
+        if not self.received_tasks:
+            self.received_tasks.extend(self.wait_for_tasks(timeout))
+
+        self.current_task = self.received_tasks.popleft()
+        self.current_task.record_timing("started")
+
+        return self.current_task.get_data()
+
+    def wait_for_tasks(self, timeout=5):
+        """
+        Wait for the next task or batch of tasks to be sent on the data port.
+
+        @returns the list of tasks received
         """
         self.wait_for_initialize()
 
@@ -86,22 +179,46 @@ class SlaveNode:
         while True:
             if self.task_socket:
                 try:
-                    logging.info("Waiting to receive a new task on port " + str(self.task_port))
+                    if self.task_connection == None:
+                        logging.info("Waiting to receive a new task on port " + str(self.task_socket.getsockname()[1]))
 
-                    c, addr = self.task_socket.accept()
-                    current_task = read_data(c)
+                        self.task_connection, self.task_connection_addr = self.task_socket.accept()
+                        self.task_connection.settimeout(timeout)
 
-                    if not isinstance(current_task, HeartbeatMessage):
-                        self.current_task = current_task
+                    readable, _, _ = select.select([self.task_connection], [], [], timeout)
+                    if readable == []:
+                        raise socket.timeout("timed out")
 
-                        logging.info("Received a new task " + str(self.current_task.get_task_id()) + " from " + str(addr))
+                    data = read_data(self.task_connection, self.compression_stats, {self.node_id : self.task_ring})
+                    addr = self.task_connection_addr
 
-                        return self.current_task.get_data()
-                    else:
+                    if isinstance(data, HeartbeatMessage):
                         logging.info("Heartbeat received from " + str(addr))
 
                         num_disconnects = 0
+                    else:
+                        if isinstance(data, TaskBatchMessage):
+                            tasks = data.get_tasks()
+
+                            logging.info("Received a batch of " + str(len(tasks)) + " tasks from " + str(addr))
+                        else:
+                            tasks = [data]
+
+                            logging.info("Received a new task " + str(data.get_task_id()) + " from " + str(addr))
+
+                        received_time = monotonic()
+                        for task in tasks:
+                            task.timings = {"received" : received_time}
+
+                        self.add_batch(tasks)
+
+                        return tasks
                 except socket.error as err:
+                    if self.task_connection != None and err.args[0] != "timed out":
+                        logging.error("Connection with the master node was closed")
+
+                        self.close_task_connection()
+
                     if num_disconnects > self.max_disconnects:
                         logging.info("Attempting to reconnect to master node")
                         self.scanning_process = multiprocessing.Process(target=self.complete_network_scan)
@@ -126,36 +243,322 @@ class SlaveNode:
                     self.scanning_process.start()
                     self.is_initialized = False
 
+                    self.close_task_connection()
                     if self.task_socket:
                         self.task_socket.close()
+                        self.task_socket = None
                     self.wait_for_initialize()
                     num_disconnects = 0
+            else:
+                sleep(0.1)
 
-            sleep(0.1)
+    def close_task_connection(self):
+        """
+        Close the stream tasks are received on, if one is open.
+        """
+        if self.task_connection != None:
+            try:
+                self.task_connection.close()
+            except socket.error:
+                pass
+
+            self.task_connection = None
+
+    def add_batch(self, tasks):
+        """
+        Keep track of a batch of received tasks until all of them have been
+        completed.
+        """
+        batch = {"tasks" : tasks, "remaining" : len(tasks)}
+
+        with self.task_lock:
+            for task in tasks:
+                self.current_tasks[task.get_task_id()] = (task, batch)
+
+            self.heartbeat_tasks.value = len(self.current_tasks)
 
     def finish_task(self, **kwargs):
         """
-        Send the task completion data back to the master node.
+        Send the task completion data back to the master node. When several
+        tasks are running at once, task_id selects the task being completed;
+        by default it is the task most recently returned by wait_for_task.
+
+        Tasks that were sent as a batch are reported back together, once the
+        last task of the batch has been completed. started and finished
+        optionally give the monotonic times the task was started and
+        finished at, if it did not run between wait_for_task returning it
+        and this call.
         """
-        if self.current_task != None:
-            logging.info("Completed task " + str(self.current_task.get_task_id()))
+        task_id = kwargs.get('task_id', None)
+        if task_id == None and self.current_task != None:
+            task_id = self.current_task.get_task_id()
 
-            self.current_task.set_generated_data(kwargs.get('generated_data', None))
+        with self.task_lock:
+            task, batch = self.current_tasks.pop(task_id, (None, None))
+            self.heartbeat_tasks.value = len(self.current_tasks)
 
-            completion_socket = create_active_socket(self.master_node_address, self.task_completion_port)
-            completion_socket.send(encode_data(TaskMessage(self.current_task)))
-        else:
+            if task != None:
+                task.set_generated_data(kwargs.get('generated_data', None))
+                task.record_timing("finished", kwargs.get('finished', None))
+                if kwargs.get('started', None) != None:
+                    task.record_timing("started", kwargs['started'])
+
+                batch["remaining"] -= 1
+
+        if task == None:
             logging.error("No task to complete")
+        elif batch["remaining"] == 0 and self.completion_queue != None:
+            self.completion_queue.put(batch["tasks"])
+        elif batch["remaining"] == 0:
+            self.send_completions(batch["tasks"])
+
+    def send_completions(self, tasks):
+        """
+        Send a completed task, or a completed batch of tasks, to the master
+        node in a single message. The data the tasks were sent with is left
+        out unless return_task_data is set. The times recorded for the
+        tasks are converted to the master node's clock.
+        """
+        sent_time = monotonic()
+        for task in tasks:
+            task.record_timing("sent", sent_time)
+            task.timings = {stage : self.clock.to_master_time(time) for stage, time in task.timings.items()}
+
+            if not self.return_task_data:
+                task.data = None
+
+        if len(tasks) == 1:
+            logging.info("Completed task " + str(tasks[0].get_task_id()))
+
+            message = TaskMessage(tasks[0], self.node_id)
+        else:
+            logging.info("Completed a batch of " + str(len(tasks)) + " tasks")
+
+            message = TaskBatchMessage(tasks, self.node_id)
+
+        message = compress_message(encode_data(message), self.codec, self.compression_threshold, self.compression_stats)
+
+        completion_ring = self.completion_ring
+        if completion_ring != None:
+            descriptor_message = write_shared_memory_frame(message, completion_ring, self.node_id)
+
+            if descriptor_message != None:
+                message = descriptor_message
+
+        try:
+            self.send_to_master(message)
+        except socket.error:
+            # The master node will never read the record the message points
+            # to, if it was written to the shared memory ring
+            if completion_ring != None and completion_ring is self.completion_ring:
+                release_shared_memory_frame(message, completion_ring)
+
+            raise
+
+    def send_to_master(self, message):
+        """
+        Send an encoded message to the master node's task completion port,
+        over a connection that is kept open between messages. If the
+        connection has been closed, it is opened again and the message is
+        sent once more.
+        """
+        with self.completion_lock:
+            is_new_connection = self.completion_connection == None
+
+            try:
+                if is_new_connection:
+                    self.completion_connection = create_active_socket(self.master_node_address, self.task_completion_port)
+
+                send_buffers(self.completion_connection, message)
+            except socket.error:
+                self.close_completion_connection()
+
+                if is_new_connection:
+                    raise
+
+                self.completion_connection = create_active_socket(self.master_node_address, self.task_completion_port)
+                send_buffers(self.completion_connection, message)
+
+    def start_heartbeats(self):
+        """
+        Start sending heartbeats to the master node, with the current node
+        id, from a separate process. A task handler that holds the GIL for
+        a long time would starve a thread of this process, and the master
+        node would take the node for dead while it is busy.
+        """
+        if self.heartbeat_process != None:
+            self.heartbeat_process.terminate()
+            self.heartbeat_process.join()
+
+        self.heartbeat_process = multiprocessing.Process(target=send_heartbeats, args=(self.node_id, self.master_node_address, self.task_completion_port, self.heartbeat_interval, self.heartbeat_tasks, self.clock.offset, os.getpid()))
+        self.heartbeat_process.daemon = True
+        self.heartbeat_process.start()
+
+    def close_completion_connection(self):
+        """
+        Close the connection to the master node's task completion port, if
+        one is open.
+        """
+        if self.completion_connection != None:
+            try:
+                self.completion_connection.close()
+            except socket.error:
+                pass
+
+            self.completion_connection = None
+
+    def attach_shared_memory(self, names):
+        """
+        Attach to the shared memory rings the master node created for this
+        node, if it is on the same host. Rings from an earlier master
+        connection are detached first.
+        """
+        for ring in [self.task_ring, self.completion_ring]:
+            if ring != None:
+                ring.close()
+
+        self.task_ring = None
+        self.completion_ring = None
+
+        if not self.shared_memory or names == []:
+            return
+
+        rings = attach_shared_memory_rings(names)
+        if rings != None:
+            logging.info("Exchanging tasks with the master node through shared memory")
+
+            self.task_ring, self.completion_ring = rings
+
+    def get_codec_name(self):
+        """
+        Return the name of the compression codec chosen with the master
+        node, or None.
+        """
+        if self.codec == None:
+            return None
+
+        return self.codec.get_name()
+
+    def get_stats(self):
+        """
+        Return statistics about the slave node.
+        """
+        return {"compression" : self.compression_stats.get_stats()}
+
+    def serve(self, handler, workers=None, prefetch=0, executor="process"):
+        """
+        Run handler(task_data) for every task sent to this node, and send its
+        return value back as the task's generated data. Batches are run by a
+        local pool of workers processes (or threads, if executor is
+        "thread"), by default one per slot. This method does not return.
+
+        The master node is asked to keep prefetch more batches on this node
+        than there are workers, so that a worker that finishes a batch
+        starts on the next one without waiting for the network. Results are
+        sent back by a separate thread, so workers never wait for them to
+        be sent either.
+
+        A process pool runs handler in other processes, so handler must be
+        picklable (i.e. defined at module level). A thread pool suits
+        handlers that release the GIL or wait on I/O.
+        """
+        if executor not in ["process", "thread"]:
+            raise ValueError("Unknown executor " + str(executor) + ", expected \"process\" or \"thread\"")
+
+        workers = max(1, workers or self.slots)
+
+        self.wait_for_initialize()
+        self.set_slots(workers + max(0, prefetch))
+
+        pool = multiprocessing.Pool(workers) if executor == "process" else ThreadPool(workers)
+
+        self.start_sending_completions()
+
+        try:
+            while True:
+                tasks = self.wait_for_tasks()
+                task_ids = [task.get_task_id() for task in tasks]
+
+                pool.apply_async(run_batch, (handler, task_ids, [task.get_data() for task in tasks]), callback=partial(self.finish_served_tasks, task_ids), error_callback=partial(self.fail_served_tasks, task_ids))
+        finally:
+            pool.terminate()
+
+            self.stop_sending_completions()
+
+    def start_sending_completions(self):
+        """
+        Send completed batches from a background thread from now on, so that
+        finish_task never waits on the network.
+        """
+        self.completion_queue = queue.Queue()
+
+        completion_thread = threading.Thread(target=self.send_queued_completions, args=(self.completion_queue,))
+        completion_thread.daemon = True
+        completion_thread.start()
+
+    def stop_sending_completions(self):
+        """
+        Send completed batches from the thread finishing them again, once
+        the background thread has sent those already queued.
+        """
+        if self.completion_queue != None:
+            self.completion_queue.put(None)
+            self.completion_queue = None
+
+    def send_queued_completions(self, completion_queue):
+        """
+        Send the completed batches put on completion_queue to the master
+        node, until None is put on it. Runs in a background thread.
+        """
+        while True:
+            tasks = completion_queue.get()
+            if tasks == None:
+                return
+
+            try:
+                self.send_completions(tasks)
+            except socket.error as err:
+                logging.error("Unable to send completions to the master node: " + str(err))
+
+    def finish_served_tasks(self, task_ids, results):
+        """
+        Complete a batch run by serve (called from the pool's result thread).
+        """
+        generated_data, execution_times = results
+
+        for task_id, task_generated_data, (started, finished) in zip(task_ids, generated_data, execution_times):
+            self.finish_task(task_id=task_id, generated_data=task_generated_data, started=started, finished=finished)
+
+    def fail_served_tasks(self, task_ids, err):
+        """
+        Complete a batch that could not be run, so its slot on the master is
+        freed (called from the pool's result thread).
+        """
+        logging.error("Batch starting with task " + str(task_ids[0]) + " failed with \"" + str(err) + "\"")
+
+        for task_id in task_ids:
+            self.finish_task(task_id=task_id, generated_data=None)
 
     def complete_network_scan(self):
         """
-        Scan the local network & determine all of the active IP addresses.
+        Find the master node & get the ports to use from it. Unless its
+        address is known, the master node is found by listening for its
+        beacon, or else by trying to connect to every address on the local
+        network at once.
         """
         while True:
-            # Scan the network (if necessary)
+            initialize_socket = None
+
+            # Find the master node (if necessary)
             if self.master_node_address == '':
-                logging.info("Scanning the network to identify active hosts")
-                ip_addresses = simple_scan_network()
+                logging.info("Listening for the master node's beacon")
+                address = wait_for_beacon(self.initialize_port, self.beacon_timeout)
+
+                if address == None:
+                    logging.info("Probing the network to identify the master node")
+                    address, initialize_socket = probe_hosts(self.get_candidate_addresses(), self.initialize_port)
+
+                ip_addresses = [address] if address != None else []
             else:
                 ip_addresses = [self.master_node_address]
 
@@ -164,7 +567,9 @@ class SlaveNode:
                 logging.info("Attempting to connect to " + str(address))
 
                 try:
-                    initialize_socket = create_active_socket(address, self.initialize_port)
+                    if initialize_socket == None:
+                        initialize_socket = create_active_socket(address, self.initialize_port)
+
                     data = read_data(initialize_socket)
                     initialize_socket.close()
 
@@ -173,13 +578,100 @@ class SlaveNode:
                     # Send the address of the master node to the parent thread
                     self.scanner_output.send({"address" : address})
 
-                    logging.info("Updated data port to port number " + str(data.get_task_port()))
+                    logging.info("Identified by the master node as node " + str(data.get_node_id()))
 
-                    # Update the data port
+                    # Update the node id and ports
                     self.scanner_output.send(data)
 
                     return
                 except:
+                    if initialize_socket != None:
+                        initialize_socket.close()
+                        initialize_socket = None
+
                     continue
 
             sleep(1)
+
+    def get_candidate_addresses(self):
+        """
+        Return the addresses to probe for the master node.
+        """
+        addresses = get_local_addresses()
+        known_addresses = set(addresses)
+
+        addresses.extend(address for address in simple_scan_network() if address not in known_addresses)
+
+        return addresses
+
+def send_heartbeats(node_id, master_node_address, task_completion_port, heartbeat_interval, tasks, clock_offset, parent_pid):
+    """
+    Send a heartbeat with the number of tasks the node is running (read from
+    the shared value tasks) to the master node over UDP every
+    heartbeat_interval seconds, so that the master node notices quickly if
+    the node fails. The master node's answers are used to keep track of the
+    offset between its clock and the node's, which is shared through
+    clock_offset. Runs in a separate process, which exits once the node's
+    process (parent_pid) is gone.
+    """
+    heartbeat_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    clock = ClockOffset(offset=clock_offset)
+
+    try:
+        while os.getppid() == parent_pid:
+            next_heartbeat = monotonic() + heartbeat_interval
+
+            try:
+                heartbeat_socket.sendto(encode_datagram(HeartbeatMessage(node_id, tasks.value, heartbeat_interval, monotonic())), (master_node_address, task_completion_port))
+            except OSError:
+                pass
+
+            while monotonic() < next_heartbeat:
+                readable, _, _ = select.select([heartbeat_socket], [], [], max(0, next_heartbeat - monotonic()))
+                if readable == []:
+                    break
+
+                receive_heartbeat_answer(heartbeat_socket, clock)
+    finally:
+        heartbeat_socket.close()
+
+def receive_heartbeat_answer(heartbeat_socket, clock):
+    """
+    Read the master node's answer to a heartbeat, and measure the offset
+    between the clocks with it.
+    """
+    try:
+        datagram, addr = heartbeat_socket.recvfrom(1024)
+        receive_time = monotonic()
+
+        data = decode_datagram(datagram)
+    except (OSError, ValueError, struct.error):
+        return
+
+    if isinstance(data, HeartbeatMessage) and data.get_echo_time() != None:
+        clock.add_sample(data.get_echo_time(), data.get_receive_time(), data.get_sent_time(), receive_time)
+
+def run_batch(handler, task_ids, batch_data):
+    """
+    Run handler over the data of a batch of tasks (in a pool process). A task
+    whose handler raises generates None, and the rest of the batch still runs.
+
+    @returns the generated data of each task, and the monotonic times each
+    task was started and finished at
+    """
+    generated_data = []
+    execution_times = []
+
+    for task_id, task_data in zip(task_ids, batch_data):
+        started = monotonic()
+
+        try:
+            generated_data.append(handler(task_data))
+        except Exception as err:
+            logging.error("Task " + str(task_id) + " raised \"" + str(err) + "\"")
+
+            generated_data.append(None)
+
+        execution_times.append((started, monotonic()))
+
+    return generated_data, execution_times
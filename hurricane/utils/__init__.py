@@ -1,5 +1,8 @@
 from .messages import *
 from .networkScanner import *
 from .socketWrappers import *
+from .connectionPool import ConnectionPool
+from .compression import register_codec
+from .sharedMemory import SharedMemoryRing
 from .id import generate_task_id
 from .task import Task
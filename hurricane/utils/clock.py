@@ -0,0 +1,50 @@
+import multiprocessing
+from collections import deque
+
+CLOCK_SAMPLES = 16
+
+class ClockOffset:
+    """
+    Estimates the offset between this node's monotonic clock and the master
+    node's, from the timestamps of heartbeat round trips, as NTP does: the
+    slave node stamps a heartbeat when it sends it (t0), the master node
+    stamps it when it arrives (t1) and stamps its reply when it sends it
+    (t2), and the slave node stamps the reply when it arrives (t3). The
+    round trip with the shortest delay out of the last CLOCK_SAMPLES gives
+    the most accurate offset, since it was held up the least on the way.
+
+    Until a round trip has completed the offset is 0, which is exact for a
+    master node on the same host.
+
+    The offset is kept in a shared value, so that the heartbeats can be
+    sent and timed in another process: a ClockOffset created there with the
+    offset of this one updates it.
+    """
+
+    def __init__(self, samples=CLOCK_SAMPLES, offset=None):
+        self.samples = deque(maxlen=samples)
+        self.offset = offset if offset != None else multiprocessing.Value('d', 0.0, lock=False)
+
+    def add_sample(self, sent_time, master_receive_time, master_send_time, receive_time):
+        """
+        Record the four timestamps of a heartbeat round trip.
+        """
+        delay = (receive_time - sent_time) - (master_send_time - master_receive_time)
+        offset = ((master_receive_time - sent_time) + (master_send_time - receive_time)) / 2
+
+        self.samples.append((delay, offset))
+        self.offset.value = min(self.samples)[1]
+
+    def get_offset(self):
+        """
+        Return the number of seconds to add to this node's monotonic clock
+        to get the master node's.
+        """
+        return self.offset.value
+
+    def to_master_time(self, local_time):
+        """
+        Convert a monotonic timestamp of this node to the master node's
+        clock.
+        """
+        return local_time + self.offset.value
@@ -0,0 +1,187 @@
+import zlib
+import threading
+
+try:
+    import bz2
+except ImportError:
+    bz2 = None
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+# Frames larger than this are compressed when a codec has been negotiated
+COMPRESSION_THRESHOLD = 16 * 1024
+
+# Codec ids are written in the upper four bits of a frame's flags, so they
+# range from 1 to 15 and must be the same on every node
+MAX_CODEC_ID = 15
+
+CODECS_BY_NAME = {}
+CODECS_BY_ID = {}
+
+class Codec:
+    """
+    A named pair of compress/decompress functions, each taking and
+    returning a bytes-like object.
+    """
+
+    def __init__(self, codec_id, name, compress, decompress):
+        self.codec_id = codec_id
+        self.name = name
+        self.compress = compress
+        self.decompress = decompress
+
+    def get_codec_id(self):
+        """
+        Return the id written in the frames this codec compresses
+        """
+        return self.codec_id
+
+    def get_name(self):
+        """
+        Return the name the codec is negotiated with
+        """
+        return self.name
+
+def register_codec(codec_id, name, compress, decompress):
+    """
+    Make a compression codec available to the nodes of this process. Codecs
+    are negotiated by name, so a codec has to be registered with the same
+    name and id on both the master and the slave nodes.
+
+    @returns the registered Codec
+    """
+    if codec_id < 1 or codec_id > MAX_CODEC_ID:
+        raise ValueError("Codec ids must be between 1 and " + str(MAX_CODEC_ID))
+
+    codec = Codec(codec_id, name, compress, decompress)
+
+    CODECS_BY_NAME[name] = codec
+    CODECS_BY_ID[codec_id] = codec
+
+    return codec
+
+def get_codec(name):
+    """
+    Return the registered codec called name.
+    """
+    if name not in CODECS_BY_NAME:
+        raise ValueError("Unknown compression codec " + str(name))
+
+    return CODECS_BY_NAME[name]
+
+def get_codec_by_id(codec_id):
+    """
+    Return the registered codec with codec_id.
+    """
+    if codec_id not in CODECS_BY_ID:
+        raise ValueError("Unknown compression codec id " + str(codec_id))
+
+    return CODECS_BY_ID[codec_id]
+
+def get_codec_names(names):
+    """
+    Normalize a compression option (None, a codec name, or a list of codec
+    names in order of preference) to a list of codec names.
+    """
+    if names == None:
+        return []
+    elif isinstance(names, str):
+        return [names]
+
+    return list(names)
+
+def choose_codec(offered, accepted=None):
+    """
+    Pick the codec to use from the codecs offered by the master node, in
+    its order of preference. accepted restricts the choice to some codecs;
+    by default any registered codec can be chosen.
+
+    @returns the name of the chosen codec, or None if there is none
+    """
+    for name in get_codec_names(offered):
+        if name in CODECS_BY_NAME and (accepted == None or name in get_codec_names(accepted)):
+            return name
+
+    return None
+
+class CompressionStats:
+    """
+    Counts how much data went through compression, to report compression
+    ratios. Frames are compressed on several threads, so updates are locked.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+        self.compressed_frames = 0
+        self.incompressible_frames = 0
+        self.bytes_before_compression = 0
+        self.bytes_after_compression = 0
+
+        self.decompressed_frames = 0
+        self.bytes_before_decompression = 0
+        self.bytes_after_decompression = 0
+
+    def record_compression(self, raw_size, compressed_size):
+        """
+        Record a frame compressed from raw_size to compressed_size bytes
+        """
+        with self.lock:
+            self.compressed_frames += 1
+            self.bytes_before_compression += raw_size
+            self.bytes_after_compression += compressed_size
+
+    def record_incompressible(self):
+        """
+        Record a frame that was sent as it was because compressing it did
+        not make it smaller
+        """
+        with self.lock:
+            self.incompressible_frames += 1
+
+    def record_decompression(self, compressed_size, raw_size):
+        """
+        Record a frame decompressed from compressed_size to raw_size bytes
+        """
+        with self.lock:
+            self.decompressed_frames += 1
+            self.bytes_before_decompression += compressed_size
+            self.bytes_after_decompression += raw_size
+
+    def get_stats(self):
+        """
+        Return the compression counters and ratios (uncompressed size over
+        compressed size).
+        """
+        with self.lock:
+            return {
+                "compressed_frames" : self.compressed_frames,
+                "incompressible_frames" : self.incompressible_frames,
+                "bytes_before_compression" : self.bytes_before_compression,
+                "bytes_after_compression" : self.bytes_after_compression,
+                "compression_ratio" : get_ratio(self.bytes_before_compression, self.bytes_after_compression),
+                "decompressed_frames" : self.decompressed_frames,
+                "bytes_before_decompression" : self.bytes_before_decompression,
+                "bytes_after_decompression" : self.bytes_after_decompression,
+                "decompression_ratio" : get_ratio(self.bytes_after_decompression, self.bytes_before_decompression),
+            }
+
+def get_ratio(raw_size, compressed_size):
+    """
+    Return raw_size / compressed_size, or None if nothing was compressed.
+    """
+    if compressed_size == 0:
+        return None
+
+    return raw_size / compressed_size
+
+register_codec(1, "zlib", zlib.compress, zlib.decompress)
+
+if bz2 != None:
+    register_codec(2, "bz2", bz2.compress, bz2.decompress)
+
+if lzma != None:
+    register_codec(3, "lzma", lzma.compress, lzma.decompress)
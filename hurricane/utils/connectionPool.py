@@ -0,0 +1,127 @@
+import socket
+import asyncio
+from .socketWrappers import create_active_socket_async
+from .messages import encode_data
+from .messages import send_buffers_async
+from .messages import get_message_size
+
+class ConnectionPool:
+    """
+    Keeps long-lived framed streams open to other nodes, keyed by node id
+    ("host:port"), so that a message does not cost a TCP handshake. The pool
+    is driven from an asyncio event loop; sends to the same node are
+    serialized so frames never interleave on a stream. The pool counts the
+    bytes it sent and how often it had to replace a broken connection.
+    """
+
+    def __init__(self, **kwargs):
+        self.timeout = kwargs.get("timeout", 5)
+
+        self.connections = {}
+        self.locks = {}
+        self.bytes_sent = 0
+        self.reconnects = 0
+
+    async def get_connection(self, node_id):
+        """
+        Return the open connection to node_id, connecting if there is none or
+        if the pooled connection has been closed by the other end.
+
+        @returns the connection to node_id
+        """
+        connection = self.connections.get(node_id, None)
+
+        if connection != None and not is_connection_alive(connection):
+            self.close(node_id)
+            self.reconnects += 1
+            connection = None
+
+        if connection == None:
+            host, port = node_id.rsplit(":", 1)
+            connection = await create_active_socket_async(asyncio.get_event_loop(), host, int(port), self.timeout)
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            self.connections[node_id] = connection
+
+        return connection
+
+    async def send(self, node_id, data):
+        """
+        Send data to node_id over its pooled connection.
+        """
+        await self.send_message(node_id, encode_data(data))
+
+    async def send_message(self, node_id, message):
+        """
+        Send an encoded message to node_id over its pooled connection. If the
+        pooled connection turns out to be broken it is replaced and the
+        message is sent once more; an error on the fresh connection is raised.
+        """
+        if node_id not in self.locks:
+            self.locks[node_id] = asyncio.Lock()
+
+        async with self.locks[node_id]:
+            is_new_connection = node_id not in self.connections
+
+            try:
+                await self.sendall(node_id, message)
+            except socket.error:
+                self.close(node_id)
+
+                if is_new_connection:
+                    raise
+
+                self.reconnects += 1
+                await self.sendall(node_id, message)
+
+            self.bytes_sent += get_message_size(message)
+
+    async def sendall(self, node_id, message):
+        """
+        Write a whole message to the connection for node_id. If the
+        connection stops accepting data for longer than the timeout, the
+        stream is left unusable, so the connection is closed.
+        """
+        connection = await self.get_connection(node_id)
+
+        try:
+            await send_buffers_async(asyncio.get_event_loop(), connection, message, self.timeout)
+        except socket.timeout:
+            self.close(node_id)
+            raise
+
+    def close(self, node_id):
+        """
+        Close and forget the connection to node_id.
+        """
+        connection = self.connections.pop(node_id, None)
+
+        if connection != None:
+            try:
+                connection.close()
+            except socket.error:
+                pass
+
+    def close_all(self):
+        """
+        Close every pooled connection.
+        """
+        for node_id in list(self.connections):
+            self.close(node_id)
+
+def is_connection_alive(connection):
+    """
+    Determine whether a pooled connection can still be written to. Nodes
+    never send data back on a pooled connection, so if it is readable the
+    other end has closed it or it is in an error state. Pooled connections
+    are non-blocking, so peeking at them returns at once; unlike select,
+    this works for file descriptors of any number.
+    """
+    try:
+        connection.recv(1, socket.MSG_PEEK)
+    except BlockingIOError:
+        return True
+    except socket.error:
+        return False
+
+    return False
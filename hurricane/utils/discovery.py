@@ -0,0 +1,182 @@
+import socket
+import select
+import struct
+import errno
+from time import monotonic
+
+# The master node announces itself by sending a small beacon to
+# initialize_port over UDP, both to a multicast group and as a broadcast.
+# Slave nodes listen on the same port and take the address the beacon came
+# from as the master node's address.
+BEACON_MAGIC = b"HURRICANE"
+BEACON_VERSION = 1
+BEACON = struct.Struct('>9sBH')
+
+MULTICAST_GROUP = "239.255.72.82"
+BEACON_ADDRESSES = [MULTICAST_GROUP, "<broadcast>"]
+BEACON_INTERVAL = 0.25
+
+MAX_PROBES = 256
+
+def create_beacon(initialize_port):
+    """
+    Create the beacon a master node sends.
+    """
+    return BEACON.pack(BEACON_MAGIC, BEACON_VERSION, initialize_port)
+
+def is_beacon(data, initialize_port):
+    """
+    Determine whether a datagram is a beacon from a master node using
+    initialize_port.
+    """
+    if len(data) != BEACON.size:
+        return False
+
+    magic, version, port = BEACON.unpack(data)
+
+    return magic == BEACON_MAGIC and version == BEACON_VERSION and port == initialize_port
+
+def create_beacon_socket():
+    """
+    Create the non-blocking socket a master node sends beacons from.
+    """
+    beacon_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    beacon_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    beacon_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+    beacon_socket.setblocking(False)
+
+    return beacon_socket
+
+def send_beacon(beacon_socket, initialize_port, addresses=BEACON_ADDRESSES):
+    """
+    Send a beacon to each of addresses. Addresses that can not be reached
+    (for example when there is no multicast route) are skipped.
+    """
+    beacon = create_beacon(initialize_port)
+
+    for address in addresses:
+        try:
+            beacon_socket.sendto(beacon, (address, initialize_port))
+        except OSError:
+            pass
+
+def wait_for_beacon(initialize_port, timeout=1):
+    """
+    Listen for a master node's beacon on initialize_port. Several nodes on
+    one host can listen at the same time.
+
+    @returns the address of the master node, or None if no beacon arrived
+    within timeout seconds
+    """
+    listen_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    try:
+        listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listen_socket.bind(("", initialize_port))
+
+        try:
+            membership = struct.pack("4s4s", socket.inet_aton(MULTICAST_GROUP), socket.inet_aton("0.0.0.0"))
+            listen_socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        except OSError:
+            pass
+
+        deadline = monotonic() + timeout
+        while monotonic() < deadline:
+            readable, _, _ = select.select([listen_socket], [], [], deadline - monotonic())
+            if readable == []:
+                break
+
+            data, addr = listen_socket.recvfrom(BEACON.size + 1)
+            if is_beacon(data, initialize_port):
+                return addr[0]
+    except OSError:
+        pass
+    finally:
+        listen_socket.close()
+
+    return None
+
+def probe_hosts(addresses, port, timeout=1):
+    """
+    Try to connect to port on every address at once with non-blocking
+    connects, MAX_PROBES at a time.
+
+    @returns the first address that accepted the connection and the
+    connected (blocking) socket, or None, None
+    """
+    for index in range(0, len(addresses), MAX_PROBES):
+        address, connection = probe_host_group(addresses[index:index + MAX_PROBES], port, timeout)
+        if address != None:
+            connection.setblocking(True)
+            connection.settimeout(5)
+
+            return address, connection
+
+    return None, None
+
+def probe_host_group(addresses, port, timeout):
+    """
+    Try to connect to port on each of addresses at once.
+
+    @returns the first address that accepted the connection and the
+    connected socket, or None, None
+    """
+    probes = {}
+
+    try:
+        for address in addresses:
+            probe_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            probe_socket.setblocking(False)
+
+            result = probe_socket.connect_ex((address, port))
+            if result == 0:
+                return address, probe_socket
+            elif result in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+                probes[probe_socket] = address
+            else:
+                probe_socket.close()
+
+        deadline = monotonic() + timeout
+        while probes and monotonic() < deadline:
+            _, writable, _ = select.select([], list(probes), [], deadline - monotonic())
+
+            for probe_socket in writable:
+                address = probes.pop(probe_socket)
+
+                if probe_socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                    return address, probe_socket
+
+                probe_socket.close()
+    finally:
+        for probe_socket in probes:
+            probe_socket.close()
+
+    return None, None
+
+def get_local_addresses():
+    """
+    Return the addresses worth probing for a master node: this host and the
+    rest of its /24 network.
+    """
+    addresses = ["127.0.0.1"]
+
+    try:
+        route_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            # Connecting a UDP socket sends nothing; it only picks the
+            # interface that would be used
+            route_socket.connect(("10.255.255.255", 1))
+            local_address = route_socket.getsockname()[0]
+        finally:
+            route_socket.close()
+    except OSError:
+        return addresses
+
+    if local_address.startswith("127."):
+        return addresses
+
+    base_address = local_address.rsplit(".", 1)[0] + "."
+    addresses.append(local_address)
+    addresses.extend(base_address + str(index) for index in range(1, 255) if base_address + str(index) != local_address)
+
+    return addresses
@@ -2,8 +2,10 @@ import uuid
 
 def generate_task_id():
     """
-    Generate a unique id (in integer format).
+    Generate a unique id (in integer format). Ids fit in a signed 64-bit
+    integer, which keeps collisions negligible even for very large numbers
+    of tasks.
     """
     new_id = uuid.uuid4()
 
-    return new_id.int % 10000000
+    return new_id.int & 0x7FFFFFFFFFFFFFFF
@@ -1,27 +1,852 @@
+import io
+import socket
 import pickle
 import struct
+import asyncio
+from datetime import datetime
+from datetime import timedelta
+from hurricane.messages import HeartbeatMessage
+from hurricane.messages import NewNodeMessage
+from hurricane.messages import TaskManagementMessage
+from hurricane.messages import NodeInitializeMessage
+from hurricane.messages import TaskMessage
+from hurricane.messages import TaskBatchMessage
+from .task import Task
+from .compression import COMPRESSION_THRESHOLD
+from .compression import get_codec_by_id
 
-def read_data(connection):
+# Every message is sent as one frame:
+#
+#   header      version (B), flags (B), buffer count (H), body length (I)
+#   lengths     one unsigned 64-bit length (Q) per out-of-band buffer
+#   body        the message
+#   buffers     the out-of-band buffers, back to back
+#
+# The body is the pickled message, unless the FLAG_CONTROL flag is set. The
+# messages in hurricane.messages (and Task) are then written in a fixed
+# binary layout:
+#
+#   control     type (B), flags (B), id (Q): the node id for messages a
+#               slave node sends the master, otherwise 0
+#   fields      the message's own fields, packed with struct
+#   payload     for tasks only, the pickled user data
+#
+# so that heartbeats and task completions cost tens of bytes and pickle is
+# only used for user data.
+#
+# Tasks sent back by a slave node also carry the times they were received,
+# started, finished and sent on the slave node (SLAVE_TIMINGS), on the
+# master node's clock, after the fields of every task.
+#
+# The upper four bits of the flags hold the id of the codec that compressed
+# the frame, or 0. The body and each buffer of a compressed frame are
+# compressed separately, and the lengths in the frame are their compressed
+# lengths.
+#
+# Nodes on the same host can pass frames through a SharedMemoryRing. The
+# frame sent over the socket then has the FLAG_SHARED_MEMORY flag set and
+# its body is the descriptor of the record in the ring holding the real
+# frame, along with the id of the node the ring belongs to.
+#
+# Large buffers found while pickling (bytes, bytearray, memoryview and, with
+# pickle protocol 5, anything exposing a PickleBuffer such as NumPy arrays)
+# are kept out of the pickle stream. They are written to the socket
+# straight from the original objects with scatter-gather I/O and read into
+# preallocated buffers on the other side, so payloads are never copied into
+# an intermediate message. Out-of-band bytes are rebuilt as read-only
+# memoryviews of those buffers, since a bytes object can not be made from
+# one without a copy.
+FRAME_VERSION = 6
+FRAME_HEADER = struct.Struct('>BBHI')
+BUFFER_LENGTH = struct.Struct('>Q')
+
+FLAG_CONTROL = 0x01
+FLAG_SHARED_MEMORY = 0x02
+FLAG_CODEC_MASK = 0xF0
+FLAG_CODEC_SHIFT = 4
+
+CONTROL_HEADER = struct.Struct('>BBQ')
+PORTS = struct.Struct('>HH')
+NODE_FIELDS = struct.Struct('>IIH')
+HEARTBEAT_FIELDS = struct.Struct('>Ifddd')
+STRING_LENGTH = struct.Struct('>H')
+TASK_FIELDS = struct.Struct('>QHq')
+TASK_TIMINGS = struct.Struct('>dddd')
+BATCH_LENGTH = struct.Struct('>I')
+RING_DESCRIPTOR = struct.Struct('>QQQQ')
+
+CONTROL_FLAG_SHARED_MEMORY = 0x01
+CONTROL_FLAG_TIMINGS = 0x02
+
+SLAVE_TIMINGS = ["received", "started", "finished", "sent"]
+
+CONTROL_HEARTBEAT       = 1
+CONTROL_NEW_NODE        = 2
+CONTROL_TASK_MANAGEMENT = 3
+CONTROL_NODE_INITIALIZE = 4
+CONTROL_TASK            = 5
+CONTROL_TASK_MESSAGE    = 6
+CONTROL_TASK_BATCH      = 7
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+OUT_OF_BAND_THRESHOLD = 64 * 1024
+HAS_OUT_OF_BAND_BUFFERS = hasattr(pickle, "PickleBuffer")
+MAX_IOV = 1024
+
+def read_data(connection, compression_stats=None, rings=None):
     """
-    Read a data from a socket.
+    Read a data from a socket. rings maps node ids to the shared memory
+    rings the other node may write frames to, if there are any.
 
     @returns the data received from the socket
     """
-    raw_msglen = connection.recv(4)
-    msglen = struct.unpack('>I', raw_msglen)[0]
+    version, flags, buffer_count, body_length = FRAME_HEADER.unpack(recv_exactly(connection, FRAME_HEADER.size))
+    check_frame_version(version)
+
+    buffer_lengths = struct.unpack('>' + 'Q' * buffer_count, recv_exactly(connection, BUFFER_LENGTH.size * buffer_count))
+
+    body = recv_exactly(connection, body_length)
+    buffers = [recv_exactly(connection, length) for length in buffer_lengths]
+
+    if flags & FLAG_SHARED_MEMORY:
+        body, buffers, flags = read_shared_memory_frame(body, rings)
+
+    return decode_data(body, buffers, flags, compression_stats)
+
+def encode_datagram(data):
+    """
+    Encode data into a single datagram, for messages sent over UDP. Only
+    messages with a binary control layout can be sent as datagrams.
+
+    @returns the datagram
+    """
+    message = encode_data(data)
+
+    if not message[0][1] & FLAG_CONTROL:
+        raise ValueError("Only control messages can be sent as datagrams")
+
+    return b"".join(message)
+
+def decode_datagram(datagram):
+    """
+    Decode a datagram made by encode_datagram. A ValueError is raised if
+    the datagram does not hold a whole frame of a control message, so a
+    stray datagram is never unpickled.
+
+    @returns the data in the datagram
+    """
+    flags, body, buffers = split_frame(datagram)
+
+    if not flags & FLAG_CONTROL or flags & FLAG_CODEC_MASK:
+        raise ValueError("Datagrams can only hold uncompressed control messages")
+
+    return decode_control_message(body, buffers)
+
+def split_frame(frame):
+    """
+    Split an encoded message held in a single bytes-like object into its
+    parts, without copying them. A ValueError is raised if frame does not
+    hold exactly one whole frame, or if the frame refers to shared memory.
+
+    @returns the flags, body and buffers of the frame, to be passed to
+    decode_data
+    """
+    frame = memoryview(frame)
+    if len(frame) < FRAME_HEADER.size:
+        raise ValueError("Too short to hold a frame")
+
+    version, flags, buffer_count, body_length = FRAME_HEADER.unpack_from(frame)
+    check_frame_version(version)
+
+    if flags & FLAG_SHARED_MEMORY:
+        raise ValueError("Frame refers to shared memory")
+
+    offset = FRAME_HEADER.size + BUFFER_LENGTH.size * buffer_count
+    buffer_lengths = struct.unpack_from('>' + 'Q' * buffer_count, frame, FRAME_HEADER.size)
+
+    if offset + body_length + sum(buffer_lengths) != len(frame):
+        raise ValueError("Length does not match the frame")
+
+    body = frame[offset:offset + body_length]
+    offset += body_length
+
+    buffers = []
+    for buffer_length in buffer_lengths:
+        buffers.append(frame[offset:offset + buffer_length])
+        offset += buffer_length
 
-    data = connection.recv(msglen)
-    data = pickle.loads(data)
+    return flags, body, buffers
+
+def recv_exactly(connection, size):
+    """
+    Read exactly size bytes from a socket into a preallocated buffer.
+    Several messages can be sent over one connection, so a short read must
+    not be mistaken for a whole message.
+
+    @returns the bytearray read from the socket
+    """
+    data = bytearray(size)
+    view = memoryview(data)
+    received = 0
+
+    while received < size:
+        nbytes = connection.recv_into(view[received:], size - received)
+        if nbytes == 0:
+            raise ConnectionResetError("Connection closed by peer")
+
+        received += nbytes
 
     return data
 
+def send_data(connection, data):
+    """
+    Encode data and write it to a socket.
+    """
+    send_buffers(connection, encode_data(data))
+
+def send_buffers(connection, buffers):
+    """
+    Write a list of buffers to a socket, in order, without joining them.
+    """
+    views = get_send_views(buffers)
+
+    if not hasattr(connection, "sendmsg"):
+        for view in views:
+            connection.sendall(view)
+
+        return
+
+    while views:
+        sent = connection.sendmsg(views[:MAX_IOV])
+        views = advance_views(views, sent)
+
+async def read_data_async(loop, connection, compression_stats=None, rings=None):
+    """
+    Read data from a non-blocking socket without blocking the event loop.
+
+    @returns the data received from the socket
+    """
+    data, frame_size, shared_memory_size = await read_frame_async(loop, connection, compression_stats, rings)
+
+    return data
+
+async def read_frame_async(loop, connection, compression_stats=None, rings=None):
+    """
+    Read a whole frame from a non-blocking socket. Compressed frames are
+    decompressed and decoded in the loop's executor, so that the event loop
+    is not held up.
+
+    @returns the data received, the number of bytes read from the socket,
+    and the size of the frame passed through shared memory in its place,
+    or 0
+    """
+    version, flags, buffer_count, body_length = FRAME_HEADER.unpack(await recv_exactly_async(loop, connection, FRAME_HEADER.size))
+    check_frame_version(version)
+
+    buffer_lengths = struct.unpack('>' + 'Q' * buffer_count, await recv_exactly_async(loop, connection, BUFFER_LENGTH.size * buffer_count))
+
+    body = await recv_exactly_async(loop, connection, body_length)
+    buffers = []
+    for length in buffer_lengths:
+        buffers.append(await recv_exactly_async(loop, connection, length))
+
+    frame_size = get_frame_size(body, buffers)
+    shared_memory_size = 0
+
+    if flags & FLAG_SHARED_MEMORY:
+        body, buffers, flags = read_shared_memory_frame(body, rings)
+        shared_memory_size = get_frame_size(body, buffers)
+
+    if flags & FLAG_CODEC_MASK:
+        return await loop.run_in_executor(None, decode_data, body, buffers, flags, compression_stats), frame_size, shared_memory_size
+
+    return decode_data(body, buffers, flags), frame_size, shared_memory_size
+
+def get_frame_size(body, buffers):
+    """
+    Return the size in bytes of a frame with body and buffers.
+    """
+    return FRAME_HEADER.size + BUFFER_LENGTH.size * len(buffers) + len(body) + sum(len(buffer) for buffer in buffers)
+
+async def recv_exactly_async(loop, connection, size):
+    """
+    Read exactly size bytes from a non-blocking socket into a preallocated
+    buffer.
+
+    @returns the bytearray read from the socket
+    """
+    data = bytearray(size)
+    view = memoryview(data)
+    received = 0
+
+    while received < size:
+        nbytes = await loop.sock_recv_into(connection, view[received:])
+        if nbytes == 0:
+            raise ConnectionResetError("Connection closed by peer")
+
+        received += nbytes
+
+    return data
+
+async def send_data_async(loop, connection, data, timeout=None):
+    """
+    Encode data and write it to a non-blocking socket.
+    """
+    await send_buffers_async(loop, connection, encode_data(data), timeout)
+
+async def send_buffers_async(loop, connection, buffers, timeout=None):
+    """
+    Write a list of buffers to a non-blocking socket, in order, without
+    joining them. If timeout is set, a socket.timeout is raised when the
+    socket stays unwritable for that long.
+    """
+    views = get_send_views(buffers)
+
+    if not hasattr(connection, "sendmsg"):
+        for view in views:
+            try:
+                await asyncio.wait_for(loop.sock_sendall(connection, view), timeout)
+            except asyncio.TimeoutError:
+                raise socket.timeout("timed out")
+
+        return
+
+    while views:
+        try:
+            sent = connection.sendmsg(views[:MAX_IOV])
+        except (BlockingIOError, InterruptedError):
+            await wait_writable(loop, connection, timeout)
+            continue
+
+        views = advance_views(views, sent)
+
+async def wait_writable(loop, connection, timeout):
+    """
+    Wait until a non-blocking socket can be written to.
+    """
+    writable = loop.create_future()
+    loop.add_writer(connection.fileno(), set_future_result, writable)
+
+    try:
+        await asyncio.wait_for(writable, timeout)
+    except asyncio.TimeoutError:
+        raise socket.timeout("timed out")
+    finally:
+        loop.remove_writer(connection.fileno())
+
+def set_future_result(future):
+    """
+    Resolve a readiness future; the loop may report readiness again before
+    the waiting coroutine has removed its callback.
+    """
+    if not future.done():
+        future.set_result(None)
+
+def get_send_views(buffers):
+    """
+    Return byte views of the non-empty buffers of a message.
+    """
+    views = [memoryview(buffer).cast('B') for buffer in buffers]
+
+    return [view for view in views if view.nbytes > 0]
+
+def advance_views(views, sent):
+    """
+    Drop sent bytes from the front of a list of views.
+
+    @returns the views that are still to be sent
+    """
+    index = 0
+
+    while index < len(views) and sent >= views[index].nbytes:
+        sent -= views[index].nbytes
+        index += 1
+
+    views = views[index:]
+    if sent > 0:
+        views[0] = views[0][sent:]
+
+    return views
+
+def check_frame_version(version):
+    """
+    Refuse frames written with a different version of the frame layout.
+    """
+    if version != FRAME_VERSION:
+        raise ValueError("Unsupported frame version " + str(version))
+
+def get_message_size(message):
+    """
+    Return the number of bytes in an encoded message.
+    """
+    return sum(memoryview(buffer).nbytes for buffer in message)
+
+def compress_message(message, codec, threshold=COMPRESSION_THRESHOLD, compression_stats=None):
+    """
+    Compress an encoded message with codec if it is at least threshold
+    bytes long. A message that does not get smaller is left as it is.
+
+    @returns the list of buffers making up the message, to be written in order
+    """
+    raw_size = get_message_size(message)
+    if codec == None or raw_size < threshold:
+        return message
+
+    version, flags, buffer_count, body_length = FRAME_HEADER.unpack_from(message[0])
+
+    parts = [codec.compress(part) for part in message[1:]]
+    body = parts[0]
+    buffers = parts[1:]
+
+    header = FRAME_HEADER.pack(FRAME_VERSION, flags | (codec.get_codec_id() << FLAG_CODEC_SHIFT), len(buffers), len(body))
+    header += b"".join(BUFFER_LENGTH.pack(len(buffer)) for buffer in buffers)
+
+    compressed_message = [header, body] + buffers
+    compressed_size = get_message_size(compressed_message)
+
+    if compressed_size >= raw_size:
+        if compression_stats != None:
+            compression_stats.record_incompressible()
+
+        return message
+
+    if compression_stats != None:
+        compression_stats.record_compression(raw_size, compressed_size)
+
+    return compressed_message
+
+def decompress_frame(body, buffers, flags, compression_stats=None):
+    """
+    Decompress the body and buffers of a compressed frame.
+
+    @returns the decompressed body and buffers
+    """
+    codec = get_codec_by_id((flags & FLAG_CODEC_MASK) >> FLAG_CODEC_SHIFT)
+    compressed_size = len(body) + sum(len(buffer) for buffer in buffers)
+
+    body = codec.decompress(body)
+    buffers = [codec.decompress(buffer) for buffer in buffers]
+
+    if compression_stats != None:
+        compression_stats.record_decompression(compressed_size, len(body) + sum(len(buffer) for buffer in buffers))
+
+    return body, buffers
+
+def write_shared_memory_frame(message, ring, node_id):
+    """
+    Copy an encoded message into the shared memory ring of node_id.
+
+    @returns the message to send over the socket in its place, holding the
+    descriptor of the record, or None if the message does not fit in the
+    ring
+    """
+    descriptor = ring.write(message)
+    if descriptor == None:
+        return None
+
+    body = RING_DESCRIPTOR.pack(node_id, *descriptor)
+
+    return [FRAME_HEADER.pack(FRAME_VERSION, FLAG_SHARED_MEMORY, 0, len(body)), body]
+
+def read_shared_memory_frame(descriptor, rings):
+    """
+    Copy the frame a descriptor points to out of a shared memory ring, and
+    release its record.
+
+    @returns the body, buffers and flags of the frame
+    """
+    node_id, _, start, length = RING_DESCRIPTOR.unpack(descriptor)
+
+    ring = None
+    if rings != None:
+        ring = rings.get(node_id, None)
+
+    if ring == None:
+        raise ValueError("Received a shared memory frame for node " + str(node_id) + " without a shared memory ring")
+
+    record = ring.read(start, length)
+
+    try:
+        version, flags, buffer_count, body_length = FRAME_HEADER.unpack_from(record)
+        check_frame_version(version)
+
+        offset = FRAME_HEADER.size
+        buffer_lengths = struct.unpack_from('>' + 'Q' * buffer_count, record, offset)
+        offset += BUFFER_LENGTH.size * buffer_count
+
+        body = bytearray(record[offset:offset + body_length])
+        offset += body_length
+
+        buffers = []
+        for buffer_length in buffer_lengths:
+            buffers.append(bytearray(record[offset:offset + buffer_length]))
+            offset += buffer_length
+    finally:
+        record.release()
+        ring.release(start)
+
+    return body, buffers, flags
+
+def get_shared_memory_frame_size(message):
+    """
+    Return the size in bytes of the frame an encoded message points to, if
+    it is a shared memory frame, or 0.
+    """
+    _, flags, _, _ = FRAME_HEADER.unpack_from(message[0])
+
+    if flags & FLAG_SHARED_MEMORY:
+        return RING_DESCRIPTOR.unpack(message[1])[3]
+
+    return 0
+
+def release_shared_memory_frame(message, ring):
+    """
+    Release the record in a shared memory ring that an encoded message
+    points to, if it is a shared memory frame, because the message could
+    not be sent and the other node will never read the record.
+    """
+    _, flags, _, _ = FRAME_HEADER.unpack_from(message[0])
+
+    if flags & FLAG_SHARED_MEMORY:
+        _, _, start, _ = RING_DESCRIPTOR.unpack(message[1])
+        ring.release(start)
+
 def encode_data(data):
     """
     Encode data into a transmittable message.
 
-    @returns the encoded data
+    @returns the list of buffers making up the message, to be written in order
     """
-    msg = pickle.dumps(data)
-    msg = struct.pack('>I', len(msg)) + msg
+    buffers = []
+    flags = FLAG_CONTROL
+    body = encode_control_message(data, buffers)
+
+    if body == None:
+        flags = 0
+        body = pickle_data(data, buffers)
+
+    header = FRAME_HEADER.pack(FRAME_VERSION, flags, len(buffers), len(body))
+    header += b"".join(BUFFER_LENGTH.pack(buffer.nbytes) for buffer in buffers)
+
+    return [header, body] + buffers
+
+def pickle_data(data, buffers):
+    """
+    Pickle data, appending a view of every large buffer it holds to buffers
+    instead of copying the buffer into the pickle stream.
+
+    Most messages are small, so they are pickled without per-object hooks
+    first; only when the pickle stream outgrows OUT_OF_BAND_THRESHOLD (or
+    it holds a memoryview, which can only be sent out-of-band) is the
+    message pickled again with large bytes-like objects moved out-of-band.
+    Big payloads are written to the stream in one piece, so the first pass
+    stops before copying them.
+
+    @returns the pickle stream
+    """
+    stream = BoundedStream(OUT_OF_BAND_THRESHOLD)
+
+    try:
+        FramePickler(stream, buffers).dump(data)
+    except (StreamLimitExceeded, TypeError):
+        del buffers[:]
+
+        stream = io.BytesIO()
+        OutOfBandPickler(stream, buffers).dump(data)
+
+    return stream.getbuffer()
+
+def decode_data(body, buffers, flags=0, compression_stats=None):
+    """
+    Decode a message body, handing it the out-of-band buffers that were
+    sent with it.
+
+    @returns the decoded data
+    """
+    if flags & FLAG_CODEC_MASK:
+        body, buffers = decompress_frame(body, buffers, flags, compression_stats)
+
+    if flags & FLAG_CONTROL:
+        return decode_control_message(body, buffers)
+
+    return FrameUnpickler(io.BytesIO(body), buffers).load()
+
+def encode_control_message(data, buffers):
+    """
+    Encode one of the hurricane messages in the binary control layout.
+
+    @returns the message body, or None if data has to be pickled instead
+    """
+    try:
+        return pack_control_message(data, buffers)
+    except struct.error:
+        return None
+
+def pack_control_message(data, buffers):
+    """
+    Pack a message in the binary control layout. A struct.error is raised
+    if one of its fields does not fit the layout.
+
+    @returns the message body, or None if data is not a hurricane message
+    """
+    data_type = type(data)
+
+    if data_type is HeartbeatMessage:
+        return CONTROL_HEADER.pack(CONTROL_HEARTBEAT, 0, data.get_node_id() or 0) + HEARTBEAT_FIELDS.pack(data.get_tasks(), data.get_interval() or 0, data.get_sent_time() or 0, data.get_echo_time() or 0, data.get_receive_time() or 0)
+    elif data_type is TaskManagementMessage:
+        return CONTROL_HEADER.pack(CONTROL_TASK_MANAGEMENT, 0, data.get_node_id() or 0) + pack_ports(data.get_task_port(), data.get_task_completion_port()) + pack_string(",".join(data.get_compression())) + pack_string(",".join(data.get_shared_memory()))
+    elif data_type is NodeInitializeMessage:
+        return CONTROL_HEADER.pack(CONTROL_NODE_INITIALIZE, CONTROL_FLAG_SHARED_MEMORY if data.get_shared_memory() else 0, data.get_node_id() or 0) + NODE_FIELDS.pack(data.get_cpu_count(), data.get_slots(), data.get_task_port() or 0) + pack_string(data.get_addr()) + pack_string(data.get_compression())
+    elif data_type is NewNodeMessage:
+        return CONTROL_HEADER.pack(CONTROL_NEW_NODE, 0, 0) + pack_ports(data.get_task_port(), data.get_task_completion_port()) + pack_string(data.get_addr())
+    elif data_type is Task:
+        return pack_tasks(CONTROL_TASK, 0, [data], buffers)
+    elif data_type is TaskMessage and type(data.get_task()) is Task:
+        return pack_tasks(CONTROL_TASK_MESSAGE, data.get_node_id(), [data.get_task()], buffers)
+    elif data_type is TaskBatchMessage and all(type(task) is Task for task in data.get_tasks()):
+        return pack_tasks(CONTROL_TASK_BATCH, data.get_node_id(), data.get_tasks(), buffers)
+
+    return None
+
+def decode_control_message(body, buffers):
+    """
+    Decode a message written in the binary control layout.
+
+    @returns the decoded message
+    """
+    body = memoryview(body)
+    control_type, flags, node_id = CONTROL_HEADER.unpack_from(body)
+    offset = CONTROL_HEADER.size
+
+    if control_type == CONTROL_HEARTBEAT:
+        tasks, interval, sent_time, echo_time, receive_time = HEARTBEAT_FIELDS.unpack_from(body, offset)
+
+        return HeartbeatMessage(node_id or None, tasks, interval or None, sent_time or None, echo_time or None, receive_time or None)
+    elif control_type == CONTROL_TASK_MANAGEMENT:
+        task_port, task_completion_port = unpack_ports(body, offset)
+        compression, offset = unpack_string(body, offset + PORTS.size)
+        shared_memory, offset = unpack_string(body, offset)
+
+        return TaskManagementMessage(node_id=node_id or None, task_port=task_port, task_completion_port=task_completion_port, compression=compression.split(",") if compression else [], shared_memory=shared_memory.split(",") if shared_memory else [])
+    elif control_type == CONTROL_NODE_INITIALIZE:
+        cpu_count, slots, task_port = NODE_FIELDS.unpack_from(body, offset)
+        addr, offset = unpack_string(body, offset + NODE_FIELDS.size)
+        compression, offset = unpack_string(body, offset)
+
+        return NodeInitializeMessage(addr, cpu_count, slots, compression, bool(flags & CONTROL_FLAG_SHARED_MEMORY), node_id or None, task_port or None)
+    elif control_type == CONTROL_NEW_NODE:
+        task_port, task_completion_port = unpack_ports(body, offset)
+        addr, offset = unpack_string(body, offset + PORTS.size)
+
+        return NewNodeMessage(addr, task_port, task_completion_port)
+    elif control_type == CONTROL_TASK:
+        return unpack_tasks(body, offset, buffers, flags)[0]
+    elif control_type == CONTROL_TASK_MESSAGE:
+        return TaskMessage(unpack_tasks(body, offset, buffers, flags)[0], node_id or None)
+    elif control_type == CONTROL_TASK_BATCH:
+        return TaskBatchMessage(unpack_tasks(body, offset, buffers, flags), node_id or None)
+
+    raise ValueError("Unknown control message type " + str(control_type))
+
+def pack_tasks(control_type, node_id, tasks, buffers):
+    """
+    Pack the fields of a list of tasks, followed by their slave node
+    timings if any task has them, and one pickle holding the user data of
+    all of them.
+
+    @returns the message body, or None if a task has a start time the
+    layout can not hold
+    """
+    has_timings = any(task.get_timings() != None for task in tasks)
+
+    fields = [CONTROL_HEADER.pack(control_type, CONTROL_FLAG_TIMINGS if has_timings else 0, node_id or 0), BATCH_LENGTH.pack(len(tasks))]
+    payload = []
+
+    for task in tasks:
+        starttime = task.get_starttime()
+        if type(starttime) is not datetime or starttime.tzinfo != None:
+            return None
+
+        fields.append(TASK_FIELDS.pack(task.get_task_id(), task.get_return_port() or 0, (starttime - EPOCH) // MICROSECOND))
+        payload.append((task.get_data(), task.get_generated_data()))
+
+    if has_timings:
+        for task in tasks:
+            timings = task.get_timings() or {}
+            fields.append(TASK_TIMINGS.pack(*[timings.get(stage, None) or 0 for stage in SLAVE_TIMINGS]))
+
+    fields.append(pickle_data(payload, buffers))
+
+    return b"".join(fields)
+
+def unpack_tasks(body, offset, buffers, flags=0):
+    """
+    Unpack a list of tasks written by pack_tasks.
+
+    @returns the list of tasks
+    """
+    count, = BATCH_LENGTH.unpack_from(body, offset)
+    offset += BATCH_LENGTH.size
+
+    fields_end = offset + TASK_FIELDS.size * count
+    task_fields = TASK_FIELDS.iter_unpack(body[offset:fields_end])
+    offset = fields_end
+
+    task_timings = [None] * count
+    if flags & CONTROL_FLAG_TIMINGS:
+        timings_end = offset + TASK_TIMINGS.size * count
+        task_timings = [{stage : time for stage, time in zip(SLAVE_TIMINGS, timings) if time != 0} for timings in TASK_TIMINGS.iter_unpack(body[offset:timings_end])]
+        offset = timings_end
+
+    payload = FrameUnpickler(io.BytesIO(body[offset:]), buffers).load()
+
+    tasks = []
+    for (task_id, return_port, starttime), (data, generated_data), timings in zip(task_fields, payload, task_timings):
+        task = Task(task_id=task_id, return_port=return_port or None, starttime=EPOCH + starttime * MICROSECOND, data=data, timings=timings)
+        task.set_generated_data(generated_data)
+
+        tasks.append(task)
+
+    return tasks
+
+def pack_ports(task_port, task_completion_port):
+    """
+    Pack a pair of ports, with 0 standing for a port that is not set.
+    """
+    return PORTS.pack(task_port or 0, task_completion_port or 0)
+
+def unpack_ports(body, offset):
+    """
+    Unpack a pair of ports written by pack_ports.
+    """
+    task_port, task_completion_port = PORTS.unpack_from(body, offset)
+
+    return task_port or None, task_completion_port or None
+
+def pack_string(value):
+    """
+    Pack a length-prefixed UTF-8 string, with the empty string standing for
+    None.
+    """
+    if value != None and type(value) is not str:
+        raise struct.error("Only strings can be packed")
+
+    encoded = (value or "").encode("utf-8")
+
+    return STRING_LENGTH.pack(len(encoded)) + encoded
+
+def unpack_string(body, offset):
+    """
+    Unpack a string written by pack_string.
+
+    @returns the string and the offset of the field after it
+    """
+    length, = STRING_LENGTH.unpack_from(body, offset)
+    offset += STRING_LENGTH.size
+
+    return str(body[offset:offset + length], "utf-8") or None, offset + length
+
+class StreamLimitExceeded(Exception):
+    """
+    Raised when a BoundedStream is written past its limit
+    """
+
+class BoundedStream(io.BytesIO):
+    """
+    In-memory stream that refuses to grow past a limit
+    """
+
+    def __init__(self, limit):
+        super(BoundedStream, self).__init__()
+
+        self.limit = limit
+
+    def write(self, data):
+        if self.tell() + memoryview(data).nbytes > self.limit:
+            raise StreamLimitExceeded()
+
+        return super(BoundedStream, self).write(data)
+
+class FramePickler(pickle.Pickler):
+    """
+    Pickler that moves large pickle protocol 5 buffers (such as the data of
+    NumPy arrays) out of the pickle stream.
+    """
+
+    def __init__(self, stream, buffers):
+        if HAS_OUT_OF_BAND_BUFFERS:
+            super(FramePickler, self).__init__(stream, protocol=5, buffer_callback=self.buffer_callback)
+        else:
+            super(FramePickler, self).__init__(stream, protocol=pickle.HIGHEST_PROTOCOL)
+
+        self.buffers = buffers
+
+    def buffer_callback(self, buffer):
+        raw_buffer = buffer.raw()
+        if raw_buffer.nbytes < OUT_OF_BAND_THRESHOLD:
+            return True
+
+        self.buffers.append(raw_buffer)
+
+        return False
+
+class OutOfBandPickler(FramePickler):
+    """
+    FramePickler that also moves large bytes, bytearray and memoryview
+    objects out of the pickle stream. Protocol 5 always pickles those
+    in-band, so they are caught with persistent_id, which is called for
+    every object. Both kinds of buffer are appended in the order they appear
+    in the stream.
+    """
+
+    def persistent_id(self, obj):
+        obj_type = type(obj)
+
+        if obj_type is bytes or obj_type is bytearray:
+            if len(obj) >= OUT_OF_BAND_THRESHOLD:
+                self.buffers.append(memoryview(obj))
+
+                return (obj_type.__name__,)
+        elif obj_type is memoryview:
+            if obj.nbytes >= OUT_OF_BAND_THRESHOLD and obj.c_contiguous and len(obj.format) == 1:
+                self.buffers.append(obj.cast('B'))
+
+                return ("memoryview", obj.format, obj.shape)
+
+        return None
+
+class FrameUnpickler(pickle.Unpickler):
+    """
+    Unpickler for frame bodies. The receive buffers are bytearrays, so
+    bytearrays, memoryviews and protocol 5 buffers are rebuilt on top of
+    them without a copy. bytes are immutable and would need one, so they
+    are rebuilt as read-only memoryviews instead. Buffers of a compressed
+    frame are decompressed to bytes, so bytearrays are copied out of them.
+    """
+
+    def __init__(self, stream, buffers):
+        self.buffer_iterator = iter(buffers)
+
+        if HAS_OUT_OF_BAND_BUFFERS:
+            super(FrameUnpickler, self).__init__(stream, buffers=self.buffer_iterator)
+        else:
+            super(FrameUnpickler, self).__init__(stream)
+
+    def persistent_load(self, pid):
+        buffer = next(self.buffer_iterator)
+
+        if pid[0] == "bytes":
+            view = memoryview(buffer)
+
+            return view.toreadonly() if hasattr(view, "toreadonly") else view
+        elif pid[0] == "bytearray":
+            if type(buffer) is not bytearray:
+                return bytearray(buffer)
+
+            return buffer
+        elif pid[0] == "memoryview":
+            return memoryview(buffer).cast(pid[1], pid[2])
 
-    return msg
+        raise pickle.UnpicklingError("Unknown out-of-band buffer type " + str(pid[0]))
@@ -0,0 +1,177 @@
+import struct
+import threading
+from collections import deque
+
+try:
+    from multiprocessing import shared_memory
+    from multiprocessing import resource_tracker
+except ImportError:
+    shared_memory = None
+
+HAS_SHARED_MEMORY = shared_memory != None
+
+# Every record in a ring starts with a state word, followed by the record's
+# data. The writer sets the state to RECORD_WRITTEN when it writes the
+# record, and the record is released by setting it to RECORD_RELEASED.
+# Positions are counted in bytes since the ring was created and never wrap;
+# a position's place in the ring is the position modulo the capacity.
+RECORD_STATE = struct.Struct('=Q')
+RECORD_WRITTEN = 0
+RECORD_RELEASED = 1
+
+SHARED_MEMORY_SIZE = 16 * 1024 * 1024
+
+class SharedMemoryRing:
+    """
+    A single-producer ring buffer in a shared memory segment, used to pass
+    frames between nodes on the same host. The writer copies a frame into
+    the ring and only sends a small descriptor over the socket; the reader
+    copies the frame out and releases its record. The writer takes the
+    space of released records back, in order, when it needs room. A record
+    whose descriptor could not be sent is released by the writer itself, so
+    that it does not hold up the records after it.
+
+    Frames that do not fit in the free space of the ring are not written,
+    and should be sent over the socket instead.
+    """
+
+    def __init__(self, name=None, size=SHARED_MEMORY_SIZE):
+        """
+        Create a new ring of size bytes, or attach to the ring called name.
+        """
+        if name == None:
+            self.memory = shared_memory.SharedMemory(create=True, size=size)
+            self.owner = True
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+            self.owner = False
+
+            # The segment belongs to the process that created it; make sure
+            # this process does not remove it when it exits
+            try:
+                resource_tracker.unregister(self.memory._name, "shared_memory")
+            except Exception:
+                pass
+
+        self.capacity = self.memory.size
+        self.data = self.memory.buf[:self.capacity]
+
+        self.write_position = 0
+        self.read_position = 0
+        self.records = deque()
+        self.write_lock = threading.Lock()
+
+    def get_name(self):
+        """
+        Return the name other processes attach to the ring with
+        """
+        return self.memory.name
+
+    def write(self, buffers):
+        """
+        Copy a list of buffers into the ring, back to back.
+
+        @returns the (begin, start, length) descriptor of the record, where
+        the data is at [start, start + length) and the record takes up
+        [begin, start + length) of the ring, or None if it does not fit
+        """
+        views = [memoryview(buffer).cast('B') for buffer in buffers]
+        length = sum(view.nbytes for view in views)
+
+        with self.write_lock:
+            self.reclaim()
+
+            begin = self.write_position
+            state = begin
+
+            # Records are never split across the end of the ring
+            if state % self.capacity + RECORD_STATE.size + length > self.capacity:
+                state += self.capacity - state % self.capacity
+
+            start = state + RECORD_STATE.size
+
+            if start + length - self.read_position > self.capacity:
+                return None
+
+            RECORD_STATE.pack_into(self.data, state % self.capacity, RECORD_WRITTEN)
+
+            offset = start % self.capacity
+            for view in views:
+                self.data[offset:offset + view.nbytes] = view
+                offset += view.nbytes
+
+            self.write_position = start + length
+            self.records.append((state, start + length))
+
+        return begin, start, length
+
+    def reclaim(self):
+        """
+        Take back the space of the oldest records, for as long as they have
+        been released. Must be called with the write lock held.
+        """
+        while self.records:
+            state, end = self.records[0]
+
+            if RECORD_STATE.unpack_from(self.data, state % self.capacity)[0] != RECORD_RELEASED:
+                break
+
+            self.read_position = end
+            self.records.popleft()
+
+    def read(self, start, length):
+        """
+        Return a view of the data of a record. The view is only valid until
+        the record is released.
+        """
+        offset = start % self.capacity
+
+        return self.data[offset:offset + length]
+
+    def release(self, start):
+        """
+        Give the space of the record with its data at start back to the
+        writer. Records may be released out of order; the writer only gets
+        space back once every record before it has been released too.
+        """
+        RECORD_STATE.pack_into(self.data, (start - RECORD_STATE.size) % self.capacity, RECORD_RELEASED)
+
+    def close(self):
+        """
+        Detach from the ring, and remove it if this process created it.
+        """
+        self.data.release()
+
+        try:
+            self.memory.close()
+        except BufferError:
+            return
+
+        if self.owner:
+            try:
+                self.memory.unlink()
+            except FileNotFoundError:
+                pass
+
+def attach_shared_memory_rings(names):
+    """
+    Attach to the rings with the given names.
+
+    @returns the list of rings, or None if one of them can not be attached
+    to (for example because it is on another host)
+    """
+    if not HAS_SHARED_MEMORY:
+        return None
+
+    rings = []
+
+    try:
+        for name in names:
+            rings.append(SharedMemoryRing(name=name))
+    except (OSError, ValueError):
+        for ring in rings:
+            ring.close()
+
+        return None
+
+    return rings
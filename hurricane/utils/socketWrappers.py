@@ -1,4 +1,5 @@
 import socket
+import asyncio
 
 def create_active_socket(host, port):
     """
@@ -12,6 +13,26 @@ def create_active_socket(host, port):
 
     return active_socket
 
+async def create_active_socket_async(loop, host, port, timeout=5):
+    """
+    Connect to a host on a specific port without blocking the event loop.
+
+    @returns the new (non-blocking) active socket
+    """
+    active_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    active_socket.setblocking(False)
+
+    try:
+        await asyncio.wait_for(loop.sock_connect(active_socket, (host, port)), timeout)
+    except asyncio.TimeoutError:
+        active_socket.close()
+        raise socket.timeout("timed out")
+    except socket.error:
+        active_socket.close()
+        raise
+
+    return active_socket
+
 def create_listen_socket(port, max_connections):
     """
     Create a socket to listen on a port with max_connections.
@@ -34,3 +55,14 @@ def create_listen_socket_timer(port, max_connections, timeout=10):
     listen_socket.settimeout(timeout)
 
     return listen_socket
+
+def is_same_host(connection):
+    """
+    Determine whether the other end of a connected socket is on this host.
+
+    @returns True if both ends of the connection have the same address
+    """
+    try:
+        return connection.getpeername()[0] == connection.getsockname()[0]
+    except socket.error:
+        return False
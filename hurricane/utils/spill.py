@@ -0,0 +1,128 @@
+import os
+import mmap
+import weakref
+import tempfile
+from .messages import encode_data
+from .messages import decode_data
+from .messages import split_frame
+
+class SpilledData:
+    """
+    Handle on generated data that was written out to a file to free up
+    memory. The file is memory-mapped whenever the data is read, so reading
+    it does not copy it onto the heap where that can be avoided: bytes-like
+    views and arrays that support pickle protocol 5 are read straight from
+    the mapped file. The file is removed once the handle is garbage
+    collected, for example when the task holding it is dropped after being
+    claimed.
+
+    kind is "bytes" or "bytearray" for data written to the file as is, and
+    "frame" for data encoded as a frame. With keep_at_exit set, the file is
+    not removed when the process exits with the handle still around, so
+    that it can be found again after a restart.
+    """
+
+    def __init__(self, path, kind, keep_at_exit=False):
+        self.path = path
+        self.kind = kind
+        self.size = os.path.getsize(path)
+        self.finalizer = weakref.finalize(self, remove_spill_file, path)
+        self.finalizer.atexit = not keep_at_exit
+
+    def get_path(self):
+        """
+        Return the path of the file.
+        """
+        return self.path
+
+    def get_kind(self):
+        """
+        Return how the data was written to the file.
+        """
+        return self.kind
+
+    def get_size(self):
+        """
+        Return the size of the file in bytes.
+        """
+        return self.size
+
+    def map(self):
+        """
+        Map the file into memory.
+
+        @returns a read-only memoryview of the whole file
+        """
+        if self.size == 0:
+            return memoryview(b"")
+
+        with open(self.path, "rb") as spill_file:
+            return memoryview(mmap.mmap(spill_file.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def load(self):
+        """
+        Read the data back from the file.
+        """
+        view = self.map()
+
+        if self.kind == "bytes":
+            return bytes(view)
+        elif self.kind == "bytearray":
+            return bytearray(view)
+
+        flags, body, buffers = split_frame(view)
+
+        return decode_data(body, buffers, flags)
+
+    def get_view(self):
+        """
+        Return a read-only memoryview of the data without copying it off
+        the mapped file. A TypeError is raised if the data does not support
+        the buffer protocol.
+        """
+        if self.kind == "frame":
+            return memoryview(self.load())
+
+        return self.map()
+
+    def remove(self):
+        """
+        Remove the file now instead of when the handle is garbage collected.
+        """
+        self.finalizer()
+
+def spill_data(data, directory, keep_at_exit=False):
+    """
+    Write data to a new file in directory.
+
+    @returns the SpilledData handle on the file
+    """
+    if type(data) in [bytes, bytearray]:
+        kind = type(data).__name__
+        buffers = [data]
+    else:
+        kind = "frame"
+        buffers = encode_data(data)
+
+    descriptor, path = tempfile.mkstemp(prefix="result-", suffix=".spill", dir=directory)
+
+    try:
+        with os.fdopen(descriptor, "wb") as spill_file:
+            for buffer in buffers:
+                spill_file.write(buffer)
+    except:
+        remove_spill_file(path)
+
+        raise
+
+    return SpilledData(path, kind, keep_at_exit)
+
+def remove_spill_file(path):
+    """
+    Remove a spill file, if it is still there. On platforms that do not
+    remove files that are still mapped, the file is left behind.
+    """
+    try:
+        os.remove(path)
+    except OSError:
+        pass
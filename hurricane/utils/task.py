@@ -1,26 +1,71 @@
+from time import monotonic
 from datetime import datetime
 
 class Task:
 
+    __slots__ = ("starttime", "return_port", "task_id", "data", "generated_data", "timings", "spilled_data")
+
     def __init__(self, **kwargs):
-        self.starttime = kwargs.get('starttime', datetime.now())
+        self.starttime = kwargs.get('starttime', None)
+        if self.starttime == None:
+            self.starttime = datetime.now()
+
         self.return_port = kwargs.get('return_port', None)
         self.task_id = kwargs.get('task_id', None)
         self.data = kwargs.get('data', None)
 
         self.generated_data = None
+        self.timings = kwargs.get('timings', None)
+        self.spilled_data = None
 
     def get_generated_data(self):
         """
-        Return the generated data for this task.
+        Return the generated data for this task. Generated data that was
+        spilled to disk is read back from its file on every call.
         """
+        if self.spilled_data != None:
+            return self.spilled_data.load()
+
         return self.generated_data
 
+    def get_generated_data_view(self):
+        """
+        Return a memoryview of the generated data for this task. Generated
+        data that was spilled to disk is viewed straight from its
+        memory-mapped file, without being read into memory first.
+        """
+        if self.spilled_data != None:
+            return self.spilled_data.get_view()
+
+        return memoryview(self.generated_data)
+
     def set_generated_data(self, generated_data):
         """
         Set the generated data for this task.
         """
         self.generated_data = generated_data
+        self.spilled_data = None
+
+    def is_spilled(self):
+        """
+        Return whether the generated data for this task was spilled to disk.
+        """
+        return self.spilled_data != None
+
+    def get_spilled_data(self):
+        """
+        Return the handle on the file the generated data for this task was
+        spilled to, or None.
+        """
+        return self.spilled_data
+
+    def set_spilled_data(self, spilled_data):
+        """
+        Replace the generated data for this task with a handle on the file
+        it was spilled to.
+        """
+        self.spilled_data = spilled_data
+        self.generated_data = None
 
     def get_starttime(self):
         """
@@ -28,6 +73,35 @@ class Task:
         """
         return self.starttime
 
+    def get_timings(self):
+        """
+        Return the times at which the task went through each stage of its
+        lifecycle, as a dictionary from stage to a time.monotonic() value
+        on the master node's clock, or None if none were recorded. A
+        completed task has the stages:
+
+            submitted   queued on the master node
+            dispatched  sent to a slave node
+            received    received by the slave node
+            started     handed to the code running it
+            finished    completed by the code running it
+            sent        sent back to the master node
+            completed   received back by the master node
+
+        Times recorded on the slave node are corrected for the offset
+        between its clock and the master node's.
+        """
+        return self.timings
+
+    def record_timing(self, stage, time=None):
+        """
+        Record the time, by default now, at which the task reached a stage.
+        """
+        if self.timings == None:
+            self.timings = {}
+
+        self.timings[stage] = monotonic() if time == None else time
+
     def get_task_id(self):
         """
         Return the task id for this task.
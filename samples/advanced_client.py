@@ -1,20 +1,15 @@
 import multiprocessing
 from hurricane import SlaveNode
 
-def run_node():
-    client = SlaveNode(debug=True, master_node='127.0.0.1')
+def run_task(task_data):
+    print("[*] Task name: " + str(task_data["name"]))
+    return {"completion_status" : "success"}
 
-    client.initialize()
-    client.wait_for_initialize()
 
-    while True:
-        task_data = client.wait_for_task()
-        print("[*] Task name: " + str(task_data["name"]))
-        client.finish_task(generated_data={"completion_status" : "success"})
+if __name__ == '__main__':
+    client = SlaveNode(debug=True, master_node='127.0.0.1', slots=multiprocessing.cpu_count())
 
+    client.initialize()
+    client.wait_for_initialize()
 
-if __name__ == '__main__':
-    for node_num in range(multiprocessing.cpu_count()):
-        print("[*] Starting another node...")
-        node_process = multiprocessing.Process(target=run_node)
-        node_process.start()
+    client.serve(run_task)
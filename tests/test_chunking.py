@@ -0,0 +1,68 @@
+import unittest
+from hurricane.master.chunking import ChunkSizer
+from hurricane.master.chunking import CHUNK_GROWTH
+
+class ChunkSizerTest(unittest.TestCase):
+
+    def test_starts_with_one_task(self):
+        self.assertEqual(ChunkSizer().get_chunksize(), 1)
+
+    def test_converges_on_target_time(self):
+        sizer = ChunkSizer(map_chunk_time=0.1)
+
+        for _ in range(20):
+            chunksize = sizer.get_chunksize()
+            sizer.record(chunksize, chunksize * 0.001)
+
+        self.assertEqual(sizer.get_chunksize(), 100)
+
+    def test_growth_is_bounded(self):
+        sizer = ChunkSizer(map_chunk_time=0.1)
+        sizer.record(1, 0.00001)
+
+        self.assertEqual(sizer.get_chunksize(), CHUNK_GROWTH)
+
+    def test_max_chunksize(self):
+        sizer = ChunkSizer(map_chunk_time=10.0, map_max_chunksize=50)
+
+        for _ in range(20):
+            sizer.record(sizer.get_chunksize(), 0.0)
+
+        self.assertEqual(sizer.get_chunksize(), 50)
+
+    def test_shrinks_for_slow_tasks(self):
+        sizer = ChunkSizer(map_chunk_time=0.1)
+
+        for _ in range(10):
+            chunksize = sizer.get_chunksize()
+            sizer.record(chunksize, chunksize * 0.001)
+
+        for _ in range(30):
+            chunksize = sizer.get_chunksize()
+            sizer.record(chunksize, chunksize * 0.05)
+
+        self.assertEqual(sizer.get_chunksize(), 2)
+
+    def test_never_below_one(self):
+        sizer = ChunkSizer(map_chunk_time=0.1)
+        sizer.record(1, 100.0)
+
+        self.assertEqual(sizer.get_chunksize(), 1)
+
+    def test_fixed_chunksize(self):
+        sizer = ChunkSizer(25)
+        sizer.record(25, 100.0)
+
+        self.assertEqual(sizer.get_chunksize(), 25)
+        self.assertEqual(ChunkSizer(0).get_chunksize(), 1)
+
+    def test_ignores_empty_chunks(self):
+        sizer = ChunkSizer()
+        sizer.record(0, 1.0)
+        sizer.record(5, -1.0)
+
+        self.assertEqual(sizer.get_chunksize(), 1)
+        self.assertEqual(sizer.task_time, None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import unittest
+from hurricane.master.detector import PhiAccrualDetector
+from hurricane.master.detector import get_phi
+
+def send_heartbeats(detector, node, interval, count, jitter=0.0):
+    """
+    Record count heartbeats from node, interval seconds apart give or take
+    jitter.
+
+    @returns the time of the last heartbeat
+    """
+    now = 0.0
+    for index in range(count):
+        now += interval + (jitter if index % 2 else -jitter)
+        detector.heartbeat(node, now, interval)
+
+    return now
+
+class PhiTest(unittest.TestCase):
+
+    def test_grows_with_elapsed_time(self):
+        values = [get_phi(elapsed, 1.0, 0.1) for elapsed in [0.5, 1.0, 1.5, 2.0, 5.0]]
+
+        self.assertEqual(values, sorted(values))
+        self.assertLess(values[0], 0.1)
+        self.assertGreater(values[-1], 8.0)
+
+    def test_does_not_overflow(self):
+        self.assertGreater(get_phi(1e6, 1.0, 0.1), 1e6)
+        self.assertEqual(get_phi(-1e6, 1.0, 0.1), 0.0)
+
+class PhiAccrualDetectorTest(unittest.TestCase):
+
+    def test_unknown_node(self):
+        detector = PhiAccrualDetector()
+
+        self.assertFalse(detector.is_monitored("node"))
+        self.assertEqual(detector.phi("node", 100.0), 0.0)
+        self.assertTrue(detector.is_available("node", 100.0))
+
+    def test_regular_heartbeats(self):
+        detector = PhiAccrualDetector()
+        last = send_heartbeats(detector, "node", 1.0, 50)
+
+        self.assertTrue(detector.is_monitored("node"))
+        self.assertTrue(detector.is_available("node", last + 1.0))
+        self.assertFalse(detector.is_available("node", last + 10.0))
+
+    def test_jitter_gives_more_slack(self):
+        steady = PhiAccrualDetector()
+        jittery = PhiAccrualDetector()
+        last = send_heartbeats(steady, "node", 1.0, 50)
+        send_heartbeats(jittery, "node", 1.0, 50, jitter=0.8)
+
+        self.assertLess(jittery.phi("node", last + 3.0), steady.phi("node", last + 3.0))
+
+    def test_announced_interval(self):
+        # A node that has only sent one heartbeat is judged by the interval
+        # it announced
+        detector = PhiAccrualDetector()
+        detector.heartbeat("node", 0.0, 1.0)
+
+        self.assertTrue(detector.is_available("node", 1.0))
+        self.assertFalse(detector.is_available("node", 30.0))
+
+    def test_threshold(self):
+        strict = PhiAccrualDetector(phi_threshold=1.0)
+        lenient = PhiAccrualDetector(phi_threshold=16.0)
+        send_heartbeats(strict, "node", 1.0, 50)
+        last = send_heartbeats(lenient, "node", 1.0, 50)
+
+        self.assertFalse(strict.is_available("node", last + 2.0))
+        self.assertTrue(lenient.is_available("node", last + 2.0))
+
+    def test_remove(self):
+        detector = PhiAccrualDetector()
+        last = send_heartbeats(detector, "node", 1.0, 10)
+        detector.remove("node")
+
+        self.assertFalse(detector.is_monitored("node"))
+        self.assertTrue(detector.is_available("node", last + 100.0))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+import unittest
+from time import time
+from hurricane.utils.task import Task
+from hurricane.master.dispatch import DispatchQueue
+
+def make_batch(batch_id):
+    """
+    Return a batch of one task.
+    """
+    return [Task(task_id=batch_id)]
+
+def drain(queue):
+    """
+    Pop every batch off a queue.
+
+    @returns the batch ids in the order they were popped
+    """
+    batch_ids = []
+    while queue:
+        batch_ids.append(queue.pop()[0].get_task_id())
+
+    return batch_ids
+
+class DispatchQueueTest(unittest.TestCase):
+
+    def test_empty(self):
+        queue = DispatchQueue()
+
+        self.assertFalse(queue)
+        self.assertEqual(len(queue), 0)
+        self.assertEqual(queue.peek(), None)
+
+    def test_fifo_within_priority(self):
+        queue = DispatchQueue()
+        for batch_id in range(5):
+            queue.push(make_batch(batch_id))
+
+        self.assertEqual(len(queue), 5)
+        self.assertEqual(drain(queue), [0, 1, 2, 3, 4])
+
+    def test_priority(self):
+        queue = DispatchQueue()
+        queue.push(make_batch(0), priority=0)
+        queue.push(make_batch(1), priority=2)
+        queue.push(make_batch(2), priority=-1)
+        queue.push(make_batch(3), priority=2)
+        queue.push(make_batch(4), priority=1)
+
+        self.assertEqual(drain(queue), [1, 3, 4, 0, 2])
+
+    def test_earliest_deadline_first(self):
+        now = time()
+        queue = DispatchQueue()
+        queue.push(make_batch(0))
+        queue.push(make_batch(1), deadline=now + 30)
+        queue.push(make_batch(2), deadline=now + 10)
+        queue.push(make_batch(3), deadline=now + 20)
+
+        # Batches without a deadline come last
+        self.assertEqual(drain(queue), [2, 3, 1, 0])
+
+    def test_peek_matches_pop(self):
+        queue = DispatchQueue()
+        queue.push(make_batch(0), priority=1)
+        queue.push(make_batch(1), priority=3)
+        queue.push(make_batch(2), priority=2)
+
+        while queue:
+            self.assertIs(queue.peek(), queue.pop())
+
+    def test_aging(self):
+        queue = DispatchQueue(priority_aging=60.0)
+        queue.push(make_batch(0), priority=0)
+        queue.push(make_batch(1), priority=1)
+
+        self.assertEqual(queue.peek()[0].get_task_id(), 1)
+
+        # Two minutes of waiting is worth two priority levels
+        queue.entries[0].enqueue_time -= 120
+
+        self.assertEqual(queue.peek()[0].get_task_id(), 0)
+        self.assertEqual(drain(queue), [0, 1])
+
+    def test_no_aging(self):
+        queue = DispatchQueue(priority_aging=None)
+        queue.push(make_batch(0), priority=0)
+        queue.push(make_batch(1), priority=1)
+        queue.entries[0].enqueue_time -= 1e6
+
+        self.assertEqual(drain(queue), [1, 0])
+
+    def test_push_front(self):
+        queue = DispatchQueue()
+        queue.push(make_batch(0), priority=5)
+        queue.push(make_batch(1))
+        queue.push_front([make_batch(2), make_batch(3)])
+
+        self.assertEqual(len(queue), 4)
+        self.assertEqual([batch[0].get_task_id() for batch in queue][:2], [2, 3])
+        self.assertEqual(drain(queue), [2, 3, 0, 1])
+
+    def test_info_kept_until_finished(self):
+        deadline = time() + 60
+        queue = DispatchQueue()
+        queue.push(make_batch(0), priority=3, deadline=deadline)
+        queue.pop()
+
+        # A batch in flight keeps its priority and deadline
+        self.assertEqual(queue.get_info(0), (3, deadline))
+        self.assertNotEqual(queue.get_enqueue_time(0), None)
+
+        queue.finish(0)
+
+        self.assertEqual(queue.get_info(0), (0, None))
+        self.assertEqual(queue.get_enqueue_time(0), None)
+
+    def test_deadline_stats(self):
+        now = time()
+        queue = DispatchQueue()
+        queue.push(make_batch(0), deadline=now + 60)
+        queue.push(make_batch(1), deadline=now - 10)
+        queue.push(make_batch(2), deadline=now + 60)
+        queue.push(make_batch(3))
+        drain(queue)
+
+        queue.finish(0)
+        queue.finish(1)
+        queue.finish(2, completed=False)
+        queue.finish(3)
+
+        stats = queue.get_stats()
+
+        self.assertEqual(stats["queued_batches"], 0)
+        self.assertEqual(stats["deadlines_met"], 1)
+        self.assertEqual(stats["deadlines_missed"], 2)
+        self.assertGreaterEqual(stats["total_lateness"], 10)
+        self.assertLess(stats["total_lateness"], 20)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,236 @@
+import os
+import shutil
+import tempfile
+import unittest
+from hurricane.utils.task import Task
+from hurricane.utils.spill import spill_data
+from hurricane.master.journal import TaskJournal
+from hurricane.master.journal import JOURNAL_HEADER
+
+def make_batch(batch_id, size=1):
+    """
+    Return a batch of size tasks, identified by the id of its first task.
+    """
+    return [Task(task_id=batch_id + index, data={"value": batch_id + index}) for index in range(size)]
+
+def get_completed_tasks(count):
+    """
+    Return (task, size) for count completed batches of one task, each
+    task's generated data and size being its id.
+    """
+    completed = []
+    for batch_id in range(count):
+        task = make_batch(batch_id)[0]
+        task.set_generated_data(batch_id)
+        completed.append((task, batch_id))
+
+    return completed
+
+def get_task_ids(batches):
+    """
+    Return the task ids in each of a list of batches.
+    """
+    return [[task.get_task_id() for task in batch] for batch in batches]
+
+class TaskJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "journal")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def reopen(self, journal):
+        """
+        Close a journal and replay it into a new one.
+
+        @returns the new journal and its state
+        """
+        journal.close()
+        journal = TaskJournal(self.path)
+
+        return journal, journal.open()
+
+    def test_empty(self):
+        journal = TaskJournal(self.path)
+        state = journal.open()
+
+        self.assertEqual(state.get_pending_batches(), [])
+        self.assertEqual(state.get_completed_tasks(), [])
+
+        journal, state = self.reopen(journal)
+        journal.close()
+
+        self.assertEqual(state.get_pending_batches(), [])
+
+    def test_replay(self):
+        journal = TaskJournal(self.path)
+        journal.open()
+
+        journal.submit([make_batch(0, 2), make_batch(10, 3), make_batch(20)])
+        journal.submit([make_batch(30)], speculative=False, priority=5, deadline=12.5)
+        journal.dispatch(10)
+
+        completed = make_batch(0, 2)
+        completed[0].set_generated_data("result")
+        journal.complete(0, [(completed[0], 100), (completed[1], 200)])
+        journal.abandon([20])
+
+        journal, state = self.reopen(journal)
+        journal.close()
+
+        # Dispatched batches come first
+        self.assertEqual(get_task_ids(state.get_pending_batches()), [[10, 11, 12], [30]])
+        self.assertEqual(state.get_pending_batches()[0][1].get_data(), {"value": 11})
+        self.assertEqual(state.dispatched, {10})
+        self.assertEqual(state.non_speculative, {30})
+        self.assertEqual(state.priorities, {30: (5, 12.5)})
+
+        completed = state.get_completed_tasks()
+
+        self.assertEqual([(task.get_task_id(), size) for task, size in completed], [(0, 100), (1, 200)])
+        self.assertEqual(completed[0][0].get_generated_data(), "result")
+
+    def test_appends_after_replay(self):
+        journal = TaskJournal(self.path)
+        journal.open()
+        journal.submit([make_batch(0)])
+
+        journal, state = self.reopen(journal)
+        journal.submit([make_batch(1)])
+
+        journal, state = self.reopen(journal)
+        journal.close()
+
+        self.assertEqual(get_task_ids(state.get_pending_batches()), [[0], [1]])
+
+    def test_truncated_record(self):
+        journal = TaskJournal(self.path)
+        journal.open()
+        journal.submit([make_batch(0)])
+        journal.submit([make_batch(1)])
+        journal.close()
+
+        with open(self.path, "r+b") as journal_file:
+            journal_file.truncate(os.path.getsize(self.path) - 3)
+
+        with self.assertLogs(level="WARNING"):
+            journal = TaskJournal(self.path)
+            state = journal.open()
+
+        self.assertEqual(get_task_ids(state.get_pending_batches()), [[0]])
+
+        # The partial record is cut off, so new records follow the last
+        # complete one
+        journal.submit([make_batch(2)])
+        journal, state = self.reopen(journal)
+        journal.close()
+
+        self.assertEqual(get_task_ids(state.get_pending_batches()), [[0], [2]])
+
+    def test_corrupted_record(self):
+        journal = TaskJournal(self.path)
+        journal.open()
+        journal.submit([make_batch(0)])
+        journal.submit([make_batch(1)])
+        journal.close()
+
+        with open(self.path, "r+b") as journal_file:
+            journal_file.seek(-1, os.SEEK_END)
+            last = journal_file.read(1)
+            journal_file.seek(-1, os.SEEK_END)
+            journal_file.write(bytes([last[0] ^ 0xFF]))
+
+        with self.assertLogs(level="WARNING"):
+            journal = TaskJournal(self.path)
+            state = journal.open()
+
+        journal.close()
+
+        self.assertEqual(get_task_ids(state.get_pending_batches()), [[0]])
+
+    def test_not_a_journal(self):
+        with open(self.path, "wb") as journal_file:
+            journal_file.write(b"x" * (JOURNAL_HEADER.size + 10))
+
+        with self.assertRaises(ValueError):
+            TaskJournal(self.path).open()
+
+    def test_compaction(self):
+        journal = TaskJournal(self.path, journal_compaction_records=10)
+        journal.open()
+
+        for batch_id in range(20):
+            journal.submit([make_batch(batch_id)], priority=batch_id % 2)
+            journal.dispatch(batch_id)
+
+        for task, size in get_completed_tasks(15):
+            journal.complete(task.get_task_id(), [(task, size)])
+
+        self.assertTrue(journal.needs_compaction(5))
+
+        journal.start_compaction()
+        snapshot_path = journal.write_snapshot([make_batch(batch_id) for batch_id in range(15, 20)], list(range(15, 20)), set(), {batch_id: (1, None) for batch_id in range(15, 20) if batch_id % 2}, get_completed_tasks(15))
+
+        # Records appended while the snapshot is written are kept
+        journal.submit([make_batch(20)])
+        journal.abandon([19])
+        journal.finish_compaction(snapshot_path)
+
+        self.assertFalse(journal.needs_compaction(5))
+        self.assertFalse(os.path.exists(snapshot_path))
+
+        journal, state = self.reopen(journal)
+        journal.close()
+
+        self.assertEqual(get_task_ids(state.get_pending_batches()), [[15], [16], [17], [18], [20]])
+        self.assertEqual(state.dispatched, {15, 16, 17, 18})
+        self.assertEqual(state.priorities, {15: (1, None), 17: (1, None)})
+        self.assertEqual([task.get_generated_data() for task, size in state.get_completed_tasks()], list(range(15)))
+
+    def test_aborted_compaction(self):
+        journal = TaskJournal(self.path)
+        journal.open()
+        journal.submit([make_batch(0)])
+
+        journal.start_compaction()
+        journal.abort_compaction()
+        journal.submit([make_batch(1)])
+
+        journal, state = self.reopen(journal)
+        journal.close()
+
+        self.assertEqual(get_task_ids(state.get_pending_batches()), [[0], [1]])
+
+    def test_spilled_tasks(self):
+        journal = TaskJournal(self.path)
+        journal.open()
+
+        completed = get_completed_tasks(3)
+        for task, size in completed[:2]:
+            task.set_spilled_data(spill_data(b"x" * 100000 if task.get_task_id() == 0 else ["y"] * 1000, self.directory, keep_at_exit=True))
+
+        journal.complete(0, completed)
+        journal.close()
+
+        # Spilled data is referenced by path, not copied into the journal
+        self.assertLess(os.path.getsize(self.path), 10000)
+
+        # The file of a spilled task that was claimed is gone
+        completed[1][0].get_spilled_data().remove()
+
+        journal = TaskJournal(self.path)
+        state = journal.open()
+        journal.close()
+
+        tasks = [task for task, size in state.get_completed_tasks()]
+
+        self.assertEqual([task.get_task_id() for task in tasks], [0, 2])
+        self.assertTrue(tasks[0].is_spilled())
+        self.assertEqual(tasks[0].get_spilled_data().get_path(), completed[0][0].get_spilled_data().get_path())
+        self.assertEqual(tasks[0].get_generated_data(), b"x" * 100000)
+        self.assertEqual(tasks[1].get_generated_data(), 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+"""
+Runs a master node and slave node processes on this host, and checks that
+tasks make it there and back, over the network and through shared memory.
+"""
+import time
+import socket
+import logging
+import unittest
+import multiprocessing
+from hurricane import MasterNode
+from hurricane import SlaveNode
+from hurricane.utils.sharedMemory import HAS_SHARED_MEMORY
+
+TIMEOUT = 30
+
+def get_free_ports():
+    """
+    Return an initialize port for a master node, such that it and the port
+    two above it (for task completions) are free.
+    """
+    while True:
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            port = probe.getsockname()[1]
+
+        if port + 2 > 65535:
+            continue
+
+        with socket.socket() as probe:
+            try:
+                probe.bind(("127.0.0.1", port + 2))
+            except OSError:
+                continue
+
+        return port
+
+def reverse(data):
+    """
+    Task handler of the slave nodes.
+    """
+    return bytes(data)[::-1]
+
+def run_slave(initialize_port, shared_memory):
+    """
+    Body of a slave node process.
+    """
+    slave = SlaveNode(master_node="127.0.0.1", initialize_port=initialize_port, slots=2, shared_memory=shared_memory, level=logging.WARNING)
+    slave.initialize()
+    slave.serve(reverse, executor="thread")
+
+class LoopbackTest(unittest.TestCase):
+
+    shared_memory = False
+    nodes = 2
+
+    def setUp(self):
+        initialize_port = get_free_ports()
+
+        self.master = MasterNode(initialize_port=initialize_port, shared_memory=self.shared_memory, level=logging.WARNING)
+        self.master.initialize()
+
+        # Not daemons, since slave nodes start processes of their own
+        self.slaves = [multiprocessing.Process(target=run_slave, args=(initialize_port, self.shared_memory)) for _ in range(self.nodes)]
+        for slave in self.slaves:
+            slave.start()
+
+        deadline = time.monotonic() + TIMEOUT
+        while len(self.master.get_stats()["nodes"]) < self.nodes:
+            if time.monotonic() > deadline:
+                self.tearDown()
+                self.fail("The slave nodes did not connect")
+
+            time.sleep(0.05)
+
+    def tearDown(self):
+        self.master.stop()
+
+        for slave in self.slaves:
+            slave.terminate()
+            slave.join()
+
+    def test_tasks(self):
+        payloads = [bytes([index]) * (index + 1) for index in range(100)]
+        task_ids = self.master.send_tasks(payloads)
+
+        tasks = list(self.master.gather(task_ids, TIMEOUT))
+
+        self.assertEqual([task.get_generated_data() for task in tasks], [payload[::-1] for payload in payloads])
+
+    def test_batches(self):
+        payloads = [str(index).encode() for index in range(1000)]
+        task_ids = self.master.send_tasks(payloads, chunksize=50)
+
+        tasks = list(self.master.gather(task_ids, TIMEOUT))
+
+        self.assertEqual([task.get_generated_data() for task in tasks], [payload[::-1] for payload in payloads])
+
+    def test_large_payloads(self):
+        # Large enough to be sent out-of-band
+        payloads = [bytes(range(256)) * 1024 + bytes([index]) for index in range(20)]
+        task_ids = self.master.send_tasks(payloads)
+
+        tasks = list(self.master.gather(task_ids, TIMEOUT))
+
+        self.assertEqual([task.get_generated_data() for task in tasks], [payload[::-1] for payload in payloads])
+
+        # Completions carry the task data back by default
+        self.assertEqual(tasks[0].get_data(), payloads[0])
+
+    def test_map(self):
+        payloads = [str(index).encode() for index in range(500)]
+
+        self.assertEqual(list(self.master.map(payloads, timeout=TIMEOUT)), [payload[::-1] for payload in payloads])
+
+    def test_stats(self):
+        list(self.master.gather(self.master.send_tasks([b"x" * 1000] * 10), TIMEOUT))
+
+        stats = self.master.get_stats()
+
+        self.assertEqual(len(stats["nodes"]), self.nodes)
+        self.assertGreater(stats["network"]["bytes_sent"], 0)
+        self.assertGreater(stats["network"]["bytes_received"], 0)
+        self.assertEqual(stats["tasks"]["completed"], 10)
+        self.assertEqual(stats["tasks"]["in_flight_batches"], 0)
+        self.assertEqual(stats["completed_tasks"]["stored"], 0)
+
+@unittest.skipUnless(HAS_SHARED_MEMORY, "shared memory is not available")
+class SharedMemoryLoopbackTest(LoopbackTest):
+
+    shared_memory = True
+
+    def test_shared_memory_is_used(self):
+        payloads = [bytes([index]) * 100000 for index in range(20)]
+        list(self.master.gather(self.master.send_tasks(payloads), TIMEOUT))
+
+        network = self.master.get_stats()["network"]
+
+        self.assertGreater(network["shared_memory_bytes_sent"], 2000000)
+        self.assertGreater(network["shared_memory_bytes_received"], 0)
+
+        # Only descriptors go over the socket
+        self.assertLess(network["bytes_sent"], network["shared_memory_bytes_sent"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,198 @@
+import unittest
+from datetime import datetime
+from hurricane.messages import HeartbeatMessage
+from hurricane.messages import NewNodeMessage
+from hurricane.messages import TaskManagementMessage
+from hurricane.messages import NodeInitializeMessage
+from hurricane.messages import TaskBatchMessage
+from hurricane.utils.task import Task
+from hurricane.utils.compression import get_codec
+from hurricane.utils.messages import FLAG_CONTROL
+from hurricane.utils.messages import OUT_OF_BAND_THRESHOLD
+from hurricane.utils.messages import HAS_OUT_OF_BAND_BUFFERS
+from hurricane.utils.messages import encode_data
+from hurricane.utils.messages import decode_data
+from hurricane.utils.messages import split_frame
+from hurricane.utils.messages import encode_datagram
+from hurricane.utils.messages import decode_datagram
+from hurricane.utils.messages import compress_message
+
+def round_trip(data):
+    """
+    Encode data, join the message into one frame, and decode it again.
+    """
+    flags, body, buffers = split_frame(b"".join(encode_data(data)))
+
+    return decode_data(body, buffers, flags)
+
+class ControlMessageTest(unittest.TestCase):
+
+    def test_heartbeat(self):
+        message = round_trip(HeartbeatMessage(7, 3, 0.5, 10.25, 9.5, 10.0))
+
+        self.assertIsInstance(message, HeartbeatMessage)
+        self.assertEqual(message.get_node_id(), 7)
+        self.assertEqual(message.get_tasks(), 3)
+        self.assertEqual(message.get_interval(), 0.5)
+        self.assertEqual(message.get_sent_time(), 10.25)
+        self.assertEqual(message.get_echo_time(), 9.5)
+        self.assertEqual(message.get_receive_time(), 10.0)
+
+    def test_empty_heartbeat(self):
+        message = round_trip(HeartbeatMessage())
+
+        self.assertEqual(message.get_node_id(), None)
+        self.assertEqual(message.get_interval(), None)
+
+    def test_task_management(self):
+        message = round_trip(TaskManagementMessage(node_id=2, task_port=12222, task_completion_port=12223, compression=["zlib"], shared_memory=["ring-a", "ring-b"]))
+
+        self.assertEqual(message.get_node_id(), 2)
+        self.assertEqual(message.get_task_port(), 12222)
+        self.assertEqual(message.get_task_completion_port(), 12223)
+        self.assertEqual(message.get_compression(), ["zlib"])
+        self.assertEqual(message.get_shared_memory(), ["ring-a", "ring-b"])
+
+    def test_node_initialize(self):
+        message = round_trip(NodeInitializeMessage("127.0.0.1", 8, 16, "zlib", True, 4, 12222))
+
+        self.assertEqual(message.get_addr(), "127.0.0.1")
+        self.assertEqual(message.get_cpu_count(), 8)
+        self.assertEqual(message.get_slots(), 16)
+        self.assertEqual(message.get_compression(), "zlib")
+        self.assertTrue(message.get_shared_memory())
+        self.assertEqual(message.get_node_id(), 4)
+        self.assertEqual(message.get_task_port(), 12222)
+
+    def test_new_node(self):
+        message = round_trip(NewNodeMessage("10.0.0.2", 12222, 12223))
+
+        self.assertEqual(message.get_addr(), "10.0.0.2")
+        self.assertEqual(message.get_task_port(), 12222)
+        self.assertEqual(message.get_task_completion_port(), 12223)
+
+    def test_control_messages_are_not_pickled(self):
+        message = encode_data(HeartbeatMessage(1, 0))
+
+        self.assertTrue(message[0][1] & FLAG_CONTROL)
+
+class TaskBatchTest(unittest.TestCase):
+
+    def test_batch(self):
+        starttime = datetime(2020, 5, 17, 12, 30, 15, 250)
+        tasks = [Task(task_id=task_id, data={"value": task_id}, starttime=starttime) for task_id in range(5)]
+        tasks[2].set_generated_data([1, 2, 3])
+
+        message = round_trip(TaskBatchMessage(tasks, 3))
+
+        self.assertIsInstance(message, TaskBatchMessage)
+        self.assertEqual(message.get_node_id(), 3)
+        self.assertEqual([task.get_task_id() for task in message.get_tasks()], list(range(5)))
+        self.assertEqual([task.get_data() for task in message.get_tasks()], [{"value": task_id} for task_id in range(5)])
+        self.assertEqual(message.get_tasks()[0].get_starttime(), starttime)
+        self.assertEqual(message.get_tasks()[2].get_generated_data(), [1, 2, 3])
+
+    def test_timings(self):
+        task = Task(task_id=1, data=None)
+        task.record_timing("received", 1.0)
+        task.record_timing("sent", 2.5)
+
+        timings = round_trip(TaskBatchMessage([task], 1)).get_tasks()[0].get_timings()
+
+        self.assertEqual(timings["received"], 1.0)
+        self.assertEqual(timings["sent"], 2.5)
+
+    def test_arbitrary_data(self):
+        self.assertEqual(round_trip({"a": [1, 2.5, "three"]}), {"a": [1, 2.5, "three"]})
+
+@unittest.skipUnless(HAS_OUT_OF_BAND_BUFFERS, "pickle protocol 5 is not available")
+class OutOfBandTest(unittest.TestCase):
+
+    def test_large_bytes_are_sent_out_of_band(self):
+        data = b"x" * (OUT_OF_BAND_THRESHOLD * 2)
+        message = encode_data(Task(task_id=1, data=data))
+
+        self.assertGreater(len(message), 2)
+        self.assertLess(len(message[1]), OUT_OF_BAND_THRESHOLD)
+
+    def test_large_bytes_arrive_as_read_only_views(self):
+        data = bytes(range(256)) * (OUT_OF_BAND_THRESHOLD // 128)
+        task = round_trip(Task(task_id=1, data=data))
+
+        self.assertIsInstance(task.get_data(), memoryview)
+        self.assertTrue(task.get_data().readonly)
+        self.assertEqual(task.get_data(), data)
+
+    def test_large_bytearray_stays_bytearray(self):
+        data = bytearray(OUT_OF_BAND_THRESHOLD * 2)
+        task = round_trip(Task(task_id=1, data=data))
+
+        self.assertIsInstance(task.get_data(), bytearray)
+        self.assertEqual(task.get_data(), data)
+
+    def test_small_bytes_stay_bytes(self):
+        task = round_trip(Task(task_id=1, data=b"small"))
+
+        self.assertEqual(task.get_data(), b"small")
+        self.assertIsInstance(task.get_data(), bytes)
+
+class CompressionTest(unittest.TestCase):
+
+    def test_compressed_round_trip(self):
+        data = {"payload": "abc" * 20000, "blob": b"y" * (OUT_OF_BAND_THRESHOLD * 2)}
+        message = encode_data(data)
+        compressed = compress_message(message, get_codec("zlib"), threshold=0)
+
+        self.assertLess(len(b"".join(compressed)), len(b"".join(message)))
+
+        flags, body, buffers = split_frame(b"".join(compressed))
+
+        self.assertEqual(decode_data(body, buffers, flags), data)
+
+    def test_small_messages_are_not_compressed(self):
+        message = encode_data({"payload": "abc"})
+
+        self.assertIs(compress_message(message, get_codec("zlib")), message)
+
+class SplitFrameTest(unittest.TestCase):
+
+    def test_truncated_frame(self):
+        frame = b"".join(encode_data({"payload": "abc"}))
+
+        with self.assertRaises(ValueError):
+            split_frame(frame[:-1])
+
+    def test_trailing_bytes(self):
+        frame = b"".join(encode_data({"payload": "abc"}))
+
+        with self.assertRaises(ValueError):
+            split_frame(frame + b"\0")
+
+    def test_short_frame(self):
+        with self.assertRaises(ValueError):
+            split_frame(b"\0")
+
+    def test_other_version(self):
+        frame = bytearray(b"".join(encode_data({"payload": "abc"})))
+        frame[0] = (frame[0] + 1) % 256
+
+        with self.assertRaises(ValueError):
+            split_frame(frame)
+
+class DatagramTest(unittest.TestCase):
+
+    def test_heartbeat(self):
+        message = decode_datagram(encode_datagram(HeartbeatMessage(5, 2, 1.0, 3.0)))
+
+        self.assertEqual(message.get_node_id(), 5)
+        self.assertEqual(message.get_tasks(), 2)
+
+    def test_pickled_data_is_refused(self):
+        with self.assertRaises(ValueError):
+            encode_datagram({"payload": "abc"})
+
+        with self.assertRaises(ValueError):
+            decode_datagram(b"".join(encode_data({"payload": "abc"})))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+import unittest
+from hurricane.utils.sharedMemory import HAS_SHARED_MEMORY
+from hurricane.utils.sharedMemory import RECORD_STATE
+from hurricane.utils.sharedMemory import SharedMemoryRing
+from hurricane.utils.messages import encode_data
+from hurricane.utils.messages import decode_data
+from hurricane.utils.messages import write_shared_memory_frame
+from hurricane.utils.messages import read_shared_memory_frame
+from hurricane.utils.messages import release_shared_memory_frame
+from hurricane.utils.messages import get_shared_memory_frame_size
+
+RING_SIZE = 64 * 1024
+RECORD_SIZE = 1000
+
+@unittest.skipUnless(HAS_SHARED_MEMORY, "shared memory is not available")
+class SharedMemoryRingTest(unittest.TestCase):
+
+    def setUp(self):
+        # The records are read back through the writer's own handle, as
+        # attaching to a segment from the process that created it confuses
+        # the resource tracker
+        self.ring = SharedMemoryRing(size=RING_SIZE)
+        self.reader = self.ring
+
+    def tearDown(self):
+        self.ring.close()
+
+    def test_read_back(self):
+        _, start, length = self.ring.write([b"abc", bytearray(b"def")])
+
+        self.assertEqual(bytes(self.reader.read(start, length)), b"abcdef")
+
+    def test_full_ring(self):
+        records = []
+
+        while True:
+            descriptor = self.ring.write([b"r" * RECORD_SIZE])
+            if descriptor == None:
+                break
+
+            records.append(descriptor)
+
+        self.assertGreater(len(records), 0)
+        self.assertLessEqual(len(records) * (RECORD_SIZE + RECORD_STATE.size), self.ring.capacity)
+
+        # Releasing the oldest record makes room for one more
+        self.reader.release(records[0][1])
+
+        self.assertNotEqual(self.ring.write([b"r" * RECORD_SIZE]), None)
+
+    def test_out_of_order_release(self):
+        first = self.ring.write([b"a" * (self.ring.capacity // 2)])
+        second = self.ring.write([b"b" * (self.ring.capacity // 4)])
+
+        # Space only comes back once every record before it is released
+        self.reader.release(second[1])
+        self.assertEqual(self.ring.write([b"c" * (self.ring.capacity // 2)]), None)
+
+        self.reader.release(first[1])
+        self.assertNotEqual(self.ring.write([b"c" * (self.ring.capacity // 2)]), None)
+
+    def test_wrap_around(self):
+        # Records are never split across the end of the ring, so each one
+        # reads back whole for many times around
+        for round_number in range(100):
+            data = bytes([round_number]) * (self.ring.capacity // 3 + round_number)
+            descriptor = self.ring.write([data])
+
+            self.assertNotEqual(descriptor, None)
+
+            _, start, length = descriptor
+            record = self.reader.read(start, length)
+
+            self.assertEqual(bytes(record), data)
+
+            record.release()
+            self.reader.release(start)
+
+    def test_too_large(self):
+        self.assertEqual(self.ring.write([b"x" * self.ring.capacity]), None)
+
+@unittest.skipUnless(HAS_SHARED_MEMORY, "shared memory is not available")
+class SharedMemoryFrameTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ring = SharedMemoryRing(size=RING_SIZE)
+        self.rings = {1: self.ring}
+
+    def tearDown(self):
+        self.ring.close()
+
+    def test_round_trip(self):
+        data = {"payload": b"p" * 10000}
+        message = write_shared_memory_frame(encode_data(data), self.ring, 1)
+
+        self.assertGreater(get_shared_memory_frame_size(message), 10000)
+
+        body, buffers, flags = read_shared_memory_frame(message[1], self.rings)
+
+        self.assertEqual(decode_data(body, buffers, flags), data)
+
+    def test_unknown_node(self):
+        message = write_shared_memory_frame(encode_data({"payload": "abc"}), self.ring, 2)
+
+        with self.assertRaises(ValueError):
+            read_shared_memory_frame(message[1], self.rings)
+
+    def test_failed_send_releases_record(self):
+        # A frame whose descriptor could not be sent is released by the
+        # writer; without that, the ring fills up and stays full
+        encoded = encode_data({"payload": b"p" * (self.ring.capacity // 4)})
+
+        for _ in range(20):
+            message = write_shared_memory_frame(encoded, self.ring, 1)
+
+            self.assertNotEqual(message, None)
+
+            release_shared_memory_frame(message, self.ring)
+
+    def test_socket_frames_are_not_released(self):
+        message = encode_data({"payload": "abc"})
+
+        release_shared_memory_frame(message, self.ring)
+
+        self.assertEqual(get_shared_memory_frame_size(message), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import unittest
+from hurricane.master.speculation import Speculator
+
+class SpeculatorTest(unittest.TestCase):
+
+    def test_threshold_needs_samples(self):
+        speculator = Speculator(speculation_min_samples=5)
+        for _ in range(4):
+            speculator.record_latency(1, 1.0)
+
+        self.assertEqual(speculator.get_latency_threshold(), None)
+
+        speculator.record_latency(1, 1.0)
+
+        self.assertEqual(speculator.get_latency_threshold(), 2.0)
+
+    def test_threshold_per_task(self):
+        speculator = Speculator(speculation_min_samples=1, speculation_percentile=90, speculation_multiplier=3.0)
+        for latency in range(1, 11):
+            speculator.record_latency(10, latency)
+
+        self.assertAlmostEqual(speculator.get_latency_threshold(), 3.0)
+
+    def test_straggler(self):
+        speculator = Speculator()
+
+        self.assertFalse(speculator.is_straggler(1, 4, 7.0, 2.0))
+        self.assertTrue(speculator.is_straggler(1, 4, 9.0, 2.0))
+
+        speculator.disallow(2)
+
+        self.assertFalse(speculator.is_straggler(2, 4, 100.0, 2.0))
+
+    def test_first_result_wins(self):
+        speculator = Speculator()
+        speculator.speculate(1, "a", "b")
+
+        self.assertTrue(speculator.is_speculative(1))
+        self.assertEqual(speculator.get_nodes(1), {"a", "b"})
+        self.assertFalse(speculator.is_straggler(1, 1, 100.0, 1.0))
+
+        self.assertTrue(speculator.complete(1, "b"))
+
+        # The copy on the other node no longer counts as running
+        self.assertFalse(speculator.is_speculative(1))
+        self.assertEqual(speculator.get_stats()["running_speculations"], 0)
+
+        self.assertFalse(speculator.complete(1, "a"))
+        self.assertEqual(speculator.get_stats()["discarded_duplicates"], 1)
+        self.assertEqual(speculator.get_stats()["speculated_batches"], 1)
+
+    def test_lose_copy(self):
+        speculator = Speculator()
+        speculator.speculate(1, "a", "b")
+
+        # Another copy is still running
+        self.assertTrue(speculator.lose(1, "a"))
+        self.assertEqual(speculator.get_nodes(1), {"b"})
+
+        self.assertFalse(speculator.lose(1, "b"))
+        self.assertFalse(speculator.is_speculative(1))
+
+    def test_lose_after_completion(self):
+        speculator = Speculator()
+        speculator.speculate(1, "a", "b")
+        speculator.complete(1, "a")
+
+        self.assertTrue(speculator.lose(1, "b"))
+
+    def test_lose_without_copies(self):
+        self.assertFalse(Speculator().lose(1, "a"))
+
+    def test_complete_without_copies(self):
+        speculator = Speculator()
+
+        self.assertTrue(speculator.complete(1, "a"))
+        self.assertTrue(speculator.complete(1, "a"))
+        self.assertEqual(speculator.get_stats()["discarded_duplicates"], 0)
+
+if __name__ == '__main__':
+    unittest.main()
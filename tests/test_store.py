@@ -0,0 +1,204 @@
+import gc
+import os
+import shutil
+import tempfile
+import unittest
+from hurricane.utils.task import Task
+from hurricane.master.store import CompletedTaskStore
+from hurricane.master.store import get_result_size
+
+def make_task(task_id, generated_data=None, data=None):
+    """
+    Return a completed task.
+    """
+    task = Task(task_id=task_id, data=data)
+    task.set_generated_data(generated_data)
+
+    return task
+
+class CompletedTaskStoreTest(unittest.TestCase):
+
+    def test_claim(self):
+        store = CompletedTaskStore()
+        store.add(make_task(1, "one"), 10)
+        store.add(make_task(2, "two"), 10)
+
+        self.assertEqual(len(store), 2)
+        self.assertIn(1, store)
+        self.assertEqual(store.claim(1).get_generated_data(), "one")
+        self.assertEqual(store.claim(1), None)
+        self.assertNotIn(1, store)
+        self.assertEqual(len(store), 1)
+
+    def test_claim_many(self):
+        store = CompletedTaskStore()
+        for task_id in range(10):
+            store.add(make_task(task_id), 10)
+
+        # Through the store, in completion order
+        self.assertEqual([task.get_task_id() for task in store.claim_many(set(range(20)))], list(range(10)))
+
+        for task_id in range(10):
+            store.add(make_task(task_id), 10)
+
+        claimed = store.claim_many({3, 7, 42})
+
+        self.assertEqual(sorted(task.get_task_id() for task in claimed), [3, 7])
+        self.assertEqual(len(store), 8)
+
+    def test_claim_oldest(self):
+        store = CompletedTaskStore()
+        store.add(make_task(5), 10)
+        store.add(make_task(2), 10)
+
+        self.assertEqual(store.claim_oldest().get_task_id(), 5)
+        self.assertEqual(store.claim_oldest().get_task_id(), 2)
+        self.assertEqual(store.claim_oldest(), None)
+
+    def test_add_again(self):
+        store = CompletedTaskStore()
+        store.add(make_task(1, b"x" * 100))
+        store.add(make_task(1, b"x" * 50))
+
+        self.assertEqual(len(store), 1)
+        self.assertEqual(store.get_stats()["stored_bytes"], 50)
+
+    def test_count_limit(self):
+        store = CompletedTaskStore(max_completed_tasks=3)
+        for task_id in range(5):
+            store.add(make_task(task_id), 10)
+
+        self.assertEqual([task.get_task_id() for task, size in store.get_tasks()], [2, 3, 4])
+        self.assertEqual(store.get_stats()["evictions"]["count"], 2)
+        self.assertEqual(store.get_stats()["evicted_bytes"], 20)
+
+    def test_byte_limit(self):
+        store = CompletedTaskStore(max_completed_bytes=250)
+        for task_id in range(5):
+            store.add(make_task(task_id, b"x" * 100))
+
+        self.assertEqual([task.get_task_id() for task, size in store.get_tasks()], [3, 4])
+        self.assertEqual(store.get_stats()["stored_bytes"], 200)
+        self.assertEqual(store.get_stats()["evictions"]["bytes"], 3)
+
+    def test_ttl(self):
+        store = CompletedTaskStore(completed_task_ttl=60)
+        store.add(make_task(1), 10)
+        store.add(make_task(2), 10)
+
+        task, size, completion_time = store.tasks[1]
+        store.tasks[1] = (task, size, completion_time - 120)
+
+        self.assertEqual(store.claim(1), None)
+        self.assertNotEqual(store.claim(2), None)
+        self.assertEqual(store.get_stats()["evictions"]["ttl"], 1)
+
+    def test_stats(self):
+        store = CompletedTaskStore()
+        store.add(make_task(1, b"x" * 100))
+        store.add(make_task(2, bytearray(30)))
+        store.claim(1)
+
+        stats = store.get_stats()
+
+        self.assertEqual(stats["stored"], 1)
+        self.assertEqual(stats["stored_bytes"], 30)
+        self.assertEqual(stats["spilled"], 0)
+
+class SpillTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def get_spill_files(self, directory=None):
+        return sorted(os.listdir(directory or self.directory))
+
+    def test_spill(self):
+        store = CompletedTaskStore(spill_threshold=1000, spill_directory=self.directory)
+        tasks = [make_task(1, b"x" * 5000), make_task(2, b"y" * 10), make_task(3, {"result": "z" * 3000})]
+        store.spill_results(tasks, 4000)
+
+        for task in tasks:
+            store.add(task, 4000)
+
+        self.assertEqual([task.is_spilled() for task in tasks], [True, False, True])
+        self.assertEqual(len(self.get_spill_files()), 2)
+
+        del task, tasks
+
+        stats = store.get_stats()
+
+        self.assertEqual(stats["spilled"], 2)
+        self.assertEqual(stats["total_spilled"], 2)
+        self.assertEqual(stats["stored_bytes"], 10)
+
+        self.assertEqual(bytes(store.claim(1).get_generated_data_view()), b"x" * 5000)
+        self.assertEqual(store.claim(3).get_generated_data(), {"result": "z" * 3000})
+
+        # The file goes with the claimed task
+        gc.collect()
+
+        self.assertEqual(self.get_spill_files(), [])
+        self.assertEqual(store.get_stats()["spilled"], 0)
+
+    def test_spilling_is_off_by_default(self):
+        store = CompletedTaskStore()
+        task = make_task(1, b"x" * 5000)
+        store.spill_results([task])
+
+        self.assertFalse(task.is_spilled())
+
+    def test_spilled_tasks_do_not_count_towards_byte_limit(self):
+        store = CompletedTaskStore(spill_threshold=1000, spill_directory=self.directory, max_completed_bytes=100)
+        tasks = [make_task(task_id, b"x" * 5000) for task_id in range(3)]
+        store.spill_results(tasks)
+
+        for task in tasks:
+            store.add(task)
+
+        self.assertEqual(len(store), 3)
+        self.assertEqual(store.get_stats()["evictions"]["bytes"], 0)
+
+    def test_journaled_spill_directory(self):
+        journal = os.path.join(self.directory, "journal")
+        store = CompletedTaskStore(spill_threshold=1000, journal=journal)
+        task = make_task(1, b"x" * 5000)
+        store.spill_results([task])
+
+        self.assertEqual(os.path.dirname(task.get_spilled_data().get_path()), journal + ".spill")
+        self.assertFalse(task.get_spilled_data().finalizer.atexit)
+
+    def test_remove_stray_spill_files(self):
+        journal = os.path.join(self.directory, "journal")
+        store = CompletedTaskStore(spill_threshold=1000, journal=journal)
+        tasks = [make_task(task_id, b"x" * 5000) for task_id in range(2)]
+        store.spill_results(tasks)
+        store.add(tasks[0])
+
+        with open(os.path.join(journal + ".spill", "other"), "wb"):
+            pass
+
+        store.remove_stray_spill_files()
+
+        # Only the file of the task that was never stored is removed
+        self.assertEqual(self.get_spill_files(journal + ".spill"), sorted(["other", os.path.basename(tasks[0].get_spilled_data().get_path())]))
+
+class ResultSizeTest(unittest.TestCase):
+
+    def test_bytes_like(self):
+        self.assertEqual(get_result_size(make_task(1, b"x" * 100), 5000), 100)
+        self.assertEqual(get_result_size(make_task(1, memoryview(bytearray(64))), 5000), 64)
+
+    def test_wire_size(self):
+        self.assertEqual(get_result_size(make_task(1, {"result": 1}), 5000), 5000)
+
+    def test_input_is_not_counted(self):
+        # The completion frame also carries the data the task was sent with
+        self.assertEqual(get_result_size(make_task(1, [1, 2], b"x" * 4000), 5000), 1000)
+        self.assertEqual(get_result_size(make_task(1, [1, 2], b"x" * 6000), 5000), 0)
+
+if __name__ == '__main__':
+    unittest.main()